@@ -0,0 +1,202 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+READ_CONCURRENCY = int(os.getenv("READ_CONCURRENCY", "24"))
+WRITE_CONCURRENCY = int(os.getenv("WRITE_CONCURRENCY", "8"))
+AUTH_CONCURRENCY = int(os.getenv("AUTH_CONCURRENCY", "4"))
+READ_QUEUE_SIZE = int(os.getenv("READ_QUEUE_SIZE", "200"))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "50"))
+AUTH_QUEUE_SIZE = int(os.getenv("AUTH_QUEUE_SIZE", "20"))
+READ_QUEUE_TIMEOUT = float(os.getenv("READ_QUEUE_TIMEOUT", "1.0"))
+WRITE_QUEUE_TIMEOUT = float(os.getenv("WRITE_QUEUE_TIMEOUT", "2.0"))
+AUTH_QUEUE_TIMEOUT = float(os.getenv("AUTH_QUEUE_TIMEOUT", "2.0"))
+# Per-user comments per second; 0 (the default) turns the limit off
+COMMENT_RATE = float(os.getenv("COMMENT_RATE", "0"))
+COMMENT_BURST = float(os.getenv("COMMENT_BURST", "5"))
+MAX_BUCKETS = 100_000
+
+AUTH_PATHS = ("/register/", "/login/")
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# Batch lookups take their ids in a POST body but only read
+READ_PATHS = ("/posts/batch", "/comments/batch", "/users/batch")
+
+
+class AdmissionPool:
+    # A concurrency limit with a bounded FIFO of waiters. Requests that find
+    # the queue full, or wait longer than `timeout`, are shed instead of
+    # holding a worker thread.
+    def __init__(self, name: str, concurrency: int, queue_size: int, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiters = deque()
+        self.counters = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    async def acquire(self) -> bool:
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return True
+        if len(self.waiters) >= self.queue_size:
+            self.counters["rejected"] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.counters["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timed_out"] += 1
+            return False
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        self.counters["admitted"] += 1
+        return True
+
+    def release(self):
+        # Hand the slot straight to the oldest waiter, so a newcomer cannot
+        # take it ahead of the queue
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.timeout))
+
+    def state(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            **self.counters,
+        }
+
+
+def default_pools() -> dict:
+    return {
+        "read": AdmissionPool(
+            "read", READ_CONCURRENCY, READ_QUEUE_SIZE, READ_QUEUE_TIMEOUT
+        ),
+        "write": AdmissionPool(
+            "write", WRITE_CONCURRENCY, WRITE_QUEUE_SIZE, WRITE_QUEUE_TIMEOUT
+        ),
+        "auth": AdmissionPool(
+            "auth", AUTH_CONCURRENCY, AUTH_QUEUE_SIZE, AUTH_QUEUE_TIMEOUT
+        ),
+    }
+
+
+admission_pools = default_pools()
+
+
+def classify_request(scope) -> str:
+    if scope["path"] in AUTH_PATHS:
+        return "auth"
+    if scope["method"] in WRITE_METHODS and scope["path"] not in READ_PATHS:
+        return "write"
+    return "read"
+
+
+class AdmissionMiddleware:
+    # Reads, writes and password hashing get separate pools, so a storm of
+    # moderation-bound writes cannot take every threadpool worker away from
+    # reads. Keep the pool sizes' sum below the threadpool size.
+    def __init__(self, app, pools: dict = None, classify=classify_request):
+        self.app = app
+        self.pools = pools if pools is not None else admission_pools
+        self.classify = classify
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        pool = self.pools[self.classify(scope)]
+        if not await pool.acquire():
+            body = json.dumps(
+                {"detail": f"Server is busy ({pool.name} requests), retry later"}
+            ).encode()
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(pool.retry_after()).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release()
+
+    def state(self) -> dict:
+        return {name: pool.state() for name, pool in self.pools.items()}
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    # Per-key token buckets: `rate` tokens per second up to `burst`. Idle
+    # buckets are refilled lazily and the least recently used are dropped.
+    def __init__(
+        self, rate: float, burst: float, max_buckets: int = MAX_BUCKETS, clock=None
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.clock = clock or time.monotonic
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until one is available
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.burst, now)
+                if len(self.buckets) > self.max_buckets:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket.tokens = min(
+                    self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate
+                )
+                bucket.updated_at = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / self.rate
+
+
+comment_limiter = RateLimiter(COMMENT_RATE, COMMENT_BURST) if COMMENT_RATE else None
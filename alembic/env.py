@@ -6,6 +6,7 @@ from sqlalchemy import pool
 from alembic import context
 
 from posts.models import *
+from sharding import GLOBAL_SHARD, SHARD_COUNT, shard_path
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -59,17 +60,31 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section, {}),
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
-
-    with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
-
-        with context.begin_transaction():
-            context.run_migrations()
+    section = config.get_section(config.config_ini_section, {})
+    urls = [section["sqlalchemy.url"]]
+    if SHARD_COUNT:
+        # Every shard file carries the full schema; the unused tables stay empty
+        shard_ids = [GLOBAL_SHARD] + [f"shard_{index}" for index in range(SHARD_COUNT)]
+        urls = [f"sqlite:///{shard_path(shard_id)}" for shard_id in shard_ids]
+
+    for url in urls:
+        connectable = engine_from_config(
+            {**section, "sqlalchemy.url": url},
+            prefix="sqlalchemy.",
+            poolclass=pool.NullPool,
+        )
+
+        with connectable.connect() as connection:
+            # Each revision commits on its own so chunked backfills (backfill.py)
+            # can run outside the migration transaction.
+            context.configure(
+                connection=connection,
+                target_metadata=target_metadata,
+                transaction_per_migration=True,
+            )
+
+            with context.begin_transaction():
+                context.run_migrations()
 
 
 if context.is_offline_mode():
@@ -0,0 +1,38 @@
+"""Backfill blocked flags
+
+Revision ID: 3c9d2f1a7b64
+Revises: 74fca43008eb
+Create Date: 2026-10-19 10:12:40.118302
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from backfill import backfill, reset_backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3c9d2f1a7b64"
+down_revision: Union[str, None] = "74fca43008eb"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    for name in ("posts", "comments"):
+        table = sa.table(name, sa.column("id", sa.Integer), sa.column("blocked"))
+        backfill(
+            f"{name}_blocked_default",
+            table,
+            values={"blocked": False},
+            where=table.c.blocked.is_(None),
+        )
+
+
+def downgrade() -> None:
+    # NULL and False mean the same thing to the app; only forget the progress
+    reset_backfill("posts_blocked_default")
+    reset_backfill("comments_blocked_default")
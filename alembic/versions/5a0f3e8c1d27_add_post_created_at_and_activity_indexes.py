@@ -0,0 +1,63 @@
+"""Add post created_at and activity indexes
+
+Revision ID: 5a0f3e8c1d27
+Revises: b7e41d0c92af
+Create Date: 2026-10-19 11:48:05.274610
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from backfill import backfill, create_index_online, reset_backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5a0f3e8c1d27"
+down_revision: Union[str, None] = "b7e41d0c92af"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("posts", sa.Column("created_at", sa.DateTime(), nullable=True))
+
+    # Existing posts never recorded a creation time; use their first comment,
+    # or the migration time for posts without comments.
+    posts = sa.table(
+        "posts", sa.column("id", sa.Integer), sa.column("created_at", sa.DateTime)
+    )
+    comments = sa.table(
+        "comments", sa.column("post_id", sa.Integer), sa.column("created_at")
+    )
+    backfill(
+        "posts_created_at",
+        posts,
+        values={
+            "created_at": sa.func.coalesce(
+                sa.select(sa.func.min(comments.c.created_at))
+                .where(comments.c.post_id == posts.c.id)
+                .scalar_subquery(),
+                sa.func.strftime("%Y-%m-%d %H:%M:%f000", "now"),
+            )
+        },
+        where=posts.c.created_at.is_(None),
+    )
+
+    create_index_online(
+        "ix_posts_user_id_created_at_id", "posts", ["user_id", "created_at", "id"]
+    )
+    create_index_online(
+        "ix_comments_user_id_created_at_id",
+        "comments",
+        ["user_id", "created_at", "id"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_comments_user_id_created_at_id", table_name="comments")
+    op.drop_index("ix_posts_user_id_created_at_id", table_name="posts")
+    reset_backfill("posts_created_at")
+    op.drop_column("posts", "created_at")
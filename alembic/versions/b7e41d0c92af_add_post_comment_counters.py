@@ -0,0 +1,75 @@
+"""Add post comment counters
+
+Revision ID: b7e41d0c92af
+Revises: 3c9d2f1a7b64
+Create Date: 2026-10-19 11:02:17.530914
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from backfill import backfill, create_index_online, reset_backfill
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b7e41d0c92af"
+down_revision: Union[str, None] = "3c9d2f1a7b64"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "posts",
+        sa.Column("comment_count", sa.Integer(), server_default="0", nullable=True),
+    )
+    op.add_column(
+        "posts",
+        sa.Column(
+            "blocked_comment_count", sa.Integer(), server_default="0", nullable=True
+        ),
+    )
+    op.add_column("posts", sa.Column("last_comment_at", sa.DateTime(), nullable=True))
+
+    create_index_online("ix_comments_post_id_id", "comments", ["post_id", "id"])
+
+    posts = sa.table(
+        "posts",
+        sa.column("id", sa.Integer),
+        sa.column("comment_count", sa.Integer),
+        sa.column("blocked_comment_count", sa.Integer),
+        sa.column("last_comment_at", sa.DateTime),
+    )
+    comments = sa.table(
+        "comments",
+        sa.column("post_id", sa.Integer),
+        sa.column("created_at", sa.DateTime),
+        sa.column("blocked", sa.Boolean),
+    )
+    visible = sa.or_(comments.c.blocked == False, comments.c.blocked.is_(None))
+    backfill(
+        "posts_comment_counters",
+        posts,
+        values={
+            "comment_count": sa.select(sa.func.count())
+            .where(comments.c.post_id == posts.c.id, visible)
+            .scalar_subquery(),
+            "blocked_comment_count": sa.select(sa.func.count())
+            .where(comments.c.post_id == posts.c.id, comments.c.blocked == True)
+            .scalar_subquery(),
+            "last_comment_at": sa.select(sa.func.max(comments.c.created_at))
+            .where(comments.c.post_id == posts.c.id, visible)
+            .scalar_subquery(),
+        },
+    )
+
+
+def downgrade() -> None:
+    reset_backfill("posts_comment_counters")
+    op.drop_index("ix_comments_post_id_id", table_name="comments")
+    op.drop_column("posts", "last_comment_at")
+    op.drop_column("posts", "blocked_comment_count")
+    op.drop_column("posts", "comment_count")
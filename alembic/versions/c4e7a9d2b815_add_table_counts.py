@@ -0,0 +1,34 @@
+"""Add table counts
+
+Revision ID: c4e7a9d2b815
+Revises: 5a0f3e8c1d27
+Create Date: 2026-10-19 14:21:40.118362
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c4e7a9d2b815"
+down_revision: Union[str, None] = "5a0f3e8c1d27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Rows are seeded with an exact count on first read (totals.table_total),
+    # which also covers sharded setups where no single file has every row
+    op.create_table(
+        "table_counts",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("table_counts")
@@ -0,0 +1,35 @@
+"""Comments autoincrement
+
+Revision ID: d81f5c2e6a43
+Revises: c4e7a9d2b815
+Create Date: 2026-10-19 16:05:12.480371
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d81f5c2e6a43"
+down_revision: Union[str, None] = "c4e7a9d2b815"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Without AUTOINCREMENT SQLite reuses max(id) + 1 once the newest comment is
+    # deleted or archived, and new ids collide with archived ones. SQLite can
+    # only add it by rebuilding the table; the copy seeds sqlite_sequence.
+    with op.batch_alter_table(
+        "comments", recreate="always", table_kwargs={"sqlite_autoincrement": True}
+    ):
+        pass
+
+
+def downgrade() -> None:
+    with op.batch_alter_table(
+        "comments", recreate="always", table_kwargs={"sqlite_autoincrement": False}
+    ):
+        pass
@@ -0,0 +1,183 @@
+import logging
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger("alembic.backfill")
+
+CHUNK_SIZE = 1000
+THROTTLE_SECONDS = 0.05
+
+checkpoints = Table(
+    "backfill_checkpoints",
+    MetaData(),
+    Column("name", String, primary_key=True),
+    Column("last_id", Integer, nullable=False),
+    Column("rows", Integer, nullable=False),
+    Column("completed_at", DateTime),
+)
+
+
+def _load_checkpoint(connection: Connection, name: str) -> Optional[dict]:
+    row = connection.execute(
+        select(checkpoints).where(checkpoints.c.name == name)
+    ).first()
+    return row._asdict() if row else None
+
+
+def _save_checkpoint(connection, name, last_id, rows, completed=False):
+    connection.exec_driver_sql(
+        "INSERT INTO backfill_checkpoints (name, last_id, rows, completed_at) "
+        "VALUES (?, ?, ?, CASE WHEN ? THEN CURRENT_TIMESTAMP END) "
+        "ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id, "
+        "rows = excluded.rows, completed_at = excluded.completed_at",
+        (name, last_id, rows, completed),
+    )
+
+
+def run_backfill(
+    connection: Connection,
+    name: str,
+    table,
+    values: Optional[dict] = None,
+    transform: Optional[Callable[[List], List[dict]]] = None,
+    columns=(),
+    where=None,
+    key: str = "id",
+    chunk_size: int = CHUNK_SIZE,
+    throttle: float = THROTTLE_SECONDS,
+) -> int:
+    # Walks the table by its integer key in chunks. Each chunk is its own short
+    # write transaction together with the checkpoint row, so an interrupted
+    # backfill resumes after the last committed chunk and the app's writers
+    # get the lock between chunks. `connection` must be in AUTOCOMMIT mode.
+    #
+    # Either `values` (a set-based UPDATE applied to every matching row of the
+    # chunk) or `transform` (called with the selected `columns` of the chunk,
+    # returning {"_key": ..., column: value} dicts) must be given.
+    if (values is None) == (transform is None):
+        raise ValueError("Pass exactly one of values or transform")
+
+    checkpoints.create(connection, checkfirst=True)
+    checkpoint = _load_checkpoint(connection, name)
+    if checkpoint and checkpoint["completed_at"] is not None:
+        logger.info("%s: already completed", name)
+        return checkpoint["rows"]
+
+    key_column = table.c[key]
+    last_id = checkpoint["last_id"] if checkpoint else 0
+    rows = checkpoint["rows"] if checkpoint else 0
+    max_id = connection.execute(select(func.max(key_column))).scalar() or 0
+    started = time.monotonic()
+
+    while last_id < max_id:
+        upper = connection.execute(
+            select(key_column)
+            .where(key_column > last_id)
+            .order_by(key_column)
+            .offset(chunk_size - 1)
+            .limit(1)
+        ).scalar()
+        if upper is None:
+            upper = max_id
+        in_chunk = (key_column > last_id) & (key_column <= upper)
+        if where is not None:
+            in_chunk = in_chunk & where
+
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            if values is not None:
+                changed = connection.execute(
+                    update(table).where(in_chunk).values(**values)
+                ).rowcount
+            else:
+                selected = connection.execute(
+                    select(key_column, *columns).where(in_chunk)
+                ).all()
+                params = transform(selected)
+                if params:
+                    targets = [column for column in params[0] if column != "_key"]
+                    connection.execute(
+                        update(table)
+                        .where(key_column == bindparam("_key"))
+                        .values(
+                            **{column: bindparam(f"_{column}") for column in targets}
+                        ),
+                        [
+                            {
+                                "_key": param["_key"],
+                                **{f"_{column}": param[column] for column in targets},
+                            }
+                            for param in params
+                        ],
+                    )
+                changed = len(params)
+            rows += changed
+            _save_checkpoint(connection, name, upper, rows)
+            connection.exec_driver_sql("COMMIT")
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+
+        last_id = upper
+        logger.info(
+            "%s: %s/%s (%.0f%%), %s rows updated, %.1fs",
+            name,
+            last_id,
+            max_id,
+            100 * last_id / max_id,
+            rows,
+            time.monotonic() - started,
+        )
+        if throttle:
+            time.sleep(throttle)
+
+    _save_checkpoint(connection, name, last_id, rows, completed=True)
+    return rows
+
+
+def backfill(name: str, table, **kwargs) -> int:
+    # Entry point for alembic revisions: commits the revision's DDL so far and
+    # runs the chunks outside the migration transaction. Use with
+    # transaction_per_migration (see alembic/env.py).
+    from alembic import op
+
+    with op.get_context().autocommit_block():
+        return run_backfill(op.get_bind(), name, table, **kwargs)
+
+
+def reset_backfill(name: str):
+    from alembic import op
+
+    connection = op.get_bind()
+    checkpoints.create(connection, checkfirst=True)
+    connection.execute(checkpoints.delete().where(checkpoints.c.name == name))
+
+
+def create_index_online(index_name: str, table_name: str, columns, unique=False):
+    # SQLite cannot build an index concurrently; CREATE INDEX holds the write
+    # lock for the whole build. Running it in its own transaction after the
+    # data backfills keeps that window to the index build alone, and
+    # IF NOT EXISTS makes an interrupted upgrade safe to re-run.
+    from alembic import op
+
+    with op.get_context().autocommit_block():
+        started = time.monotonic()
+        op.get_bind().exec_driver_sql(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} "
+            f"ON {table_name} ({', '.join(columns)})"
+        )
+        logger.info("%s: built in %.1fs", index_name, time.monotonic() - started)
@@ -0,0 +1,81 @@
+import argparse
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from database import Base
+from posts import crud, models
+from users import crud as users_crud
+
+
+def _legacy_calls(db: Session, post_id: int, username: str):
+    # The db.query(...) forms the hot paths used before they were prebuilt
+    return {
+        "get_post_by_id": lambda: db.query(models.Post)
+        .filter(models.Post.id == post_id)
+        .first(),
+        "get_user_by_username": lambda: db.query(models.User)
+        .filter(models.User.username == username)
+        .first(),
+        "get_comments_for_post": lambda: db.query(models.Comment)
+        .filter(models.Comment.post_id == post_id, models.Comment.blocked == False)
+        .order_by(models.Comment.id.desc())
+        .offset(0)
+        .limit(10)
+        .all(),
+    }
+
+
+def _prebuilt_calls(db: Session, post_id: int, username: str):
+    return {
+        "get_post_by_id": lambda: crud.get_post_by_id(db, post_id),
+        "get_user_by_username": lambda: users_crud.get_user_by_username(db, username),
+        "get_comments_for_post": lambda: crud.get_comments_for_post(db, post_id),
+    }
+
+
+def _time(call, iterations: int) -> float:
+    call()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-call overhead of query-built and prebuilt CRUD statements"
+    )
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        user = models.User(username="bench", hashed_password="x")
+        db.add(user)
+        db.flush()
+        post = models.Post(title="Bench", content="Body", user_id=user.id)
+        db.add(post)
+        db.flush()
+        db.add_all(
+            models.Comment(content=f"Comment {i}", post_id=post.id, user_id=user.id)
+            for i in range(50)
+        )
+        db.commit()
+
+        legacy = _legacy_calls(db, post.id, user.username)
+        prebuilt = _prebuilt_calls(db, post.id, user.username)
+        print(f"{'query':<24}{'db.query':>12}{'prebuilt':>12}{'saved':>10}")
+        for name in legacy:
+            before = _time(legacy[name], args.iterations)
+            after = _time(prebuilt[name], args.iterations)
+            print(
+                f"{name:<24}{before:>10.1f}us{after:>10.1f}us"
+                f"{(before - after) / before:>10.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
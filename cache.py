@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", "cache.db")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "100000"))
+# How long a worker may serve an entry from its own memory before it has
+# to notice an invalidation made by another worker
+LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "1.0"))
+# Last-access times are only rewritten when older than this, so reads
+# rarely write to the shared file
+ACCESS_RESOLUTION = 60.0
+EVICT_EVERY = 1000
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Cannot cache {type(value).__name__}")
+
+
+class MemoryCache:
+    # Per-process LRU with a TTL on every entry
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def get(self, namespace: str, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[(namespace, key)]
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end((namespace, key))
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def set(self, namespace: str, key, value, ttl: float):
+        with self.lock:
+            self.entries[(namespace, key)] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end((namespace, key))
+            self.counters["sets"] += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def delete(self, namespace: str, key):
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+
+    def clear(self, namespace: str = None):
+        with self.lock:
+            if namespace is None:
+                self.entries.clear()
+                return
+            for entry_key in [k for k in self.entries if k[0] == namespace]:
+                del self.entries[entry_key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"backend": "memory", "entries": len(self.entries), **self.counters}
+
+
+class SQLiteCache:
+    # One WAL-mode file shared by every worker on the host. Values are stored
+    # as JSON, so datetimes come back as ISO strings. Each worker keeps the
+    # entries it read in a short-lived local LRU and drops them when another
+    # worker logs an invalidation for them.
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        local_ttl: float = LOCAL_TTL,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.local = MemoryCache(max_entries)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.last_invalidation = 0
+        self.polled_at = 0.0
+        self.writes = 0
+        self.counters = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not cross a fork, so each process opens its own
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+        connection = sqlite3.connect(
+            self.path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "namespace TEXT, key TEXT, value TEXT, expires_at REAL, "
+            "accessed_at REAL, PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_cache_entries_accessed_at "
+            "ON cache_entries (accessed_at)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_invalidations ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT, key TEXT, "
+            "created_at REAL)"
+        )
+        self.connection = connection
+        self.pid = os.getpid()
+        self.local.clear()
+        self.last_invalidation = connection.execute(
+            "SELECT coalesce(max(id), 0) FROM cache_invalidations"
+        ).fetchone()[0]
+        return connection
+
+    def _poll_invalidations(self, connection):
+        now = time.monotonic()
+        if now - self.polled_at < self.local_ttl:
+            return
+        self.polled_at = now
+        rows = connection.execute(
+            "SELECT id, namespace, key FROM cache_invalidations WHERE id > ?",
+            (self.last_invalidation,),
+        ).fetchall()
+        for invalidation_id, namespace, key in rows:
+            if key is None:
+                self.local.clear(namespace)
+            else:
+                self.local.delete(namespace, key)
+            self.last_invalidation = invalidation_id
+
+    def get(self, namespace: str, key):
+        key = str(key)
+        with self.lock:
+            connection = self._connect()
+            self._poll_invalidations(connection)
+            value = self.local.get(namespace, key)
+            if value is not None:
+                self.counters["hits"] += 1
+                return value
+
+            now = time.time()
+            row = connection.execute(
+                "SELECT value, expires_at, accessed_at FROM cache_entries "
+                "WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+            if row is None or row[1] <= now:
+                self.counters["misses"] += 1
+                return None
+            if now - row[2] > ACCESS_RESOLUTION:
+                connection.execute(
+                    "UPDATE cache_entries SET accessed_at = ? "
+                    "WHERE namespace = ? AND key = ?",
+                    (now, namespace, key),
+                )
+            value = json.loads(row[0])
+            self.local.set(namespace, key, value, min(self.local_ttl, row[1] - now))
+            self.counters["hits"] += 1
+            return value
+
+    def set(self, namespace: str, key, value, ttl: float):
+        key = str(key)
+        encoded = json.dumps(value, default=_json_default)
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, encoded, now + ttl, now),
+            )
+            self.local.set(
+                namespace, key, json.loads(encoded), min(self.local_ttl, ttl)
+            )
+            self.counters["sets"] += 1
+            self.writes += 1
+            if self.writes % EVICT_EVERY == 0:
+                self._evict(connection, now)
+
+    def _evict(self, connection, now: float):
+        evicted = connection.execute(
+            "DELETE FROM cache_entries WHERE expires_at <= ?", (now,)
+        ).rowcount
+        excess = (
+            connection.execute("SELECT count(*) FROM cache_entries").fetchone()[0]
+            - self.max_entries
+        )
+        if excess > 0:
+            # Least recently used first, to within ACCESS_RESOLUTION
+            evicted += connection.execute(
+                "DELETE FROM cache_entries WHERE (namespace, key) IN (SELECT "
+                "namespace, key FROM cache_entries ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            ).rowcount
+        connection.execute(
+            "DELETE FROM cache_invalidations WHERE created_at <= ?",
+            (now - 3600,),
+        )
+        self.counters["evictions"] += evicted
+
+    def _invalidate(self, namespace: str, key):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            if key is None:
+                connection.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ?", (namespace,)
+                )
+            else:
+                connection.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (namespace, key),
+                )
+            connection.execute(
+                "INSERT INTO cache_invalidations (namespace, key, created_at) "
+                "VALUES (?, ?, ?)",
+                (namespace, key, time.time()),
+            )
+            connection.execute("COMMIT")
+            if key is None:
+                self.local.clear(namespace)
+            else:
+                self.local.delete(namespace, key)
+
+    def delete(self, namespace: str, key):
+        self._invalidate(namespace, str(key))
+
+    def clear(self, namespace: str = None):
+        if namespace is None:
+            with self.lock:
+                connection = self._connect()
+                namespaces = [
+                    row[0]
+                    for row in connection.execute(
+                        "SELECT DISTINCT namespace FROM cache_entries"
+                    )
+                ]
+            for name in namespaces:
+                self._invalidate(name, None)
+            return
+        self._invalidate(namespace, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = (
+                self._connect()
+                .execute("SELECT count(*) FROM cache_entries")
+                .fetchone()[0]
+            )
+            return {"backend": "sqlite", "entries": entries, **self.counters}
+
+
+def create_cache(backend: str = CACHE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteCache()
+    return MemoryCache()
+
+
+cache = create_cache()
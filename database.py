@@ -1,11 +1,110 @@
-from sqlalchemy import create_engine
+import os
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS, CACHING_DISABLED
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from sharding import (
+    GLOBAL_SHARD,
+    SHARD_COUNT,
+    RoutedSession,
+    ShardRouter,
+    create_shard_engines,
+)
+
 SQLALCHEMY_DATABASE_URL = "sqlite:///./content.db"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# Number of compiled statements SQLAlchemy keeps per engine
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "500"))
+# Attach content_archive.db (content_shard_<n>_archive.db when sharded)
+ARCHIVE_COMMENTS = os.getenv("ARCHIVE_COMMENTS", "false").lower() == "true"
+ARCHIVE_SCHEMA = (
+    "PRAGMA archive.auto_vacuum = INCREMENTAL",
+    "CREATE TABLE IF NOT EXISTS archive.archived_comments ("
+    "id INTEGER PRIMARY KEY, content BLOB, post_id INTEGER, user_id INTEGER, "
+    "created_at DATETIME, archived_at DATETIME)",
+    "CREATE INDEX IF NOT EXISTS archive.ix_archived_comments_post_id_id "
+    "ON archived_comments (post_id, id)",
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+if SHARD_COUNT:
+    # content.db keeps users; posts and comments go to content_shard_<n>.db
+    engines = create_shard_engines(query_cache_size=QUERY_CACHE_SIZE)
+    engine = engines[GLOBAL_SHARD]
+    SessionLocal = sessionmaker(
+        class_=RoutedSession,
+        router=ShardRouter(engines),
+        autocommit=False,
+        autoflush=False,
+    )
+else:
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        query_cache_size=QUERY_CACHE_SIZE,
+    )
+    engines = {GLOBAL_SHARD: engine}
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Engines whose files hold the posts and comments tables
+post_engines = [
+    shard_engine
+    for shard_id, shard_engine in engines.items()
+    if shard_id != GLOBAL_SHARD
+] or [engine]
 
 Base = declarative_base()
+# Tables in the attached archive file; kept out of Base so migrations skip them
+ArchiveBase = declarative_base()
+
+
+def archive_path(database_path: str) -> str:
+    root, extension = os.path.splitext(database_path)
+    return f"{root}_archive{extension}"
+
+
+def attach_archive(target):
+    # Archived comments sit in a sibling file attached as `archive`, so reads
+    # and counter reconciliation reach them from the same statement
+    path = archive_path(target.url.database)
+
+    @event.listens_for(target, "connect")
+    def attach(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS archive", (path,))
+        for statement in ARCHIVE_SCHEMA:
+            dbapi_connection.execute(statement)
+
+
+if ARCHIVE_COMMENTS:
+    for post_engine in post_engines:
+        attach_archive(post_engine)
+
+_cache_outcomes = {
+    CACHE_HIT: "hits",
+    CACHE_MISS: "misses",
+    CACHING_DISABLED: "disabled",
+}
+_cache_stats = {"hits": 0, "misses": 0, "disabled": 0, "uncached": 0}
+_cache_stats_lock = threading.Lock()
+
+
+def track_statement_cache(target):
+    @event.listens_for(target, "after_cursor_execute")
+    def count_cache_outcome(conn, cursor, statement, parameters, context, executemany):
+        outcome = _cache_outcomes.get(context.cache_hit, "uncached")
+        with _cache_stats_lock:
+            _cache_stats[outcome] += 1
+
+
+def statement_cache_stats() -> dict:
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    compiled = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / compiled, 4) if compiled else None
+    stats["size"] = QUERY_CACHE_SIZE
+    return stats
+
+
+for shard_engine in engines.values():
+    track_statement_cache(shard_engine)
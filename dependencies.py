@@ -1,3 +1,4 @@
+from fastapi import Response
 from sqlalchemy.orm import Session
 
 from database import SessionLocal
@@ -10,3 +11,21 @@ def get_db() -> Session:
         yield db
     finally:
         db.close()
+
+
+def get_analytics_db(response: Response) -> Session:
+    # Analytics read from the replica snapshot when one is configured, so
+    # long scans do not hold locks on the file that takes writes
+    from replica import analytics_replica
+
+    if analytics_replica is None:
+        yield from get_db()
+        return
+    analytics_replica.ensure_fresh()
+    analytics_replica.set_freshness(response)
+    db = analytics_replica.SessionLocal()
+
+    try:
+        yield db
+    finally:
+        db.close()
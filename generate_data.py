@@ -0,0 +1,290 @@
+import argparse
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from database import Base, SessionLocal, engine, engines, post_engines
+from sharding import SHARD_COUNT, IdAllocator, create_all
+from totals import reconcile_table_counts
+from users.crud import get_password_hash
+
+BATCH_SIZE = 50_000
+WORDS = (
+    "the quick brown fox jumps over lazy dog content post comment great idea "
+    "thanks agree disagree really interesting article share more about this "
+    "today week year people think good bad best worst new old update review"
+).split()
+
+
+def _timestamps(rng, count: int, start: datetime, days: int) -> np.ndarray:
+    # Bursty arrivals: most rows land in short bursts around random centres,
+    # the rest are spread uniformly over the period.
+    seconds = days * 24 * 3600
+    bursts = rng.uniform(0, seconds, max(1, count // 500))
+    in_burst = rng.random(count) < 0.7
+    offsets = np.where(
+        in_burst,
+        rng.choice(bursts, count) + rng.exponential(600, count),
+        rng.uniform(0, seconds, count),
+    )
+    offsets = np.clip(offsets, 0, seconds - 1).astype(np.int64)
+    return np.datetime64(start, "s") + np.sort(offsets).astype("timedelta64[s]")
+
+
+def _texts(rng, count: int, mean_words: int):
+    lengths = rng.poisson(mean_words, count) + 1
+    words = rng.integers(0, len(WORDS), int(lengths.sum()))
+    position = 0
+    for length in lengths:
+        yield " ".join(WORDS[i] for i in words[position : position + length])
+        position += length
+
+
+def _zipf_counts(rng, total: int, buckets: int, exponent: float) -> np.ndarray:
+    weights = 1.0 / np.arange(1, buckets + 1) ** exponent
+    rng.shuffle(weights)
+    return rng.multinomial(total, weights / weights.sum())
+
+
+def _format(timestamp: np.datetime64):
+    # Same text layout SQLAlchemy uses for DateTime columns on SQLite
+    if np.isnat(timestamp):
+        return None
+    return str(timestamp).replace("T", " ") + ".000000"
+
+
+def _next_id(connections, table: str) -> int:
+    return 1 + max(
+        connection.exec_driver_sql(f"SELECT coalesce(max(id), 0) FROM {table}").scalar()
+        for connection in connections
+    )
+
+
+def _taken_usernames(connection, first_user: int, users: int) -> list:
+    # Generated names are user<id>; a registered user may already hold one
+    return [
+        username
+        for (username,) in connection.exec_driver_sql(
+            "SELECT username FROM users WHERE username GLOB 'user[0-9]*'"
+        )
+        if username[4:].isdigit()
+        and first_user <= int(username[4:]) < first_user + users
+    ]
+
+
+def _insert(connections, sql: str, rows, shard=lambda row: 0):
+    # Rows are buffered per target connection; `shard` picks the target
+    batches = [[] for _ in connections]
+    for row in rows:
+        index = shard(row)
+        batches[index].append(row)
+        if len(batches[index]) >= BATCH_SIZE:
+            connections[index].exec_driver_sql(sql, batches[index])
+            batches[index] = []
+    for connection, batch in zip(connections, batches):
+        if batch:
+            connection.exec_driver_sql(sql, batch)
+
+
+def generate(
+    users: int,
+    posts: int,
+    comments: int,
+    blocked_ratio: float = 0.05,
+    days: int = 365,
+    zipf_exponent: float = 1.1,
+    seed: int = 0,
+    wal: bool = False,
+):
+    rng = np.random.default_rng(seed)
+    start = datetime.utcnow() - timedelta(days=days)
+    # Hashing is the slow part of registration, so every user shares one hash
+    password_hash = get_password_hash("password")
+
+    if SHARD_COUNT:
+        create_all(Base.metadata, engines)
+    else:
+        Base.metadata.create_all(bind=engine)
+
+    with ExitStack() as stack:
+        connection = stack.enter_context(engine.connect())
+        # Posts and comments go to the shard of their post id
+        shards = [
+            (
+                connection
+                if shard_engine is engine
+                else stack.enter_context(shard_engine.connect())
+            )
+            for shard_engine in post_engines
+        ]
+        targets = [connection] + [shard for shard in shards if shard is not connection]
+        for target in targets:
+            # Bulk-load pragmas; durability is irrelevant for a throwaway dataset.
+            # Unlike the others, journal_mode is stored in the file and stays.
+            if wal:
+                target.exec_driver_sql("PRAGMA journal_mode=WAL")
+            target.exec_driver_sql("PRAGMA synchronous=OFF")
+            target.exec_driver_sql("PRAGMA cache_size=-262144")
+            target.exec_driver_sql("PRAGMA temp_store=MEMORY")
+
+        first_user = _next_id([connection], "users")
+        first_post = _next_id(shards, "posts")
+        first_comment = _next_id(shards, "comments")
+        taken = _taken_usernames(connection, first_user, users)
+        if taken:
+            raise ValueError(
+                f"{len(taken)} generated usernames are already registered, "
+                f"e.g. {taken[0]}"
+            )
+
+        _insert(
+            [connection],
+            "INSERT INTO users (id, username, hashed_password) VALUES (?, ?, ?)",
+            (
+                (user_id, f"user{user_id}", password_hash)
+                for user_id in range(first_user, first_user + users)
+            ),
+        )
+
+        post_authors = np.repeat(
+            np.arange(first_user, first_user + users),
+            _zipf_counts(rng, posts, users, zipf_exponent),
+        )
+        rng.shuffle(post_authors)
+        post_blocked = rng.random(posts) < blocked_ratio
+        post_created_at = _timestamps(rng, posts, start, days)
+
+        comment_posts = np.repeat(
+            np.arange(first_post, first_post + posts),
+            _zipf_counts(rng, comments, posts, zipf_exponent),
+        )
+        comment_authors = np.repeat(
+            np.arange(first_user, first_user + users),
+            _zipf_counts(rng, comments, users, zipf_exponent),
+        )
+        rng.shuffle(comment_posts)
+        rng.shuffle(comment_authors)
+        comment_blocked = rng.random(comments) < blocked_ratio
+        created_at = _timestamps(rng, comments, start, days)
+
+        # Post counters are derived here instead of reconciled after the load
+        post_index = comment_posts - first_post
+        visible = ~comment_blocked
+        comment_count = np.bincount(post_index[visible], minlength=posts)
+        blocked_count = np.bincount(post_index[comment_blocked], minlength=posts)
+        # NaT is the minimum int64, so untouched posts come out as NaT
+        last_comment_at = np.full(posts, np.iinfo(np.int64).min)
+        np.maximum.at(
+            last_comment_at, post_index[visible], created_at[visible].astype(np.int64)
+        )
+        last_comment_at = last_comment_at.astype("datetime64[s]")
+
+        _insert(
+            shards,
+            "INSERT INTO posts (id, title, content, user_id, blocked, created_at, "
+            "comment_count, blocked_comment_count, last_comment_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    first_post + i,
+                    title,
+                    content,
+                    int(author),
+                    bool(blocked),
+                    _format(post_created_at[i]),
+                    int(comment_count[i]),
+                    int(blocked_count[i]),
+                    _format(last_comment_at[i]),
+                )
+                for i, (title, content, author, blocked) in enumerate(
+                    zip(
+                        _texts(rng, posts, 5),
+                        _texts(rng, posts, 120),
+                        post_authors,
+                        post_blocked,
+                    )
+                )
+            ),
+            shard=lambda row: row[0] % len(shards),
+        )
+
+        _insert(
+            shards,
+            "INSERT INTO comments (id, content, post_id, user_id, created_at, blocked) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    first_comment + i,
+                    content,
+                    int(post_id),
+                    int(author),
+                    _format(created),
+                    bool(blocked),
+                )
+                for i, (content, post_id, author, created, blocked) in enumerate(
+                    zip(
+                        _texts(rng, comments, 20),
+                        comment_posts,
+                        comment_authors,
+                        created_at,
+                        comment_blocked,
+                    )
+                )
+            ),
+            shard=lambda row: row[2] % len(shards),
+        )
+        for target in targets:
+            target.commit()
+
+    if SHARD_COUNT:
+        # Ids were written directly, so move the global sequences past them
+        allocator = IdAllocator(engines)
+        allocator.advance("posts", first_post + posts)
+        allocator.advance("comments", first_comment + comments)
+
+    # The raw inserts bypass the flush hook that keeps table_counts current
+    with SessionLocal() as db:
+        reconcile_table_counts(db)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk-generate a synthetic dataset into the configured database"
+    )
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--posts", type=int, default=100_000)
+    parser.add_argument("--comments", type=int, default=1_000_000)
+    parser.add_argument("--blocked-ratio", type=float, default=0.05)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--zipf-exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--wal",
+        action="store_true",
+        help="switch the database files to WAL mode (persists after the load)",
+    )
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    try:
+        generate(
+            users=args.users,
+            posts=args.posts,
+            comments=args.comments,
+            blocked_ratio=args.blocked_ratio,
+            days=args.days,
+            zipf_exponent=args.zipf_exponent,
+            seed=args.seed,
+            wal=args.wal,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - started
+    rows = args.users + args.posts + args.comments
+    print(f"Inserted {rows} rows in {elapsed:.1f}s ({rows / elapsed * 60:,.0f}/min)")
+
+
+if __name__ == "__main__":
+    main()
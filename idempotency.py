@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import anyio
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 60 * 60)))
+IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB")
+MAX_ENTRIES = 100_000
+MAX_KEY_LENGTH = 255
+WAIT_TIMEOUT = 30.0
+IDEMPOTENT_PATHS = re.compile(r"^/posts/(\d+/comments/)?$")
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status", "headers", "body", "expires_at")
+
+    def __init__(self, fingerprint, status, headers, body, expires_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+
+class IdempotencyStore:
+    # Recent responses in an LRU dict; with a path, also persisted to a small
+    # SQLite file so replays survive restarts and are shared by workers.
+    def __init__(
+        self,
+        path: Optional[str] = IDEMPOTENCY_DB,
+        ttl: int = IDEMPOTENCY_TTL,
+        max_entries: int = MAX_ENTRIES,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT, status INTEGER, "
+                "headers TEXT, body BLOB, expires_at REAL)"
+            )
+            self.connection.commit()
+
+    def get(self, key: str) -> Optional[StoredResponse]:
+        now = time.time()
+        with self.lock:
+            stored = self.entries.get(key)
+            if stored is not None:
+                if stored.expires_at > now:
+                    self.entries.move_to_end(key)
+                    return stored
+                del self.entries[key]
+
+            if self.connection is None:
+                return None
+            row = self.connection.execute(
+                "SELECT fingerprint, status, headers, body, expires_at "
+                "FROM idempotency_keys WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+        if row is None:
+            return None
+        fingerprint, status, headers, body, expires_at = row
+        return StoredResponse(
+            fingerprint,
+            status,
+            [(name.encode(), value.encode()) for name, value in json.loads(headers)],
+            body,
+            expires_at,
+        )
+
+    def put(self, key: str, fingerprint: str, status: int, headers, body: bytes):
+        stored = StoredResponse(
+            fingerprint, status, headers, body, time.time() + self.ttl
+        )
+        with self.lock:
+            self.entries[key] = stored
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        fingerprint,
+                        status,
+                        json.dumps(
+                            [(name.decode(), value.decode()) for name, value in headers]
+                        ),
+                        body,
+                        stored.expires_at,
+                    ),
+                )
+                self.connection.execute(
+                    "DELETE FROM idempotency_keys WHERE expires_at <= ?",
+                    (time.time(),),
+                )
+                self.connection.commit()
+
+
+def _plain_response(status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    return status, headers, body
+
+
+async def _send_response(send, status: int, headers, body: bytes):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    # Handles the Idempotency-Key header on the create endpoints: completed
+    # responses are replayed for the same key and body, and a retry that
+    # arrives while the original is still running waits for its result.
+    def __init__(self, app, store: IdempotencyStore = None):
+        self.app = app
+        self.store = store or IdempotencyStore()
+        self.in_flight = {}
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not IDEMPOTENT_PATHS.match(scope["path"])
+        ):
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key is None:
+            return await self.app(scope, receive, send)
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return await _send_response(
+                send, *_plain_response(400, "Idempotency-Key is too long")
+            )
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        key = hashlib.sha256(
+            b"\0".join(
+                [
+                    headers.get(b"authorization", b""),
+                    scope["path"].encode(),
+                    idempotency_key,
+                ]
+            )
+        ).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        while True:
+            stored = await anyio.to_thread.run_sync(self.store.get, key)
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    return await _send_response(
+                        send,
+                        *_plain_response(
+                            422, "Idempotency-Key was reused with a different body"
+                        ),
+                    )
+                return await _send_response(
+                    send,
+                    stored.status,
+                    stored.headers + [(b"idempotent-replayed", b"true")],
+                    stored.body,
+                )
+
+            pending = self.in_flight.get(key)
+            if pending is None:
+                break
+            try:
+                await asyncio.wait_for(asyncio.shield(pending.wait()), WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                return await _send_response(
+                    send,
+                    *_plain_response(409, "A request with this key is in progress"),
+                )
+
+        done = asyncio.Event()
+        self.in_flight[key] = done
+        response = {"status": 500, "headers": [], "body": b""}
+
+        async def replay_receive():
+            nonlocal body
+            chunk, body = body, b""
+            return {"type": "http.request", "body": chunk, "more_body": False}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+            # Server errors and rate limits are worth retrying, so they are not kept
+            if response["status"] < 500 and response["status"] != 429:
+                await anyio.to_thread.run_sync(
+                    self.store.put,
+                    key,
+                    fingerprint,
+                    response["status"],
+                    response["headers"],
+                    response["body"],
+                )
+        finally:
+            del self.in_flight[key]
+            done.set()
@@ -0,0 +1,159 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Optional
+
+import uvicorn
+
+from monitoring import startup_timer
+
+logger = logging.getLogger("launcher")
+
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", "8000"))
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+# A worker that dies sooner than this after its start failed to start
+FAST_FAILURE = 10.0
+MAX_FAST_FAILURES = 5
+
+
+class RestartBackoff:
+    # Workers that die right after starting (bad database path, port in use)
+    # would otherwise be forked in a tight loop: each fast failure in a row
+    # doubles the wait before the next restart, and after `max_failures`
+    # the launcher gives up. A worker that ran for a while resets the count.
+    def __init__(
+        self,
+        delay: float = RESTART_DELAY,
+        max_delay: float = MAX_RESTART_DELAY,
+        fast: float = FAST_FAILURE,
+        max_failures: int = MAX_FAST_FAILURES,
+        clock=None,
+    ):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.fast = fast
+        self.max_failures = max_failures
+        self.clock = clock or time.monotonic
+        self.failures = 0
+
+    def next_delay(self, started_at: float) -> Optional[float]:
+        # Seconds to wait before restarting, or None to give up
+        if self.clock() - started_at >= self.fast:
+            self.failures = 0
+            return 0.0
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            return None
+        return min(self.max_delay, self.delay * 2 ** (self.failures - 1))
+
+
+def _serve(app, sock: socket.socket):
+    # Forked child: the event loop, threads and database connections are all
+    # created here, after the fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server = uvicorn.Server(uvicorn.Config(app, lifespan="on", log_config=None))
+    server.run(sockets=[sock])
+
+
+def _spawn(app, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _serve(app, sock)
+        except BaseException:
+            logger.exception("Worker %s crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def run(workers: int = WORKERS, host: str = HOST, port: int = PORT) -> int:
+    # Imports the app and its fork-safe state once in the parent so the
+    # workers start warm and share those pages copy-on-write
+    from main import create_app
+
+    app = create_app()
+    logger.info("Preloaded app in %s", startup_timer.phases)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # pid -> start time, for telling failed starts from later crashes
+    children = {_spawn(app, sock): time.monotonic() for _ in range(workers)}
+    logger.info("Listening on %s:%s with %s workers", host, port, len(children))
+
+    backoff = RestartBackoff()
+    stopping = False
+    code = 0
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started_at = children.pop(pid, None)
+        if stopping or started_at is None:
+            continue
+        delay = backoff.next_delay(started_at)
+        if delay is None:
+            logger.error(
+                "Worker %s exited with %s; %s workers failed right after starting,"
+                " giving up",
+                pid,
+                status,
+                backoff.failures,
+            )
+            code = 1
+            stop()
+            continue
+        logger.warning(
+            "Worker %s exited with %s, restarting in %.1fs", pid, status, delay
+        )
+        time.sleep(delay)
+        if not stopping:
+            children[_spawn(app, sock)] = time.monotonic()
+    sock.close()
+    return code
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the app from N forked workers sharing one socket"
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(run(args.workers, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,132 @@
-from fastapi import FastAPI
-from users import routers as users_routers
-from posts import routers as posts_routers
+import logging
+from contextlib import asynccontextmanager
 
-app = FastAPI()
+import anyio.to_thread
+from fastapi import Depends, FastAPI
 
-app.include_router(users_routers.router)
-app.include_router(posts_routers.router)
+from memory_profiling import memory_profiler
+from monitoring import FirstRequestMiddleware, runtime_monitor, startup_timer
 
+logger = logging.getLogger("startup")
 
-@app.get("/")
-async def root():
-    return {"message": "Hello World"}
 
+def preload():
+    # Process-wide state that is safe to share with forked workers: no
+    # sockets, threads or database connections are opened here
+    from posts.text_moderation import moderation_client
+    from users.crud import pwd_context
 
-@app.get("/hello/{name}")
-async def say_hello(name: str):
-    return {"message": f"Hello {name}"}
+    moderation_client.local.words
+    pwd_context.handler().get_backend()
+
+
+def warm_up():
+    # Per worker: fills the connection pools and compiles the hot statements
+    from database import SessionLocal, engines
+    from posts import crud as posts_crud
+    from sharding import on_shard, post_shards
+    from totals import seed_table_counts
+    from users import crud as users_crud
+
+    for engine in engines.values():
+        with engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+
+    with SessionLocal() as db:
+        for shard_id in post_shards(db):
+            for statement, params in posts_crud.HOT_STATEMENTS:
+                db.execute(on_shard(statement, shard_id), params).all()
+        for statement, params in users_crud.HOT_STATEMENTS:
+            db.execute(statement, params).all()
+        # Listing reads only look table_counts up, they never seed it
+        seed_table_counts(db)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with startup_timer.phase("warm_up"):
+        try:
+            await anyio.to_thread.run_sync(warm_up)
+        except Exception:
+            # An unmigrated database should not keep the server from starting
+            logger.warning("Warm-up failed", exc_info=True)
+    await runtime_monitor.start()
+    await memory_profiler.start()
+    yield
+    await memory_profiler.stop()
+    await runtime_monitor.stop()
+
+
+def create_app() -> FastAPI:
+    with startup_timer.phase("create_app"):
+        from admission import AdmissionMiddleware, admission_pools
+        from cache import cache
+        from database import statement_cache_stats
+        from idempotency import IdempotencyMiddleware
+        from memory_profiling import TOP_SITES, MemoryProfilingMiddleware
+        from posts import models
+        from posts.hot_comments import hot_comments
+        from posts import routers as posts_routers
+        from replica import analytics_replica
+        from users import routers as users_routers
+        from users.crud import get_current_admin
+
+        app = FastAPI(lifespan=lifespan)
+        # The last middleware added runs first. Idempotency wraps admission so
+        # retries waiting on an in-flight key hold no slot
+        if memory_profiler.enabled:
+            # Inside admission, so time spent queued is not measured
+            app.add_middleware(MemoryProfilingMiddleware)
+        app.add_middleware(AdmissionMiddleware)
+        app.add_middleware(IdempotencyMiddleware)
+        app.add_middleware(FirstRequestMiddleware)
+
+        app.include_router(users_routers.router)
+        app.include_router(posts_routers.router)
+
+        @app.get("/")
+        async def root():
+            return {"message": "Hello World"}
+
+        @app.get("/hello/{name}")
+        async def say_hello(name: str):
+            return {"message": f"Hello {name}"}
+
+        @app.get("/admin/metrics/runtime")
+        async def runtime_metrics(
+            current_user: models.User = Depends(get_current_admin),
+        ):
+            return {
+                **runtime_monitor.snapshot(),
+                "admission": {
+                    name: pool.state() for name, pool in admission_pools.items()
+                },
+                "statement_cache": statement_cache_stats(),
+                "cache": cache.stats(),
+                "hot_comments": hot_comments.stats(),
+                "analytics_replica": (
+                    analytics_replica.stats() if analytics_replica else None
+                ),
+                "startup": startup_timer.snapshot(),
+            }
+
+        @app.get("/admin/memory")
+        def memory_report(
+            limit: int = TOP_SITES,
+            current_user: models.User = Depends(get_current_admin),
+        ):
+            # Sync, so the snapshot runs on a worker thread
+            return memory_profiler.report(limit)
+
+    with startup_timer.phase("preload"):
+        preload()
+    return app
+
+
+def __getattr__(name):
+    # `uvicorn main:app` builds the app on first access; importing main alone
+    # stays cheap
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
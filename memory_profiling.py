@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import tracemalloc
+from typing import Optional
+
+import anyio.to_thread
+
+logger = logging.getLogger("memory")
+
+# Tracing slows every allocation down, so it only runs when asked for
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "false").lower() == "true"
+# Share of requests whose peak allocation is measured
+MEMORY_SAMPLE_RATE = float(os.getenv("MEMORY_SAMPLE_RATE", "0.05"))
+# Seconds between snapshot diffs; 0 turns them off
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", "600"))
+MEMORY_SNAPSHOT_DIR = os.getenv("MEMORY_SNAPSHOT_DIR", "memory_snapshots")
+TRACE_FRAMES = 10
+TOP_SITES = 20
+
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _kib(size: int) -> float:
+    return round(size / 1024, 1)
+
+
+def _site(statistic) -> dict:
+    frame = statistic.traceback[0]
+    return {
+        "site": f"{frame.filename}:{frame.lineno}",
+        "size_kib": _kib(statistic.size),
+        "count": statistic.count,
+    }
+
+
+def _difference(statistic) -> dict:
+    return {
+        **_site(statistic),
+        "size_diff_kib": _kib(statistic.size_diff),
+        "count_diff": statistic.count_diff,
+    }
+
+
+class RouteMemory:
+    __slots__ = ("samples", "total_peak", "max_peak")
+
+    def __init__(self):
+        self.samples = 0
+        self.total_peak = 0
+        self.max_peak = 0
+
+    def record(self, peak: int):
+        self.samples += 1
+        self.total_peak += peak
+        self.max_peak = max(self.max_peak, peak)
+
+    def state(self) -> dict:
+        return {
+            "samples": self.samples,
+            "mean_peak_kib": _kib(self.total_peak // self.samples),
+            "max_peak_kib": _kib(self.max_peak),
+        }
+
+
+class MemoryProfiler:
+    # tracemalloc keeps one process-wide peak, so a sampled request resets it
+    # on entry and reads it on exit, and only one request is measured at a
+    # time. Allocations by requests running alongside it still land in its
+    # peak; the per-route figures are upper bounds that settle as samples
+    # accumulate.
+    def __init__(
+        self,
+        enabled: bool = MEMORY_PROFILING,
+        sample_rate: float = MEMORY_SAMPLE_RATE,
+        snapshot_interval: float = MEMORY_SNAPSHOT_INTERVAL,
+        snapshot_dir: str = MEMORY_SNAPSHOT_DIR,
+    ):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_dir = snapshot_dir
+        self.routes = {}
+        self.measuring = False
+        self.previous = None
+        self.last_diff = []
+        self.task = None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        if self.snapshot_interval > 0:
+            self.task = asyncio.ensure_future(self._snapshots())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def begin(self) -> Optional[int]:
+        # Returns the traced size at entry, or None when this request is
+        # not measured
+        if (
+            self.measuring
+            or not tracemalloc.is_tracing()
+            or random.random() >= self.sample_rate
+        ):
+            return None
+        self.measuring = True
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(self, route: str, started: int):
+        peak = tracemalloc.get_traced_memory()[1] - started
+        self.measuring = False
+        self.routes.setdefault(route, RouteMemory()).record(peak)
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def top_sites(self, limit: int = TOP_SITES) -> list:
+        if not tracemalloc.is_tracing():
+            return []
+        return [
+            _site(statistic)
+            for statistic in self.take_snapshot().statistics("lineno")[:limit]
+        ]
+
+    def diff_snapshot(self, limit: int = TOP_SITES) -> list:
+        # Growth by allocation site since the previous call. Sites that keep
+        # growing from one diff to the next are the leak candidates.
+        current = self.take_snapshot()
+        previous, self.previous = self.previous, current
+        if previous is None:
+            return []
+        self.last_diff = [
+            _difference(statistic)
+            for statistic in current.compare_to(previous, "lineno")[:limit]
+        ]
+        return self.last_diff
+
+    def _write_diff(self, diff: list):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(
+            self.snapshot_dir,
+            f"memory-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt",
+        )
+        with open(path, "w") as diff_file:
+            for entry in diff:
+                diff_file.write(
+                    f"{entry['site']} size={entry['size_kib']} KiB "
+                    f"({entry['size_diff_kib']:+} KiB) count={entry['count']} "
+                    f"({entry['count_diff']:+})\n"
+                )
+        return path
+
+    async def _snapshots(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                # Snapshots walk every traced block; keep them off the loop
+                diff = await anyio.to_thread.run_sync(self.diff_snapshot)
+                if diff:
+                    path = await anyio.to_thread.run_sync(self._write_diff, diff)
+                    logger.info("Memory snapshot diff written to %s", path)
+            except Exception:
+                logger.warning("Memory snapshot failed", exc_info=True)
+
+    def report(self, limit: int = TOP_SITES) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        current = tracemalloc.get_traced_memory()[0]
+        return {
+            "enabled": True,
+            "sample_rate": self.sample_rate,
+            "traced_kib": _kib(current),
+            "tracemalloc_overhead_kib": _kib(tracemalloc.get_tracemalloc_memory()),
+            "routes": {
+                route: memory.state()
+                for route, memory in sorted(
+                    self.routes.items(), key=lambda item: -item[1].max_peak
+                )
+            },
+            "top_sites": self.top_sites(limit),
+            "last_diff": self.last_diff[:limit],
+        }
+
+
+memory_profiler = MemoryProfiler()
+
+
+class MemoryProfilingMiddleware:
+    def __init__(self, app, profiler: MemoryProfiler = memory_profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = self.profiler.begin()
+        if started is None:
+            return await self.app(scope, receive, send)
+        try:
+            # The body is sent inside this call, so encoding counts as well
+            await self.app(scope, receive, send)
+        finally:
+            # Unmatched paths share one entry so scans cannot grow the table
+            route = scope.get("route")
+            path = route.path if route is not None else "<unmatched>"
+            self.profiler.end(f"{scope['method']} {path}", started)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+import anyio
+import anyio.to_thread
+
+logger = logging.getLogger("monitoring")
+
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+PROBE_INTERVAL = float(os.getenv("THREADPOOL_PROBE_INTERVAL", "1.0"))
+HEARTBEAT_INTERVAL = 0.05
+STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+SAMPLES = 600
+MAX_STALLS = 20
+
+
+def _percentiles(samples) -> dict:
+    if not samples:
+        return {"p50": None, "p95": None, "max": None}
+    ordered = sorted(samples)
+    return {
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+class RuntimeMonitor:
+    # Watches the anyio worker threadpool the sync handlers run in and the
+    # event loop itself. A probe task measures how long a no-op waits for a
+    # worker thread; a heartbeat task ticks every HEARTBEAT_INTERVAL and a
+    # watchdog thread reports a stall (with the loop thread's stack) when the
+    # heartbeat falls behind by more than `stall_threshold`.
+    def __init__(
+        self,
+        threadpool_size: int = THREADPOOL_SIZE,
+        probe_interval: float = PROBE_INTERVAL,
+        stall_threshold: float = STALL_THRESHOLD,
+    ):
+        self.threadpool_size = threadpool_size
+        self.probe_interval = probe_interval
+        self.stall_threshold = stall_threshold
+        self.wait_times = deque(maxlen=SAMPLES)
+        self.loop_lags = deque(maxlen=SAMPLES)
+        self.stalls = deque(maxlen=MAX_STALLS)
+        self.stall_count = 0
+        self.saturated_probes = 0
+        self.limiter = None
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.tasks = []
+        self.watchdog = None
+        self.stopping = threading.Event()
+
+    async def start(self):
+        self.limiter = anyio.to_thread.current_default_thread_limiter()
+        self.limiter.total_tokens = self.threadpool_size
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopping.clear()
+        self.tasks = [
+            asyncio.ensure_future(self._heartbeat()),
+            asyncio.ensure_future(self._probe()),
+        ]
+        self.watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self.watchdog.start()
+
+    async def stop(self):
+        self.stopping.set()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + HEARTBEAT_INTERVAL
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            self.loop_lags.append(max(0.0, now - expected))
+            self.last_beat = now
+
+    async def _probe(self):
+        while True:
+            if self.limiter.borrowed_tokens >= self.limiter.total_tokens:
+                self.saturated_probes += 1
+                logger.warning(
+                    "Threadpool saturated: %s/%s threads busy, %s tasks waiting",
+                    self.limiter.borrowed_tokens,
+                    self.limiter.total_tokens,
+                    self.limiter.statistics().tasks_waiting,
+                )
+            started = time.monotonic()
+            await anyio.to_thread.run_sync(time.monotonic)
+            self.wait_times.append(time.monotonic() - started)
+            await asyncio.sleep(self.probe_interval)
+
+    def _watch(self):
+        stalled_since = None
+        while not self.stopping.wait(HEARTBEAT_INTERVAL):
+            behind = time.monotonic() - self.last_beat - HEARTBEAT_INTERVAL
+            if behind < self.stall_threshold:
+                if stalled_since is not None:
+                    self.stalls[-1]["duration"] = round(
+                        time.monotonic() - stalled_since, 3
+                    )
+                    stalled_since = None
+                continue
+            if stalled_since is not None:
+                continue
+
+            # First check past the threshold: capture what the loop is running
+            stalled_since = self.last_beat + HEARTBEAT_INTERVAL
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.stall_count += 1
+            self.stalls.append(
+                {"at": time.time(), "duration": round(behind, 3), "stack": stack}
+            )
+            logger.warning(
+                "Event loop blocked for %.3fs, stack:\n%s", behind, stack.rstrip()
+            )
+
+    def snapshot(self) -> dict:
+        threadpool = {"size": self.threadpool_size}
+        if self.limiter is not None:
+            threadpool.update(
+                busy=self.limiter.borrowed_tokens,
+                waiting=self.limiter.statistics().tasks_waiting,
+                saturated_probes=self.saturated_probes,
+            )
+        return {
+            "threadpool": {
+                **threadpool,
+                "wait_seconds": _percentiles(self.wait_times),
+            },
+            "event_loop": {
+                "lag_seconds": _percentiles(self.loop_lags),
+                "stall_threshold": self.stall_threshold,
+                "stalls": self.stall_count,
+                "recent_stalls": list(self.stalls),
+            },
+        }
+
+
+runtime_monitor = RuntimeMonitor()
+
+
+class StartupTimer:
+    # Time spent in each startup phase, and the latency of the first request
+    # a worker serves, counted from process start (forked workers inherit the
+    # launcher's start time).
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.first_request = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - started, 4)
+            logger.info("Startup phase %s took %.3fs", name, self.phases[name])
+
+    def record_first_request(self, seconds: float):
+        if self.first_request is not None:
+            return
+        self.first_request = {
+            "latency": round(seconds, 4),
+            "since_start": round(time.perf_counter() - self.started, 4),
+        }
+        logger.info(
+            "First request served in %.3fs, %.3fs after start",
+            seconds,
+            self.first_request["since_start"],
+        )
+
+    def snapshot(self) -> dict:
+        return {"phases": dict(self.phases), "first_request": self.first_request}
+
+
+startup_timer = StartupTimer()
+
+
+class FirstRequestMiddleware:
+    def __init__(self, app, timer: StartupTimer = startup_timer):
+        self.app = app
+        self.timer = timer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.timer.first_request is not None:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.timer.record_first_request(time.perf_counter() - started)
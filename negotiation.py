@@ -0,0 +1,155 @@
+import os
+import zlib
+from datetime import date, datetime
+from itertools import chain, islice
+
+import msgpack
+import orjson
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is offered only where the zstandard package is installed
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MEDIA_TYPES = {JSON: JSON, MSGPACK: MSGPACK, "application/x-msgpack": MSGPACK}
+# Bodies shorter than this go out uncompressed, in one piece
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+CHUNK_ITEMS = 100
+
+
+def _default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        # numpy scalars from the analytics aggregations
+        return value.item()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _preferences(header: str) -> dict:
+    # {"value": q} from an Accept or Accept-Encoding header
+    preferences = {}
+    for part in header.split(","):
+        value, *params = [piece.strip() for piece in part.split(";")]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        preferences[value.lower()] = quality
+    return preferences
+
+
+def choose_media_type(accept: str) -> str:
+    preferences = _preferences(accept or "")
+    # Highest quality wins, ties go to the type listed first
+    ranked = sorted(
+        (-quality, position, media_type)
+        for position, (media_type, quality) in enumerate(preferences.items())
+        if media_type in MEDIA_TYPES and quality > 0
+    )
+    return MEDIA_TYPES[ranked[0][2]] if ranked else JSON
+
+
+def choose_encoding(accept_encoding: str):
+    preferences = _preferences(accept_encoding or "")
+    available = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    ranked = sorted(
+        (
+            (preferences.get(encoding, preferences.get("*", 0)), -rank, encoding)
+            for rank, encoding in enumerate(available)
+        ),
+        reverse=True,
+    )
+    quality, _, encoding = ranked[0]
+    return encoding if quality > 0 else None
+
+
+def _json_chunks(payload):
+    if not isinstance(payload, list):
+        yield orjson.dumps(payload, default=_default)
+        return
+    yield b"["
+    items = iter(payload)
+    separator = b""
+    while True:
+        chunk = list(islice(items, CHUNK_ITEMS))
+        if not chunk:
+            break
+        yield separator + b",".join(
+            orjson.dumps(item, default=_default) for item in chunk
+        )
+        separator = b","
+    yield b"]"
+
+
+def _msgpack_chunks(payload):
+    packer = msgpack.Packer(default=_default)
+    if not isinstance(payload, list):
+        yield packer.pack(payload)
+        return
+    yield packer.pack_array_header(len(payload))
+    for start in range(0, len(payload), CHUNK_ITEMS):
+        yield b"".join(
+            packer.pack(item) for item in payload[start : start + CHUNK_ITEMS]
+        )
+
+
+ENCODERS = {JSON: _json_chunks, MSGPACK: _msgpack_chunks}
+
+
+def _compressed(chunks, encoding: str):
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def negotiated_response(request: Request, payload, headers=None) -> Response:
+    # Serializes with orjson or MessagePack per Accept. The body is produced
+    # chunk by chunk; once it passes COMPRESSION_MIN_SIZE the rest streams
+    # through gzip or zstd per Accept-Encoding, so a large listing is never
+    # held in memory in encoded form.
+    media_type = choose_media_type(request.headers.get("accept"))
+    response_headers = {
+        name: value
+        for name, value in (headers or {}).items()
+        if name.lower() not in ("content-length", "content-type")
+    }
+    response_headers["vary"] = "Accept, Accept-Encoding"
+
+    chunks = ENCODERS[media_type](payload)
+    head, size = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESSION_MIN_SIZE:
+            break
+    else:
+        return Response(b"".join(head), media_type=media_type, headers=response_headers)
+
+    body = chain(head, chunks)
+    encoding = choose_encoding(request.headers.get("accept-encoding"))
+    if encoding is not None:
+        body = _compressed(body, encoding)
+        response_headers["content-encoding"] = encoding
+    return StreamingResponse(body, media_type=media_type, headers=response_headers)
@@ -0,0 +1,437 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.orm import Session
+
+from posts.models import Comment
+from posts.schemas import (
+    BlockedRatePercentiles,
+    HourlyCommentAnalytics,
+    UserCommentCount,
+    UserCommentDistribution,
+)
+from sharding import on_shard, post_shards
+
+CHUNK_SIZE = 100_000
+ANALYTICS_CACHE_DIR = os.getenv("ANALYTICS_CACHE_DIR")
+MAX_SEGMENTS = 64
+# Deleted ids kept beside the segments before a compaction folds them in
+MAX_TOMBSTONES = 100_000
+PERCENTILES = (50, 90, 99)
+TOP_USERS = 10
+
+TOMBSTONE_KINDS = ("comments", "posts")
+
+COLUMN_DTYPES = {
+    "id": np.int64,
+    "created_at": np.int64,
+    "user_id": np.int64,
+    "post_id": np.int64,
+    "blocked": np.bool_,
+}
+
+
+class CommentColumns:
+    # created_at is stored as unix seconds, missing ids and dates as -1
+    def __init__(self, id, created_at, user_id, post_id, blocked):
+        self.id = id
+        self.created_at = created_at
+        self.user_id = user_id
+        self.post_id = post_id
+        self.blocked = blocked
+
+    @classmethod
+    def empty(cls) -> "CommentColumns":
+        return cls(
+            **{name: np.empty(0, dtype) for name, dtype in COLUMN_DTYPES.items()}
+        )
+
+    @classmethod
+    def concatenate(cls, chunks: List["CommentColumns"]) -> "CommentColumns":
+        if not chunks:
+            return cls.empty()
+        return cls(
+            **{
+                name: np.concatenate([getattr(chunk, name) for chunk in chunks])
+                for name in COLUMN_DTYPES
+            }
+        )
+
+    def __len__(self):
+        return len(self.id)
+
+    def mask(self, selector) -> "CommentColumns":
+        return CommentColumns(
+            **{name: getattr(self, name)[selector] for name in COLUMN_DTYPES}
+        )
+
+    def between(self, date_from: date, date_to: date) -> "CommentColumns":
+        start, end = _epoch_range(date_from, date_to)
+        return self.mask((self.created_at >= start) & (self.created_at < end))
+
+
+def _epoch_range(date_from: date, date_to: date) -> (int, int):
+    epoch = datetime(1970, 1, 1)
+    start = datetime.combine(date_from, datetime.min.time()) - epoch
+    end = datetime.combine(date_to + timedelta(days=1), datetime.min.time()) - epoch
+    return int(start.total_seconds()), int(end.total_seconds())
+
+
+def _columns_statement(last_id: int, limit: int):
+    return (
+        select(
+            Comment.id,
+            func.coalesce(cast(func.strftime("%s", Comment.created_at), Integer), -1),
+            func.coalesce(Comment.user_id, -1),
+            func.coalesce(Comment.post_id, -1),
+            func.coalesce(Comment.blocked, False),
+        )
+        .where(Comment.id > last_id)
+        .order_by(Comment.id)
+        .limit(limit)
+    )
+
+
+def _rows_to_columns(rows) -> CommentColumns:
+    if not rows:
+        return CommentColumns.empty()
+    ids, created_at, user_ids, post_ids, blocked = zip(*rows)
+    return CommentColumns(
+        id=np.fromiter(ids, np.int64, len(rows)),
+        created_at=np.fromiter(created_at, np.int64, len(rows)),
+        user_id=np.fromiter(user_ids, np.int64, len(rows)),
+        post_id=np.fromiter(post_ids, np.int64, len(rows)),
+        blocked=np.fromiter(blocked, np.bool_, len(rows)),
+    )
+
+
+def iter_comment_chunks(
+    db: Session,
+    last_id: int = 0,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    chunk_size: int = CHUNK_SIZE,
+    shard_id: Optional[str] = None,
+):
+    while True:
+        stmt = on_shard(_columns_statement(last_id, chunk_size), shard_id)
+        if date_from is not None and date_to is not None:
+            stmt = stmt.where(
+                Comment.created_at >= datetime.combine(date_from, datetime.min.time()),
+                Comment.created_at <= datetime.combine(date_to, datetime.max.time()),
+            )
+        rows = db.execute(stmt).all()
+        if not rows:
+            return
+        chunk = _rows_to_columns(rows)
+        yield chunk
+        if len(rows) < chunk_size:
+            return
+        last_id = int(chunk.id[-1])
+
+
+class ColumnCache:
+    # Columnar segment files read back through np.memmap. Refreshing only
+    # pulls comments with an id above the cached maximum of each shard into
+    # a new segment. Deleted and archived comments, and deleted posts whose
+    # comments lose their post_id, are appended to tombstone files that
+    # loading masks out and compaction folds in. Moderation changes to
+    # existing rows invalidate the cache instead.
+    #
+    # The meta file is the commit point: a segment's column files are each
+    # written to a temporary file and moved into place before the meta file
+    # that lists it is replaced, so a crash leaves at most an unlisted
+    # segment behind, never misaligned columns. Worker processes share the
+    # directory and serialize writes on a lock file.
+    def __init__(self, directory: str, max_segments: int = MAX_SEGMENTS):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self.lock, open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, segment: int, name: str) -> str:
+        return os.path.join(self.directory, f"{segment}.{name}.bin")
+
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, "meta.json")
+
+    def _tombstone_path(self, kind: str) -> str:
+        return os.path.join(self.directory, f"deleted_{kind}.tomb")
+
+    def _read_tombstones(self, kind: str) -> np.ndarray:
+        # A torn append leaves a partial record at the end, which is ignored
+        path = self._tombstone_path(kind)
+        try:
+            count = os.path.getsize(path) // 8
+            return np.fromfile(path, dtype=np.int64, count=count)
+        except FileNotFoundError:
+            return np.empty(0, np.int64)
+
+    def record_deleted(self, kind: str, ids: Iterable[int]):
+        ids = np.fromiter(ids, np.int64)
+        if not len(ids):
+            return
+        with self._locked(), open(self._tombstone_path(kind), "ab") as tomb_file:
+            size = tomb_file.tell()
+            if size % 8:
+                tomb_file.truncate(size - size % 8)
+            tomb_file.write(ids.tobytes())
+
+    def _clear_tombstones(self):
+        for kind in TOMBSTONE_KINDS:
+            if os.path.exists(self._tombstone_path(kind)):
+                os.remove(self._tombstone_path(kind))
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self._meta_path()) as meta_file:
+                meta = json.load(meta_file)
+        except FileNotFoundError:
+            meta = {}
+        if "segments" not in meta:
+            # Missing, or written by the append-only layout: start over
+            return {"segments": [], "next_segment": 0, "last_ids": {}}
+        return meta
+
+    def _write_meta(self, meta: dict):
+        tmp_path = self._meta_path() + ".tmp"
+        with open(tmp_path, "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_path, self._meta_path())
+
+    def _write_segment(self, meta: dict, chunk: CommentColumns) -> dict:
+        segment = meta["next_segment"]
+        for name, dtype in COLUMN_DTYPES.items():
+            tmp_path = self._path(segment, name) + ".tmp"
+            with open(tmp_path, "wb") as column_file:
+                column_file.write(getattr(chunk, name).astype(dtype).tobytes())
+            os.replace(tmp_path, self._path(segment, name))
+        return {
+            **meta,
+            "segments": meta["segments"] + [{"id": segment, "rows": len(chunk)}],
+            "next_segment": segment + 1,
+        }
+
+    def _remove_unlisted(self, meta: dict):
+        listed = {str(segment["id"]) for segment in meta["segments"]}
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith((".bin", ".bin.tmp")):
+                if file_name.split(".", 1)[0] not in listed:
+                    os.remove(os.path.join(self.directory, file_name))
+
+    def refresh(self, db: Session):
+        with self._locked():
+            meta = self._read_meta()
+            for shard_id in post_shards(db):
+                key = shard_id or ""
+                last_id = meta["last_ids"].get(key, 0)
+                for chunk in iter_comment_chunks(db, last_id, shard_id=shard_id):
+                    meta = self._write_segment(meta, chunk)
+                    meta["last_ids"] = {**meta["last_ids"], key: int(chunk.id[-1])}
+                    self._write_meta(meta)
+            tombstones = sum(
+                len(self._read_tombstones(kind)) for kind in TOMBSTONE_KINDS
+            )
+            if len(meta["segments"]) > self.max_segments or tombstones > MAX_TOMBSTONES:
+                self._compact(meta)
+
+    def _compact(self, meta: dict):
+        # Frequent small refreshes leave many small segments, and deletes
+        # pile up tombstones; merge both into one segment. Tombstones go
+        # last, so a reader never sees the old segments without them.
+        merged = self._load(meta, *self._tombstones())
+        compacted = self._write_segment({**meta, "segments": []}, merged)
+        self._write_meta(compacted)
+        self._remove_unlisted(compacted)
+        self._clear_tombstones()
+
+    def invalidate(self):
+        with self._locked():
+            meta = self._read_meta()
+            emptied = {
+                "segments": [],
+                "next_segment": meta["next_segment"],
+                "last_ids": {},
+            }
+            self._write_meta(emptied)
+            # Readers holding a memmap keep their (unlinked) files
+            self._remove_unlisted(emptied)
+            self._clear_tombstones()
+
+    def rebuild(self, db: Session):
+        self.invalidate()
+        self.refresh(db)
+
+    def _tombstones(self) -> (np.ndarray, np.ndarray):
+        return self._read_tombstones("comments"), self._read_tombstones("posts")
+
+    def _load(
+        self,
+        meta: dict,
+        deleted_comments: np.ndarray,
+        deleted_posts: np.ndarray,
+        date_from=None,
+        date_to=None,
+    ) -> CommentColumns:
+        chunks = []
+        for segment in meta["segments"]:
+            columns = CommentColumns(
+                **{
+                    name: np.memmap(
+                        self._path(segment["id"], name),
+                        dtype=dtype,
+                        mode="r",
+                        shape=(segment["rows"],),
+                    )
+                    for name, dtype in COLUMN_DTYPES.items()
+                }
+            )
+            if date_from is not None and date_to is not None:
+                columns = columns.between(date_from, date_to)
+            if len(deleted_comments):
+                columns = columns.mask(~np.isin(columns.id, deleted_comments))
+            if len(deleted_posts):
+                orphaned = np.isin(columns.post_id, deleted_posts)
+                columns.post_id = np.where(orphaned, -1, columns.post_id)
+            chunks.append(columns)
+        return CommentColumns.concatenate(chunks)
+
+    def load(
+        self, date_from: Optional[date] = None, date_to: Optional[date] = None
+    ) -> CommentColumns:
+        # With a date range each segment is filtered before concatenation, so
+        # only the matching rows are copied out of the memmaps
+        # Tombstones are read before meta: compaction clears them only after
+        # the meta without the deleted rows is in place
+        try:
+            tombstones = self._tombstones()
+            return self._load(self._read_meta(), *tombstones, date_from, date_to)
+        except FileNotFoundError:
+            # Compacted or invalidated between reading meta and the segments
+            tombstones = self._tombstones()
+            return self._load(self._read_meta(), *tombstones, date_from, date_to)
+
+
+column_cache = ColumnCache(ANALYTICS_CACHE_DIR) if ANALYTICS_CACHE_DIR else None
+
+
+def invalidate_column_cache():
+    # For writes that change comments the cache already holds
+    if column_cache is not None:
+        column_cache.invalidate()
+
+
+def record_deleted_comments(ids: Iterable[int]):
+    # Deleted, archived and purged comments; comment ids are unique across
+    # shards
+    if column_cache is not None:
+        column_cache.record_deleted("comments", ids)
+
+
+def record_deleted_post(post_id: int):
+    # The post's comments are orphaned, which clears their post_id
+    if column_cache is not None:
+        column_cache.record_deleted("posts", [post_id])
+
+
+def load_comment_columns(db: Session, date_from: date, date_to: date) -> CommentColumns:
+    if column_cache is not None:
+        column_cache.refresh(db)
+        return column_cache.load(date_from, date_to)
+
+    chunks = [
+        chunk
+        for shard_id in post_shards(db)
+        for chunk in iter_comment_chunks(
+            db, date_from=date_from, date_to=date_to, shard_id=shard_id
+        )
+    ]
+    return CommentColumns.concatenate(chunks).between(date_from, date_to)
+
+
+def get_hourly_comments(
+    date_from: date, date_to: date, db: Session
+) -> List[HourlyCommentAnalytics]:
+    columns = load_comment_columns(db, date_from, date_to)
+    start, end = _epoch_range(date_from, date_to)
+    hours = (end - start) // 3600
+
+    bucket = (columns.created_at - start) // 3600
+    blocked = np.bincount(bucket, weights=columns.blocked, minlength=hours)
+    total = np.bincount(bucket, minlength=hours)
+
+    epoch = datetime(1970, 1, 1)
+    return [
+        HourlyCommentAnalytics(
+            hour=epoch + timedelta(seconds=start + int(index) * 3600),
+            created_comments=int(total[index] - blocked[index]),
+            blocked_comments=int(blocked[index]),
+        )
+        for index in np.flatnonzero(total)
+    ]
+
+
+def get_user_comment_distribution(
+    date_from: date, date_to: date, db: Session
+) -> UserCommentDistribution:
+    columns = load_comment_columns(db, date_from, date_to)
+    columns = columns.mask(columns.user_id >= 0)
+    if len(columns) == 0:
+        return UserCommentDistribution()
+
+    user_ids, counts = np.unique(columns.user_id, return_counts=True)
+    percentiles = np.percentile(counts, PERCENTILES)
+    top = np.argsort(counts, kind="stable")[::-1][:TOP_USERS]
+
+    return UserCommentDistribution(
+        users=len(user_ids),
+        comments=int(counts.sum()),
+        mean=float(counts.mean()),
+        p50=float(percentiles[0]),
+        p90=float(percentiles[1]),
+        p99=float(percentiles[2]),
+        max=int(counts.max()),
+        top_users=[
+            UserCommentCount(user_id=int(user_ids[index]), comments=int(counts[index]))
+            for index in top
+        ],
+    )
+
+
+def get_blocked_rate_percentiles(
+    date_from: date, date_to: date, db: Session
+) -> BlockedRatePercentiles:
+    columns = load_comment_columns(db, date_from, date_to)
+    columns = columns.mask(columns.post_id >= 0)
+    if len(columns) == 0:
+        return BlockedRatePercentiles()
+
+    post_ids, inverse = np.unique(columns.post_id, return_inverse=True)
+    totals = np.bincount(inverse)
+    blocked = np.bincount(inverse, weights=columns.blocked)
+    rates = blocked / totals
+    percentiles = np.percentile(rates, PERCENTILES)
+
+    return BlockedRatePercentiles(
+        posts=len(post_ids),
+        overall_rate=float(blocked.sum() / totals.sum()),
+        p50=float(percentiles[0]),
+        p90=float(percentiles[1]),
+        p99=float(percentiles[2]),
+    )
@@ -0,0 +1,209 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, or_, select
+
+from posts.analytics import record_deleted_comments
+from posts.compression import compress_text, decompress_text
+from posts.counters import reconcile_post_counters
+from posts.models import ArchivedComment, Comment
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+BLOCKED_RETENTION_DAYS = int(os.getenv("BLOCKED_RETENTION_DAYS", "90"))
+BATCH_SIZE = 1000
+# Free pages returned to the filesystem after each run
+VACUUM_PAGES = 10_000
+
+comments = Comment.__table__
+archived_comments = ArchivedComment.__table__
+
+
+def _compressed(content):
+    # Archived bodies are always compressed, whatever COMPRESS_CONTENT says
+    if content is None or isinstance(content, bytes):
+        return content
+    return compress_text(decompress_text(content))
+
+
+def _reserve_archived_ids(connection):
+    # comments is AUTOINCREMENT, but ids archived before it was may sit above
+    # its sequence; move the sequence past them so they are never reused
+    highest = connection.execute(select(func.max(archived_comments.c.id))).scalar()
+    if highest is None:
+        return
+    sequence = connection.exec_driver_sql(
+        "SELECT seq FROM main.sqlite_sequence WHERE name = 'comments'"
+    ).scalar()
+    if sequence is None:
+        connection.exec_driver_sql(
+            "INSERT INTO main.sqlite_sequence (name, seq) VALUES ('comments', ?)",
+            (highest,),
+        )
+    elif sequence < highest:
+        connection.exec_driver_sql(
+            "UPDATE main.sqlite_sequence SET seq = ? WHERE name = 'comments'",
+            (highest,),
+        )
+    connection.commit()
+
+
+def archive_comments(
+    connection, archive_before: datetime, batch_size: int = BATCH_SIZE
+) -> int:
+    # Copies visible comments from before the first one created at or after
+    # `archive_before` into the attached archive and deletes them from `comments` in the same transaction, one
+    # id-ordered batch at a time. Post counters are left as they are: an
+    # archived comment still counts.
+    archived = 0
+    now = datetime.utcnow()
+    _reserve_archived_ids(connection)
+    # Listings order by id and read the archive after the live rows, so only
+    # ids below the first recent comment move; created_at comes from clients
+    # and does not follow id order
+    boundary = connection.execute(
+        select(func.min(comments.c.id)).where(comments.c.created_at >= archive_before)
+    ).scalar()
+    if boundary is None:
+        boundary = (
+            connection.execute(select(func.max(comments.c.id))).scalar() or 0
+        ) + 1
+    while True:
+        rows = connection.execute(
+            select(
+                comments.c.id,
+                comments.c.content,
+                comments.c.post_id,
+                comments.c.user_id,
+                comments.c.created_at,
+            )
+            .where(
+                comments.c.id < boundary,
+                or_(comments.c.blocked == False, comments.c.blocked.is_(None)),
+            )
+            .order_by(comments.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return archived
+
+        # A reused id fails the batch rather than overwrite an archived comment
+        connection.execute(
+            insert(archived_comments),
+            [
+                {
+                    "id": row.id,
+                    "content": _compressed(row.content),
+                    "post_id": row.post_id,
+                    "user_id": row.user_id,
+                    "created_at": row.created_at,
+                    "archived_at": now,
+                }
+                for row in rows
+            ],
+        )
+        connection.execute(
+            delete(comments).where(comments.c.id.in_([row.id for row in rows]))
+        )
+        connection.commit()
+        # Analytics only cover live comments
+        record_deleted_comments(row.id for row in rows)
+        archived += len(rows)
+
+
+def purge_blocked_comments(
+    connection, purge_before: datetime, batch_size: int = BATCH_SIZE
+) -> int:
+    purged = 0
+    while True:
+        rows = connection.execute(
+            select(comments.c.id, comments.c.post_id)
+            .where(comments.c.created_at < purge_before, comments.c.blocked == True)
+            .order_by(comments.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return purged
+
+        connection.execute(
+            delete(comments).where(comments.c.id.in_([row.id for row in rows]))
+        )
+        reconcile_post_counters(connection, {row.post_id for row in rows})
+        connection.commit()
+        record_deleted_comments(row.id for row in rows)
+        purged += len(rows)
+
+
+def incremental_vacuum(connection, pages: int = VACUUM_PAGES) -> dict:
+    # Only frees pages in files created with (or converted to)
+    # auto_vacuum=INCREMENTAL; see enable_incremental_vacuum
+    freed = {}
+    for schema in ("main", "archive"):
+        before = connection.exec_driver_sql(f"PRAGMA {schema}.freelist_count").scalar()
+        connection.exec_driver_sql(f"PRAGMA {schema}.incremental_vacuum({pages})")
+        after = connection.exec_driver_sql(f"PRAGMA {schema}.freelist_count").scalar()
+        freed[schema] = before - after
+    connection.commit()
+    return freed
+
+
+def enable_incremental_vacuum(engine):
+    # Switching an existing file's auto_vacuum mode takes one full VACUUM
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA main.auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM main")
+
+
+def run_tiering(
+    engine,
+    archive_after_days: int = ARCHIVE_AFTER_DAYS,
+    blocked_retention_days: int = BLOCKED_RETENTION_DAYS,
+    batch_size: int = BATCH_SIZE,
+) -> dict:
+    now = datetime.utcnow()
+    with engine.connect() as connection:
+        return {
+            "archived": archive_comments(
+                connection, now - timedelta(days=archive_after_days), batch_size
+            ),
+            "purged": purge_blocked_comments(
+                connection, now - timedelta(days=blocked_retention_days), batch_size
+            ),
+            "vacuumed_pages": incremental_vacuum(connection),
+        }
+
+
+def main():
+    from database import ARCHIVE_COMMENTS, post_engines
+
+    parser = argparse.ArgumentParser(
+        description="Move old comments to the archive and purge old blocked ones"
+    )
+    parser.add_argument("--archive-after-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument(
+        "--blocked-retention-days", type=int, default=BLOCKED_RETENTION_DAYS
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="convert the database files to auto_vacuum=INCREMENTAL first",
+    )
+    args = parser.parse_args()
+
+    if not ARCHIVE_COMMENTS:
+        parser.error("set ARCHIVE_COMMENTS=true so the archive is attached")
+    for engine in post_engines:
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(engine)
+        result = run_tiering(
+            engine,
+            args.archive_after_days,
+            args.blocked_retention_days,
+            args.batch_size,
+        )
+        print(f"{engine.url.database}: {result}")
+
+
+if __name__ == "__main__":
+    main()
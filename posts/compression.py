@@ -0,0 +1,220 @@
+import argparse
+import os
+import struct
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import String, bindparam, func, select, update
+from sqlalchemy.types import TypeDecorator
+
+COMPRESS_CONTENT = os.getenv("COMPRESS_CONTENT", "false").lower() == "true"
+COMPRESSION_THRESHOLD = int(os.getenv("COMPRESSION_THRESHOLD", "512"))
+COMPRESSION_DICT_DIR = os.getenv("COMPRESSION_DICT_DIR")
+COMPRESSION_LEVEL = 6
+DICTIONARY_SIZE = 32 * 1024
+
+# Compressed values are stored as BLOBs: magic prefix, crc32 of the preset
+# dictionary they were compressed with (0 for none), then the zlib stream.
+MAGIC = b"\x00zc"
+HEADER = struct.Struct(">3sI")
+
+
+def load_dictionaries(directory: Optional[str]) -> (Dict[int, bytes], int):
+    dictionaries = {}
+    current = 0
+    if not directory or not os.path.isdir(directory):
+        return dictionaries, current
+
+    paths = [
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".zdict")
+    ]
+    for path in sorted(paths, key=os.path.getmtime):
+        with open(path, "rb") as dictionary_file:
+            dictionary = dictionary_file.read()
+        current = zlib.crc32(dictionary)
+        dictionaries[current] = dictionary
+    return dictionaries, current
+
+
+dictionaries, current_dictionary = load_dictionaries(COMPRESSION_DICT_DIR)
+
+
+def train_dictionary(samples: Iterable[str], size: int = DICTIONARY_SIZE) -> bytes:
+    # zlib reuses the tail of a preset dictionary most cheaply, so the most
+    # frequent words go last.
+    counter = Counter()
+    for sample in samples:
+        counter.update(word for word in sample.split() if len(word) > 3)
+
+    words = []
+    total = 0
+    for word, count in counter.most_common():
+        if count < 2:
+            break
+        encoded = word.encode() + b" "
+        if total + len(encoded) > size:
+            break
+        words.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(words))
+
+
+def compress_text(text: str, dictionary_id: int = None) -> bytes:
+    if dictionary_id is None:
+        dictionary_id = current_dictionary
+    if dictionary_id:
+        compressor = zlib.compressobj(
+            COMPRESSION_LEVEL, zdict=dictionaries[dictionary_id]
+        )
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    body = compressor.compress(text.encode()) + compressor.flush()
+    return HEADER.pack(MAGIC, dictionary_id) + body
+
+
+def decompress_text(value):
+    if not isinstance(value, bytes):
+        return value
+    if not value.startswith(MAGIC):
+        return value.decode()
+
+    _, dictionary_id = HEADER.unpack_from(value)
+    if dictionary_id:
+        if dictionary_id not in dictionaries:
+            raise ValueError(f"Unknown compression dictionary {dictionary_id:08x}")
+        decompressor = zlib.decompressobj(zdict=dictionaries[dictionary_id])
+    else:
+        decompressor = zlib.decompressobj()
+    body = decompressor.decompress(value[HEADER.size :]) + decompressor.flush()
+    return body.decode()
+
+
+def should_compress(value) -> bool:
+    return (
+        COMPRESS_CONTENT
+        and isinstance(value, str)
+        and len(value) >= COMPRESSION_THRESHOLD
+    )
+
+
+class CompressedText(TypeDecorator):
+    # Compresses on write only; loaded values stay compressed until the
+    # mapped attribute is read through compressed_property().
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if should_compress(value):
+            return compress_text(value)
+        return value
+
+
+def compressed_property(attribute: str) -> property:
+    cache_key = f"{attribute}_text"
+
+    def getter(instance):
+        raw = getattr(instance, attribute)
+        if not isinstance(raw, bytes):
+            return raw
+        cached = instance.__dict__.get(cache_key)
+        if cached is not None and cached[0] is raw:
+            return cached[1]
+        text = decompress_text(raw)
+        instance.__dict__[cache_key] = (raw, text)
+        return text
+
+    def setter(instance, value):
+        instance.__dict__.pop(cache_key, None)
+        setattr(instance, attribute, value)
+
+    return property(getter, setter)
+
+
+def convert_table(connection, table, batch_size: int = 1000, decompress=False):
+    # Rewrites content in id-ordered chunks, committing between chunks so the
+    # write lock is only held for one batch at a time.
+    if decompress:
+        candidates = func.typeof(table.c.content) == "blob"
+    else:
+        candidates = (func.typeof(table.c.content) == "text") & (
+            func.length(table.c.content) >= COMPRESSION_THRESHOLD
+        )
+
+    converted = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(table.c.id, table.c.content)
+            .where(table.c.id > last_id, candidates)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return converted
+
+        convert = decompress_text if decompress else compress_text
+        connection.execute(
+            update(table)
+            .where(table.c.id == bindparam("row_id"))
+            .values(content=bindparam("body", type_=String)),
+            [{"row_id": row.id, "body": convert(row.content)} for row in rows],
+        )
+        connection.commit()
+        converted += len(rows)
+        last_id = rows[-1].id
+
+
+def main():
+    from database import post_engines
+    from posts.models import Comment, Post
+
+    parser = argparse.ArgumentParser(description="Compress post and comment bodies")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train = subparsers.add_parser("train", help="train a preset dictionary")
+    train.add_argument("--output", default=COMPRESSION_DICT_DIR)
+    train.add_argument("--samples", type=int, default=10_000)
+
+    migrate = subparsers.add_parser("migrate", help="convert existing rows")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--decompress", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "train":
+        if not args.output:
+            parser.error("--output or COMPRESSION_DICT_DIR is required")
+        samples = []
+        for engine in post_engines:
+            with engine.connect() as connection:
+                for table in (Post.__table__, Comment.__table__):
+                    samples += connection.execute(
+                        select(table.c.content)
+                        .where(func.typeof(table.c.content) == "text")
+                        .order_by(func.random())
+                        .limit(args.samples // len(post_engines))
+                    ).scalars()
+        dictionary = train_dictionary(samples)
+        os.makedirs(args.output, exist_ok=True)
+        path = os.path.join(args.output, f"{zlib.crc32(dictionary):08x}.zdict")
+        with open(path, "wb") as dictionary_file:
+            dictionary_file.write(dictionary)
+        print(f"Wrote {len(dictionary)} byte dictionary to {path}")
+    else:
+        if not COMPRESS_CONTENT and not args.decompress:
+            parser.error("set COMPRESS_CONTENT=true to compress existing rows")
+        for engine in post_engines:
+            with engine.connect() as connection:
+                for table in (Post.__table__, Comment.__table__):
+                    converted = convert_table(
+                        connection, table, args.batch_size, args.decompress
+                    )
+                    print(
+                        f"{engine.url.database} {table.name}: converted {converted} rows"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import ARCHIVE_COMMENTS
+from posts.models import ArchivedComment, Comment, Post
+from sharding import on_shard, post_shards
+
+RECONCILE_CHUNK_SIZE = 1000
+
+
+def record_comment_created(
+    db: Session, post_id: int, blocked: bool, created_at: Optional[datetime]
+):
+    # Runs in the caller's transaction, so the counters commit with the comment
+    if blocked:
+        values = {
+            Post.blocked_comment_count: func.coalesce(Post.blocked_comment_count, 0) + 1
+        }
+    else:
+        values = {Post.comment_count: func.coalesce(Post.comment_count, 0) + 1}
+        if created_at is not None:
+            values[Post.last_comment_at] = func.max(
+                func.coalesce(Post.last_comment_at, created_at), created_at
+            )
+    db.query(Post).filter(Post.id == post_id).update(values, synchronize_session=False)
+
+
+def record_comment_deleted(db: Session, post_id: int):
+    db.query(Post).filter(Post.id == post_id).update(
+        {
+            Post.comment_count: func.max(func.coalesce(Post.comment_count, 0) - 1, 0),
+            Post.last_comment_at: _last_comment_at(),
+        },
+        synchronize_session=False,
+    )
+
+
+def _visible():
+    return or_(Comment.blocked == False, Comment.blocked.is_(None))
+
+
+def _last_comment_at():
+    live = (
+        select(func.max(Comment.created_at))
+        .where(Comment.post_id == Post.id, _visible())
+        .scalar_subquery()
+    )
+    if not ARCHIVE_COMMENTS:
+        return live
+    # Archived comments are older than live ones, so they only matter once
+    # every live comment is gone
+    return func.coalesce(
+        live,
+        select(func.max(ArchivedComment.created_at))
+        .where(ArchivedComment.post_id == Post.id)
+        .scalar_subquery(),
+    )
+
+
+def _comment_count():
+    count = (
+        select(func.count())
+        .where(Comment.post_id == Post.id, _visible())
+        .scalar_subquery()
+    )
+    if not ARCHIVE_COMMENTS:
+        return count
+    return (
+        count
+        + select(func.count())
+        .where(ArchivedComment.post_id == Post.id)
+        .scalar_subquery()
+    )
+
+
+def counter_values() -> dict:
+    return {
+        Post.comment_count: _comment_count(),
+        Post.blocked_comment_count: select(func.count())
+        .where(Comment.post_id == Post.id, Comment.blocked == True)
+        .scalar_subquery(),
+        Post.last_comment_at: _last_comment_at(),
+    }
+
+
+def _drifted():
+    values = counter_values()
+    return or_(*(column.is_distinct_from(value) for column, value in values.items()))
+
+
+def reconcile_post_counters(db: Session, post_ids: Iterable[int]) -> int:
+    post_ids = list(post_ids)
+    if not post_ids:
+        return 0
+    return db.execute(
+        update(Post)
+        .where(Post.id.in_(post_ids), _drifted())
+        .values(counter_values())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def reconcile_all(db: Session, chunk_size: int = RECONCILE_CHUNK_SIZE) -> int:
+    return sum(
+        _reconcile_shard(db, chunk_size, shard_id) for shard_id in post_shards(db)
+    )
+
+
+def _reconcile_shard(db: Session, chunk_size: int, shard_id: Optional[str]) -> int:
+    fixed = 0
+    last_id = 0
+    while True:
+        upper = db.execute(
+            on_shard(
+                select(Post.id)
+                .where(Post.id > last_id)
+                .order_by(Post.id)
+                .offset(chunk_size - 1)
+                .limit(1),
+                shard_id,
+            )
+        ).scalar()
+        if upper is None:
+            upper = db.execute(on_shard(select(func.max(Post.id)), shard_id)).scalar()
+        if upper is None or upper <= last_id:
+            return fixed
+
+        fixed += db.execute(
+            on_shard(
+                update(Post)
+                .where(and_(Post.id > last_id, Post.id <= upper), _drifted())
+                .values(counter_values())
+                .execution_options(synchronize_session=False),
+                shard_id,
+            )
+        ).rowcount
+        db.commit()
+        last_id = upper
+
+
+def main():
+    from database import SessionLocal, post_engines
+    from totals import analyze_sampled, reconcile_table_counts
+
+    parser = argparse.ArgumentParser(
+        description="Recompute per-post comment counters and fix drift"
+    )
+    parser.add_argument("--chunk-size", type=int, default=RECONCILE_CHUNK_SIZE)
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="refresh the sampled index statistics behind the planner and activity estimates",
+    )
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        fixed = reconcile_all(db, args.chunk_size)
+        counts = reconcile_table_counts(db)
+    print(f"Reconciled {fixed} posts, table counts {counts}")
+    if args.analyze:
+        for engine in post_engines:
+            analyze_sampled(engine)
+
+
+if __name__ == "__main__":
+    main()
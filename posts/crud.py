@@ -1,14 +1,125 @@
+import logging
+import os
 from datetime import date, datetime
-from typing import List
+from typing import List, Optional
 
 from fastapi import HTTPException
-from sqlalchemy import func, case, literal
-from sqlalchemy.orm import Session
-
-from posts import schemas, models
+from sqlalchemy import bindparam, case, func, literal, select
+from sqlalchemy.orm import Session, joinedload, load_only
+
+from cache import cache
+from database import ARCHIVE_COMMENTS
+from posts import analytics, schemas, models
+from posts.compression import decompress_text
+from posts.counters import record_comment_created, record_comment_deleted
+from posts.hot_comments import HotComment, WriteClock, hot_comments
 from posts.models import Comment
 from posts.schemas import CommentAnalytics
+from posts.spam import comment_index
 from posts.text_moderation import check_profanity
+from sharding import post_shards
+
+logger = logging.getLogger("posts")
+
+PREVIEW_LENGTH = 200
+# Documents are cached with this many comments; smaller pages are sliced
+# from it and larger ones bypass the cache
+DOCUMENT_CACHE_LIMIT = 50
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "30"))
+POST_FIELDS = (
+    "id",
+    "title",
+    "content",
+    "user_id",
+    "blocked",
+    "comment_count",
+    "blocked_comment_count",
+    "last_comment_at",
+)
+DEFAULT_POST_FIELDS = (
+    "id",
+    "title",
+    "content",
+    "comment_count",
+    "blocked_comment_count",
+    "last_comment_at",
+)
+COMMENT_FIELDS = ("id", "content", "post_id", "user_id", "created_at", "blocked")
+DEFAULT_COMMENT_FIELDS = ("id", "content", "post_id", "user_id", "created_at")
+
+# Hot statements are built once at import; each call only binds new values,
+# so SQLAlchemy skips construction and reuses the compiled form from its cache.
+POST_BY_ID = select(models.Post).where(models.Post.id == bindparam("post_id"))
+POST_BY_ID_AND_USER = select(models.Post).where(
+    models.Post.id == bindparam("post_id"), models.Post.user_id == bindparam("user_id")
+)
+POST_WITH_AUTHOR = (
+    select(models.Post)
+    .options(joinedload(models.Post.user).load_only(models.User.username))
+    .where(models.Post.id == bindparam("post_id"))
+)
+POST_COMMENT_COUNT = select(models.Post.comment_count).where(
+    models.Post.id == bindparam("post_id")
+)
+COMMENT_BY_ID = select(models.Comment).where(
+    models.Comment.id == bindparam("comment_id")
+)
+COMMENT_BY_ID_AND_POST = select(models.Comment).where(
+    models.Comment.id == bindparam("comment_id"),
+    models.Comment.post_id == bindparam("post_id"),
+)
+VISIBLE_COMMENTS = (
+    select(models.Comment)
+    .where(
+        models.Comment.post_id == bindparam("post_id"), models.Comment.blocked == False
+    )
+    .order_by(models.Comment.id.desc())
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+VISIBLE_COMMENT_COUNT = select(func.count(models.Comment.id)).where(
+    models.Comment.post_id == bindparam("post_id"), models.Comment.blocked == False
+)
+ARCHIVED_COMMENTS = (
+    select(models.ArchivedComment)
+    .where(models.ArchivedComment.post_id == bindparam("post_id"))
+    .order_by(models.ArchivedComment.id.desc())
+    .offset(bindparam("skip"))
+    .limit(bindparam("limit"))
+)
+VISIBLE_COMMENTS_WITH_AUTHORS = (
+    select(models.Comment)
+    .options(joinedload(models.Comment.user).load_only(models.User.username))
+    .where(
+        models.Comment.post_id == bindparam("post_id"), models.Comment.blocked == False
+    )
+    .order_by(models.Comment.id.desc())
+    .limit(bindparam("limit"))
+)
+# Archived comments have no relationship to load their authors through
+AUTHOR_NAMES = select(models.User.id, models.User.username).where(
+    models.User.id.in_(bindparam("ids", expanding=True))
+)
+# Run once per worker at startup (with values matching no row) to compile them
+POSTS_BY_IDS = select(models.Post).where(
+    models.Post.id.in_(bindparam("ids", expanding=True))
+)
+VISIBLE_COMMENTS_BY_IDS = select(models.Comment).where(
+    models.Comment.id.in_(bindparam("ids", expanding=True)),
+    models.Comment.blocked == False,
+)
+# Ids bound per IN query, well under SQLite's bound parameter limit
+BATCH_CHUNK_SIZE = 500
+HOT_STATEMENTS = (
+    (POST_BY_ID, {"post_id": 0}),
+    (POST_BY_ID_AND_USER, {"post_id": 0, "user_id": 0}),
+    (POST_WITH_AUTHOR, {"post_id": 0}),
+    (POST_COMMENT_COUNT, {"post_id": 0}),
+    (COMMENT_BY_ID, {"comment_id": 0}),
+    (COMMENT_BY_ID_AND_POST, {"comment_id": 0, "post_id": 0}),
+    (VISIBLE_COMMENTS, {"post_id": 0, "skip": 0, "limit": 1}),
+    (VISIBLE_COMMENTS_WITH_AUTHORS, {"post_id": 0, "limit": 1}),
+)
 
 
 def create_post(db: Session, post: schemas.PostCreate, user_id: int):
@@ -38,21 +149,115 @@ def create_post(db: Session, post: schemas.PostCreate, user_id: int):
 
 
 def get_post_by_id(db: Session, post_id: int):
-    return db.query(models.Post).filter(models.Post.id == post_id).first()
+    return db.scalars(POST_BY_ID, {"post_id": post_id}).first()
+
+
+def get_by_ids(db: Session, statement, ids: List[int]) -> (list, List[int]):
+    # Rows in the order of `ids` (repeats dropped) and the ids not found
+    unique = list(dict.fromkeys(ids))
+    found = {}
+    for start in range(0, len(unique), BATCH_CHUNK_SIZE):
+        chunk = unique[start : start + BATCH_CHUNK_SIZE]
+        for row in db.scalars(statement, {"ids": chunk}):
+            found[row.id] = row
+    return (
+        [found[row_id] for row_id in unique if row_id in found],
+        [row_id for row_id in unique if row_id not in found],
+    )
+
+
+def get_posts_by_ids(db: Session, ids: List[int]):
+    return get_by_ids(db, POSTS_BY_IDS, ids)
+
+
+def get_comments_by_ids(db: Session, ids: List[int]):
+    # Blocked comments are reported as missing, as in the listings
+    return get_by_ids(db, VISIBLE_COMMENTS_BY_IDS, ids)
+
+
+def _scatter_page(db: Session, query, model, skip: int, limit: int, row_id=None):
+    if post_shards(db) == [None]:
+        return query.offset(skip).limit(limit).all()
+    # Every shard returns its first skip + limit rows and the page is cut from
+    # the merged result, so deep offsets cost shards * (skip + limit) rows
+    rows = query.order_by(model.id).limit(skip + limit).all()
+    rows.sort(key=row_id or (lambda row: row.id))
+    return rows[skip : skip + limit]
 
 
 def get_all_posts(db: Session, skip: int = 0, limit: int = 10) -> List[models.Post]:
-    return db.query(models.Post).offset(skip).limit(limit).all()
+    return _scatter_page(db, db.query(models.Post), models.Post, skip, limit)
+
+
+def parse_fields(fields: Optional[str], allowed: tuple, default: tuple) -> List[str]:
+    if not fields:
+        return list(default)
+
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return requested
+
+
+def _listing_query(db: Session, model, fields: List[str], summary: bool):
+    # Only the requested columns are loaded; in summary mode the body is
+    # replaced by a preview truncated by the database.
+    columns = [
+        getattr(model, field)
+        for field in fields
+        if not (summary and field == "content")
+    ]
+    query = db.query(model).options(load_only(*columns))
+    if summary:
+        # Compressed bodies cannot be cut in SQL and are truncated after
+        # decompression instead.
+        preview = case(
+            (func.typeof(model.content) == "blob", model.content),
+            else_=func.substr(model.content, 1, PREVIEW_LENGTH),
+        ).label("preview")
+        query = query.add_columns(preview)
+    return query
+
+
+def _listing_rows(rows, fields: List[str], summary: bool) -> List[dict]:
+    items = []
+    for row in rows:
+        instance = row[0] if summary else row
+        item = {
+            field: getattr(instance, field)
+            for field in fields
+            if not (summary and field == "content")
+        }
+        if summary:
+            item["preview"] = decompress_text(row.preview)[:PREVIEW_LENGTH]
+        items.append(item)
+    return items
+
+
+def get_post_listing(
+    db: Session,
+    skip: int = 0,
+    limit: int = 10,
+    fields: List[str] = DEFAULT_POST_FIELDS,
+    summary: bool = False,
+) -> List[dict]:
+    query = _listing_query(db, models.Post, fields, summary)
+    row_id = (lambda row: row[0].id) if summary else None
+    rows = _scatter_page(db, query, models.Post, skip, limit, row_id)
+    return _listing_rows(rows, fields, summary)
 
 
 def update_post_by_id(
     db: Session, post_id: int, post_data: schemas.PostUpdate, user_id: int
 ):
-    db_post = (
-        db.query(models.Post)
-        .filter(models.Post.id == post_id, models.Post.user_id == user_id)
-        .first()
-    )
+    db_post = db.scalars(
+        POST_BY_ID_AND_USER, {"post_id": post_id, "user_id": user_id}
+    ).first()
     if db_post:
         try:
             title_is_toxic, title_message = check_profanity(post_data.title)
@@ -68,6 +273,7 @@ def update_post_by_id(
             db_post.content = post_data.content
 
             db.commit()
+            invalidate_post_document(post_id)
             db.refresh(db_post)
             return db_post
 
@@ -80,10 +286,13 @@ def update_post_by_id(
 
 
 def delete_post_by_id(db: Session, post_id: int):
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
+    post = db.scalars(POST_BY_ID, {"post_id": post_id}).first()
     if post:
         db.delete(post)
         db.commit()
+        invalidate_post_document(post_id)
+        hot_comments.invalidate(post_id)
+        analytics.record_deleted_post(post_id)
         return True
     return False
 
@@ -91,8 +300,17 @@ def delete_post_by_id(db: Session, post_id: int):
 def create_comment(
     db: Session, comment: schemas.CommentCreate, user_id: int, post_id: int
 ):
-    content_is_toxic, content_message = check_profanity(comment.content)
-    blocked = content_is_toxic
+    # Near-duplicates of a recently blocked comment skip the moderator
+    duplicate = comment_index.match(comment.content)
+    if duplicate is not None and duplicate.blocked:
+        blocked = True
+    else:
+        if duplicate is not None and not comment_index.allow_duplicate(user_id):
+            raise HTTPException(status_code=429, detail="Too many duplicate comments.")
+        content_is_toxic, content_message = check_profanity(comment.content)
+        blocked = content_is_toxic
+        if duplicate is None:
+            comment_index.add(comment.content, blocked)
 
     try:
         db_comment = models.Comment(
@@ -104,8 +322,20 @@ def create_comment(
         )
 
         db.add(db_comment)
+        record_comment_created(db, post_id, blocked, comment.created_at)
         db.commit()
+        invalidate_post_document(post_id)
         db.refresh(db_comment)
+        if not blocked:
+            hot_comments.add(
+                HotComment(
+                    db_comment.id,
+                    db_comment.content,
+                    post_id,
+                    user_id,
+                    db_comment.created_at,
+                )
+            )
 
         if blocked:
             raise HTTPException(
@@ -123,21 +353,189 @@ def create_comment(
 
 
 def get_comments_for_post(db: Session, post_id: int, skip: int = 0, limit: int = 10):
-    return (
-        db.query(models.Comment)
+    comments = db.scalars(
+        VISIBLE_COMMENTS, {"post_id": post_id, "skip": skip, "limit": limit}
+    ).all()
+    return comments + _archived_page(db, post_id, skip, limit, len(comments))
+
+
+def _archived_page(db: Session, post_id: int, skip: int, limit: int, found: int):
+    # Past the last live comment a page continues into the archive, which
+    # only holds comments older than every live one. `found` is the number
+    # of live comments the page already has.
+    if not ARCHIVE_COMMENTS or found >= limit:
+        return []
+    if found:
+        # The live page ran out part way, so it ended at the last live one
+        live = skip + found
+    else:
+        live = db.scalar(VISIBLE_COMMENT_COUNT, {"post_id": post_id})
+    return db.scalars(
+        ARCHIVED_COMMENTS,
+        {"post_id": post_id, "skip": max(skip - live, 0), "limit": limit - found},
+    ).all()
+
+
+def get_post_document(db: Session, post_id: int, limit: int = 10) -> Optional[dict]:
+    # One query for the post and its author, one for the newest visible
+    # comments joined to their authors, independent of the page size.
+    post = db.scalars(POST_WITH_AUTHOR, {"post_id": post_id}).first()
+    if post is None:
+        return None
+
+    comments = db.scalars(
+        VISIBLE_COMMENTS_WITH_AUTHORS, {"post_id": post_id, "limit": limit}
+    ).all()
+    archived = _archived_page(db, post_id, 0, limit, len(comments))
+    usernames = {
+        comment.user_id: comment.user.username for comment in comments if comment.user
+    }
+    if archived:
+        usernames.update(
+            db.execute(
+                AUTHOR_NAMES, {"ids": list({comment.user_id for comment in archived})}
+            ).all()
+        )
+
+    return {
+        "id": post.id,
+        "title": post.title,
+        "content": post.content,
+        "comment_count": post.comment_count,
+        "blocked_comment_count": post.blocked_comment_count,
+        "last_comment_at": post.last_comment_at,
+        "user_id": post.user_id,
+        "username": post.user.username if post.user else None,
+        "comments": [
+            {
+                "id": comment.id,
+                "content": comment.content,
+                "post_id": comment.post_id,
+                "user_id": comment.user_id,
+                "created_at": comment.created_at,
+                "username": usernames.get(comment.user_id),
+            }
+            for comment in [*comments, *archived]
+        ],
+    }
+
+
+document_writes = WriteClock()
+
+
+def invalidate_post_document(post_id: int):
+    # Called after the write has committed: a failing cache must not turn a
+    # saved write into an error the client would retry
+    document_writes.written(post_id)
+    try:
+        cache.delete("post_documents", post_id)
+    except Exception:
+        logger.warning("Failed to invalidate post document %s", post_id, exc_info=True)
+
+
+def invalidate_post_documents():
+    document_writes.clear()
+    cache.clear("post_documents")
+
+
+def get_cached_post_document(
+    db: Session, post_id: int, limit: int = 10
+) -> Optional[dict]:
+    if limit > DOCUMENT_CACHE_LIMIT:
+        return get_post_document(db, post_id, limit)
+    document = cache.get("post_documents", post_id)
+    if document is None:
+        started = document_writes.start()
+        document = get_post_document(db, post_id, DOCUMENT_CACHE_LIMIT)
+        if document is None:
+            return None
+        cache.set("post_documents", post_id, document, DOCUMENT_CACHE_TTL)
+        # A write that landed during the query may have invalidated before
+        # the set; checking after it means one of the two deletes wins
+        if not document_writes.unchanged_since(post_id, started):
+            cache.delete("post_documents", post_id)
+    return {**document, "comments": document["comments"][:limit]}
+
+
+def get_comment_listing(
+    db: Session,
+    post_id: int,
+    skip: int = 0,
+    limit: int = 10,
+    fields: List[str] = DEFAULT_COMMENT_FIELDS,
+    summary: bool = False,
+) -> List[dict]:
+    if skip == 0 and limit <= hot_comments.size:
+        comments = _hot_first_page(db, post_id, limit)
+        archived = _archived_page(db, post_id, 0, limit, len(comments))
+        return _instance_rows([*comments, *archived], fields, summary)
+
+    rows = (
+        _listing_query(db, models.Comment, fields, summary)
         .filter(models.Comment.post_id == post_id, models.Comment.blocked == False)
+        .order_by(models.Comment.id.desc())
         .offset(skip)
         .limit(limit)
         .all()
     )
+    archived = _archived_page(db, post_id, skip, limit, len(rows))
+    return _listing_rows(rows, fields, summary) + _instance_rows(
+        archived, fields, summary
+    )
+
+
+def _hot_first_page(db: Session, post_id: int, limit: int) -> List[HotComment]:
+    comments = hot_comments.first_page(post_id, limit)
+    if comments is not None:
+        return comments
+
+    started = hot_comments.start_fill()
+    comments = [
+        HotComment(
+            comment.id,
+            comment.content,
+            comment.post_id,
+            comment.user_id,
+            comment.created_at,
+        )
+        for comment in db.scalars(
+            VISIBLE_COMMENTS,
+            {"post_id": post_id, "skip": 0, "limit": hot_comments.size},
+        )
+    ]
+    total = db.scalar(POST_COMMENT_COUNT, {"post_id": post_id}) or 0
+    hot_comments.fill(post_id, comments, total, started)
+    return comments[:limit]
+
+
+def get_comment_total(db: Session, post_id: int) -> int:
+    # Read after the listing, which fills the ring on a miss
+    total = hot_comments.total(post_id)
+    if total is None:
+        total = db.scalar(POST_COMMENT_COUNT, {"post_id": post_id}) or 0
+    return total
+
+
+def _instance_rows(comments, fields: List[str], summary: bool) -> List[dict]:
+    # Hot ring entries and archived comments, whose content is already
+    # decompressed
+    items = []
+    for comment in comments:
+        item = {
+            field: getattr(comment, field)
+            for field in fields
+            if not (summary and field == "content")
+        }
+        if summary:
+            item["preview"] = (comment.content or "")[:PREVIEW_LENGTH]
+        items.append(item)
+    return items
 
 
 def update_comment(
     db: Session, comment_id: int, comment_data: schemas.CommentUpdate
 ) -> models.Comment:
-    db_comment = (
-        db.query(models.Comment).filter(models.Comment.id == comment_id).first()
-    )
+    db_comment = db.scalars(COMMENT_BY_ID, {"comment_id": comment_id}).first()
 
     if db_comment:
         try:
@@ -161,6 +559,8 @@ def update_comment(
             db_comment.updated_at = comment_data.updated_at
 
             db.commit()
+            invalidate_post_document(db_comment.post_id)
+            hot_comments.update(db_comment.post_id, db_comment.id, db_comment.content)
             db.refresh(db_comment)
             return db_comment
 
@@ -171,11 +571,9 @@ def update_comment(
 
 
 def delete_comment_by_id_and_post_id(db: Session, comment_id: int, post_id: int):
-    comment = (
-        db.query(models.Comment)
-        .filter(models.Comment.id == comment_id, models.Comment.post_id == post_id)
-        .first()
-    )
+    comment = db.scalars(
+        COMMENT_BY_ID_AND_POST, {"comment_id": comment_id, "post_id": post_id}
+    ).first()
 
     if comment:
         if comment.blocked:
@@ -183,7 +581,12 @@ def delete_comment_by_id_and_post_id(db: Session, comment_id: int, post_id: int)
                 status_code=400, detail="Cannot delete blocked comment."
             )
         db.delete(comment)
+        db.flush()
+        record_comment_deleted(db, post_id)
         db.commit()
+        invalidate_post_document(post_id)
+        hot_comments.remove(post_id, comment_id)
+        analytics.record_deleted_comments([comment_id])
         return True
     return False
 
@@ -209,11 +612,20 @@ def get_comments_data(
         .all()
     )
 
+    # Sharded sessions return one group per date and shard, so sum them up
+    days = {}
+    for row in result:
+        created, blocked = days.get(row.date, (0, 0))
+        days[row.date] = (
+            created + row.created_comments,
+            blocked + row.blocked_comments,
+        )
+
     return [
         CommentAnalytics(
-            date=row.date,
-            created_comments=row.created_comments,
-            blocked_comments=row.blocked_comments,
+            date=day,
+            created_comments=created,
+            blocked_comments=blocked,
         )
-        for row in result
+        for day, (created, blocked) in sorted(days.items())
     ]
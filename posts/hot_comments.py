@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import List, Optional
+
+HOT_COMMENTS_SIZE = int(os.getenv("HOT_COMMENTS_SIZE", "20"))
+HOT_POSTS = int(os.getenv("HOT_POSTS", "1000"))
+# Other workers' writes only reach this worker's copy by expiry
+HOT_COMMENTS_TTL = float(os.getenv("HOT_COMMENTS_TTL", "5"))
+RECENT_WRITES = 10_000
+
+
+class WriteClock:
+    # A cache filled from a query that started before a write to the same
+    # key would miss that write. Fills take a tick with start() and store
+    # only if unchanged_since() still holds.
+    def __init__(self, size: int = RECENT_WRITES):
+        self.size = size
+        self.clock = 0
+        self.cleared = -1
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self) -> int:
+        with self.lock:
+            return self.clock
+
+    def written(self, key):
+        with self.lock:
+            self.recent[key] = self.clock
+            self.recent.move_to_end(key)
+            self.clock += 1
+            while len(self.recent) > self.size:
+                self.recent.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.cleared = self.clock
+            self.clock += 1
+
+    def unchanged_since(self, key, started: int) -> bool:
+        with self.lock:
+            return started > self.cleared and self.recent.get(key, -1) < started
+
+
+class HotComment:
+    __slots__ = ("id", "content", "post_id", "user_id", "created_at")
+
+    blocked = False
+
+    def __init__(self, id, content, post_id, user_id, created_at):
+        self.id = id
+        self.content = content
+        self.post_id = post_id
+        self.user_id = user_id
+        self.created_at = created_at
+
+
+class PostRing:
+    # Newest visible comments of one post, highest id first. `complete` means
+    # the post has no visible comments beyond the ring; `total` is the post's
+    # comment_count, kept in step by this worker's writes.
+    __slots__ = ("comments", "complete", "total", "expires_at")
+
+    def __init__(
+        self, comments, size: int, complete: bool, total: int, expires_at: float
+    ):
+        self.comments = deque(comments, maxlen=size)
+        self.complete = complete
+        self.total = total
+        self.expires_at = expires_at
+
+
+class HotComments:
+    def __init__(
+        self,
+        size: int = HOT_COMMENTS_SIZE,
+        max_posts: int = HOT_POSTS,
+        ttl: float = HOT_COMMENTS_TTL,
+    ):
+        self.size = size
+        self.max_posts = max_posts
+        self.ttl = ttl
+        self.posts = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = WriteClock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def first_page(self, post_id: int, limit: int) -> Optional[List[HotComment]]:
+        with self.lock:
+            ring = self.posts.get(post_id)
+            if (
+                ring is None
+                or ring.expires_at <= time.monotonic()
+                or (len(ring.comments) < limit and not ring.complete)
+            ):
+                self.counters["misses"] += 1
+                return None
+            self.posts.move_to_end(post_id)
+            self.counters["hits"] += 1
+            return list(islice(ring.comments, limit))
+
+    def total(self, post_id: int) -> Optional[int]:
+        with self.lock:
+            ring = self.posts.get(post_id)
+            if ring is None or ring.expires_at <= time.monotonic():
+                return None
+            return ring.total
+
+    def start_fill(self) -> int:
+        return self.writes.start()
+
+    def fill(self, post_id: int, comments: List[HotComment], total: int, started: int):
+        with self.lock:
+            if not self.writes.unchanged_since(post_id, started):
+                return
+            self.posts[post_id] = PostRing(
+                comments,
+                self.size,
+                len(comments) < self.size,
+                total,
+                time.monotonic() + self.ttl,
+            )
+            self.posts.move_to_end(post_id)
+            while len(self.posts) > self.max_posts:
+                self.posts.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def add(self, comment: HotComment):
+        with self.lock:
+            self.writes.written(comment.post_id)
+            ring = self.posts.get(comment.post_id)
+            if ring is None:
+                return
+            ring.total += 1
+            if ring.comments and comment.id < ring.comments[0].id:
+                # Out of order (ids from another process's block); reload
+                del self.posts[comment.post_id]
+                return
+            if len(ring.comments) == ring.comments.maxlen:
+                ring.complete = False
+            ring.comments.appendleft(comment)
+
+    def update(self, post_id: int, comment_id: int, content: str):
+        with self.lock:
+            self.writes.written(post_id)
+            ring = self.posts.get(post_id)
+            for comment in ring.comments if ring is not None else ():
+                if comment.id == comment_id:
+                    comment.content = content
+
+    def remove(self, post_id: int, comment_id: int):
+        # Deleted or blocked. The ring is one short afterwards, so it only
+        # serves pages it still covers until it is reloaded.
+        with self.lock:
+            self.writes.written(post_id)
+            ring = self.posts.get(post_id)
+            if ring is None:
+                return
+            ring.total -= 1
+            kept = [comment for comment in ring.comments if comment.id != comment_id]
+            if len(kept) != len(ring.comments):
+                ring.comments = deque(kept, maxlen=self.size)
+
+    def invalidate(self, post_id: int = None):
+        with self.lock:
+            if post_id is None:
+                self.writes.clear()
+                self.posts.clear()
+            else:
+                self.writes.written(post_id)
+                self.posts.pop(post_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"posts": len(self.posts), **self.counters}
+
+
+hot_comments = HotComments()
@@ -1,8 +1,18 @@
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, func
-from sqlalchemy.orm import relationship
-from database import Base
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    DateTime,
+    Boolean,
+    Index,
+    func,
+)
+from sqlalchemy.orm import relationship, synonym
+from database import ArchiveBase, Base
+from posts.compression import CompressedText, compressed_property
 
 
 class User(Base):
@@ -17,20 +27,35 @@ class User(Base):
 
 class Post(Base):
     __tablename__ = "posts"
+    __table_args__ = (
+        Index("ix_posts_user_id_created_at_id", "user_id", "created_at", "id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
-    content = Column(String)
+    _content = Column("content", CompressedText)
+    content = synonym("_content", descriptor=compressed_property("_content"))
     user_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=datetime.utcnow)
 
     user = relationship("User", back_populates="posts")
     comments = relationship("Comment", back_populates="post")
     blocked = Column(Boolean, default=False)
+    comment_count = Column(Integer, default=0, server_default="0")
+    blocked_comment_count = Column(Integer, default=0, server_default="0")
+    last_comment_at = Column(DateTime)
 
 
 class Comment(Base):
     __tablename__ = "comments"
+    __table_args__ = (
+        Index("ix_comments_post_id_id", "post_id", "id"),
+        Index("ix_comments_user_id_created_at_id", "user_id", "created_at", "id"),
+        # Ids of deleted and archived comments are never handed out again
+        {"sqlite_autoincrement": True},
+    )
     id = Column(Integer, primary_key=True, index=True)
-    content = Column(String)
+    _content = Column("content", CompressedText)
+    content = synonym("_content", descriptor=compressed_property("_content"))
     post_id = Column(Integer, ForeignKey("posts.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
     created_at = Column(DateTime, default=func.now())
@@ -38,3 +63,27 @@ class Comment(Base):
 
     post = relationship("Post", back_populates="comments")
     user = relationship("User", back_populates="comments")
+
+
+class TableCount(Base):
+    # Row counts for paginated listings, kept in step by totals.py
+    __tablename__ = "table_counts"
+    name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class ArchivedComment(ArchiveBase):
+    # Visible comments moved out of `comments` by posts/archive.py
+    __tablename__ = "archived_comments"
+    __table_args__ = (
+        Index("ix_archived_comments_post_id_id", "post_id", "id"),
+        {"schema": "archive"},
+    )
+    id = Column(Integer, primary_key=True)
+    _content = Column("content", CompressedText)
+    content = synonym("_content", descriptor=compressed_property("_content"))
+    post_id = Column(Integer)
+    user_id = Column(Integer)
+    created_at = Column(DateTime)
+    archived_at = Column(DateTime)
+    blocked = False
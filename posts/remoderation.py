@@ -0,0 +1,307 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from sqlalchemy import select, update
+
+from cache import cache
+from database import SessionLocal
+from posts import analytics, crud
+from posts.compression import decompress_text
+from posts.hot_comments import hot_comments
+from posts.counters import reconcile_post_counters
+from posts.models import Comment, Post
+from posts.text_moderation import VERDICT_TTL, moderation_client, verdict_key
+from sharding import on_shard, post_shards
+
+logger = logging.getLogger("remoderation")
+
+CHECKPOINT_PATH = os.getenv("REMODERATION_CHECKPOINT", "remoderation.json")
+BATCH_SIZE = 500
+WORKERS = 8
+THROTTLE_SECONDS = 0.05
+
+MODELS = {"posts": Post, "comments": Comment}
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return {}
+
+    def table(self, name: str) -> dict:
+        return self.state.setdefault(
+            name, {"last_id": 0, "scanned": 0, "blocked": 0, "unblocked": 0}
+        )
+
+    def advance(self, name: str, last_id: int, scanned: int, blocked: int, unblocked):
+        with self.lock:
+            progress = self.table(name)
+            progress["last_id"] = last_id
+            progress["scanned"] += scanned
+            progress["blocked"] += blocked
+            progress["unblocked"] += unblocked
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as checkpoint_file:
+                json.dump(self.state, checkpoint_file)
+            os.replace(tmp_path, self.path)
+
+    def reset(self):
+        with self.lock:
+            self.state = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def finish(self):
+        # A completed run leaves nothing to resume; the totals stay in
+        # memory for the status endpoint
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def _text_columns(model):
+    if model is Post:
+        return [Post.title, Post.content]
+    return [Comment.content]
+
+
+class ModerationUnavailable(Exception):
+    pass
+
+
+def _is_toxic(texts: Iterable[Optional[str]]) -> bool:
+    for text in texts:
+        text = decompress_text(text)
+        if not text:
+            continue
+        is_profane, source = moderation_client.contains_profanity(text)
+        if source != "remote":
+            # The wordlist fallback must never overrule the provider's verdicts;
+            # the batch is dropped and the checkpoint stays before it
+            raise ModerationUnavailable("Moderation provider unavailable")
+        # Only the verdicts this run re-checked are refreshed in the cache
+        cache.set("moderation", verdict_key(text), is_profane, VERDICT_TTL)
+        if is_profane:
+            return True
+    return False
+
+
+def remoderate_table(
+    name: str,
+    checkpoint: Checkpoint,
+    executor: ThreadPoolExecutor,
+    batch_size: int = BATCH_SIZE,
+    throttle: float = THROTTLE_SECONDS,
+    stop: threading.Event = None,
+):
+    with SessionLocal() as db:
+        shards = post_shards(db)
+    # Ids only increase within a shard, so each shard keeps its own position
+    for shard_id in shards:
+        progress = name if shard_id is None else f"{name}:{shard_id}"
+        _remoderate_shard(
+            name, progress, shard_id, checkpoint, executor, batch_size, throttle, stop
+        )
+
+
+def _remoderate_shard(
+    name, progress, shard_id, checkpoint, executor, batch_size, throttle, stop
+):
+    model = MODELS[name]
+    columns = _text_columns(model)
+
+    while stop is None or not stop.is_set():
+        last_id = checkpoint.table(progress)["last_id"]
+        # Short read and write transactions per batch keep the write lock free
+        # for live traffic between batches.
+        with SessionLocal() as db:
+            rows = db.execute(
+                on_shard(
+                    select(model.id, model.blocked, *columns)
+                    .where(model.id > last_id)
+                    .order_by(model.id)
+                    .limit(batch_size),
+                    shard_id,
+                )
+            ).all()
+        if not rows:
+            return
+
+        verdicts = list(executor.map(lambda row: _is_toxic(row[2:]), rows))
+        to_block = [
+            row.id for row, toxic in zip(rows, verdicts) if toxic and not row.blocked
+        ]
+        to_unblock = [
+            row.id for row, toxic in zip(rows, verdicts) if not toxic and row.blocked
+        ]
+
+        if to_block or to_unblock:
+            with SessionLocal() as db:
+                if model is Comment:
+                    post_ids = db.execute(
+                        on_shard(
+                            select(Comment.post_id)
+                            .distinct()
+                            .where(Comment.id.in_(to_block + to_unblock)),
+                            shard_id,
+                        )
+                    ).scalars()
+                    post_ids = list(post_ids)
+                if to_block:
+                    db.execute(
+                        on_shard(
+                            update(model)
+                            .where(model.id.in_(to_block))
+                            .values(blocked=True),
+                            shard_id,
+                        )
+                    )
+                if to_unblock:
+                    db.execute(
+                        on_shard(
+                            update(model)
+                            .where(model.id.in_(to_unblock))
+                            .values(blocked=False),
+                            shard_id,
+                        )
+                    )
+                if model is Comment:
+                    reconcile_post_counters(db, post_ids)
+                db.commit()
+                if model is Comment:
+                    for post_id in post_ids:
+                        hot_comments.invalidate(post_id)
+
+        checkpoint.advance(
+            progress, rows[-1].id, len(rows), len(to_block), len(to_unblock)
+        )
+        if throttle:
+            time.sleep(throttle)
+
+
+class RemoderationJob:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop = threading.Event()
+        self.checkpoint = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(
+        self,
+        tables=tuple(MODELS),
+        checkpoint_path: str = CHECKPOINT_PATH,
+        batch_size: int = BATCH_SIZE,
+        workers: int = WORKERS,
+        throttle: float = THROTTLE_SECONDS,
+        restart: bool = False,
+    ):
+        self.checkpoint = Checkpoint(checkpoint_path)
+        if restart:
+            self.checkpoint.reset()
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for name in tables:
+                    remoderate_table(
+                        name, self.checkpoint, executor, batch_size, throttle, self.stop
+                    )
+            # A cancelled or failed run resumes from its checkpoint, a finished
+            # one starts over next time
+            if not self.stop.is_set():
+                self.checkpoint.finish()
+        except Exception as e:
+            self.error = str(e)
+            raise
+        finally:
+            # Batches before a failure were committed
+            analytics.invalidate_column_cache()
+            crud.invalidate_post_documents()
+            self.finished_at = time.time()
+
+    def start(self, **kwargs) -> bool:
+        with self.lock:
+            if self.running:
+                return False
+            self.stop.clear()
+            self.thread = threading.Thread(
+                target=self._run_quietly, kwargs=kwargs, daemon=True
+            )
+            self.thread.start()
+            return True
+
+    def _run_quietly(self, **kwargs):
+        try:
+            self.run(**kwargs)
+        except Exception:
+            # The message is kept in status(); the traceback goes to the log
+            logger.exception("Re-moderation failed")
+
+    def cancel(self):
+        self.stop.set()
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "progress": self.checkpoint.state if self.checkpoint else {},
+        }
+
+
+job = RemoderationJob()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-run moderation over existing posts and comments"
+    )
+    parser.add_argument(
+        "--tables", nargs="+", choices=list(MODELS), default=list(MODELS)
+    )
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--throttle", type=float, default=THROTTLE_SECONDS)
+    parser.add_argument("--restart", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        job.run(
+            tables=args.tables,
+            checkpoint_path=args.checkpoint,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            throttle=args.throttle,
+            restart=args.restart,
+        )
+    except ModerationUnavailable as e:
+        parser.exit(1, f"{e}; rerun to resume from {args.checkpoint}\n")
+    print(json.dumps(job.status()["progress"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,43 @@
+import math
 from datetime import date
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from sqlalchemy.orm import Session
 
 import posts
 from posts import models
 
-from dependencies import get_db
-from posts import schemas, crud
-from posts.crud import get_all_posts, get_comments_data
-from posts.schemas import CommentAnalytics
-from users.crud import get_current_user
+from admission import comment_limiter
+from dependencies import get_analytics_db, get_db
+from posts import schemas, crud, analytics, counters, remoderation
+from posts.crud import get_comments_data
+from posts.text_moderation import moderation_client
+from negotiation import negotiated_response
+from totals import set_total_count, table_total
+from posts.schemas import (
+    BlockedRatePercentiles,
+    CommentAnalytics,
+    HourlyCommentAnalytics,
+    UserCommentDistribution,
+)
+from users.crud import get_current_admin, get_current_user
 
 router = APIRouter()
 
 
+def limit_comment_rate(current_user: models.User = Depends(get_current_user)):
+    if comment_limiter is None:
+        return
+    retry_after = comment_limiter.acquire(current_user.id)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many comments, slow down",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
 @router.post("/posts/", response_model=schemas.PostCreate)
 def create_post(
     post: schemas.PostCreate,
@@ -37,15 +59,58 @@ def get_post_by_id(
     return db_post
 
 
-@router.get("/all_posts/", response_model=List[schemas.Post])
+@router.post("/posts/batch", response_model=schemas.PostBatch)
+def get_posts_batch(
+    batch: schemas.BatchIds,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    items, missing = crud.get_posts_by_ids(db, batch.ids)
+    return {"items": items, "missing": missing}
+
+
+@router.post("/comments/batch", response_model=schemas.CommentBatch)
+def get_comments_batch(
+    batch: schemas.BatchIds,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    items, missing = crud.get_comments_by_ids(db, batch.ids)
+    return {"items": items, "missing": missing}
+
+
+@router.get("/posts/{post_id}/document", response_model=schemas.PostDocument)
+def get_post_document(
+    post_id: int,
+    limit: int = 10,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    document = crud.get_cached_post_document(db, post_id, limit)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return document
+
+
+@router.get(
+    "/all_posts/",
+    response_model=List[schemas.PostFields],
+    response_model_exclude_unset=True,
+)
 def get_posts(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 10,
+    fields: Optional[str] = None,
+    summary: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    posts = get_all_posts(db, skip, limit)
-    return posts
+    selected = crud.parse_fields(fields, crud.POST_FIELDS, crud.DEFAULT_POST_FIELDS)
+    set_total_count(response, table_total(db, "posts"))
+    posts = crud.get_post_listing(db, skip, limit, fields=selected, summary=summary)
+    return negotiated_response(request, posts, headers=response.headers)
 
 
 @router.put("/posts/{post_id}", response_model=schemas.Post)
@@ -94,7 +159,11 @@ def delete_post(
         return {"message": "Post not found"}
 
 
-@router.post("/posts/{post_id}/comments/", response_model=schemas.Comment)
+@router.post(
+    "/posts/{post_id}/comments/",
+    response_model=schemas.Comment,
+    dependencies=[Depends(limit_comment_rate)],
+)
 def create_comment_for_post(
     post_id: int,
     comment: schemas.CommentCreate,
@@ -106,14 +175,28 @@ def create_comment_for_post(
     )
 
 
-@router.get("/posts/{post_id}/all_comments/", response_model=list[schemas.Comment])
+@router.get(
+    "/posts/{post_id}/all_comments/",
+    response_model=list[schemas.CommentFields],
+    response_model_exclude_unset=True,
+)
 def read_comments_for_post(
     post_id: int,
+    request: Request,
+    response: Response,
+    fields: Optional[str] = None,
+    summary: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    db_comments = crud.get_comments_for_post(db, post_id)
-    return db_comments
+    selected = crud.parse_fields(
+        fields, crud.COMMENT_FIELDS, crud.DEFAULT_COMMENT_FIELDS
+    )
+    db_comments = crud.get_comment_listing(
+        db, post_id, fields=selected, summary=summary
+    )
+    set_total_count(response, crud.get_comment_total(db, post_id))
+    return negotiated_response(request, db_comments, headers=response.headers)
 
 
 @router.put("/posts/{post_id}/comments/{comment_id}", response_model=schemas.Comment)
@@ -175,8 +258,125 @@ def delete_comment(
 def get_comments_daily_breakdown(
     date_from: date,
     date_to: date,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_analytics_db),
     current_user: models.User = Depends(get_current_user),
 ):
     comments_data = get_comments_data(date_from, date_to, db)
-    return comments_data
+    return negotiated_response(
+        request,
+        [CommentAnalytics.model_validate(row) for row in comments_data],
+        headers=response.headers,
+    )
+
+
+@router.get(
+    "/api/comments-hourly-breakdown", response_model=List[HourlyCommentAnalytics]
+)
+def get_comments_hourly_breakdown(
+    date_from: date,
+    date_to: date,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_analytics_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    hours = analytics.get_hourly_comments(date_from, date_to, db)
+    return negotiated_response(
+        request,
+        [HourlyCommentAnalytics.model_validate(row) for row in hours],
+        headers=response.headers,
+    )
+
+
+@router.get("/api/comments-per-user", response_model=UserCommentDistribution)
+def get_comments_per_user(
+    date_from: date,
+    date_to: date,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_analytics_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    distribution = analytics.get_user_comment_distribution(date_from, date_to, db)
+    return negotiated_response(
+        request,
+        UserCommentDistribution.model_validate(distribution),
+        headers=response.headers,
+    )
+
+
+@router.get("/api/comments-blocked-rate", response_model=BlockedRatePercentiles)
+def get_comments_blocked_rate(
+    date_from: date,
+    date_to: date,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_analytics_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    rates = analytics.get_blocked_rate_percentiles(date_from, date_to, db)
+    return negotiated_response(
+        request,
+        BlockedRatePercentiles.model_validate(rates),
+        headers=response.headers,
+    )
+
+
+@router.post(
+    "/admin/remoderate",
+    response_model=schemas.RemoderationStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def start_remoderation(
+    request: schemas.RemoderationRequest,
+    current_user: models.User = Depends(get_current_admin),
+):
+    unknown = set(request.tables) - set(remoderation.MODELS)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown tables: {', '.join(sorted(unknown))}"
+        )
+    started = remoderation.job.start(
+        tables=request.tables,
+        batch_size=request.batch_size,
+        workers=request.workers,
+        restart=request.restart,
+    )
+    if not started:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Re-moderation is already running",
+        )
+    return remoderation.job.status()
+
+
+@router.get("/admin/remoderate", response_model=schemas.RemoderationStatus)
+def get_remoderation_status(
+    current_user: models.User = Depends(get_current_admin),
+):
+    return remoderation.job.status()
+
+
+@router.delete("/admin/remoderate", response_model=schemas.RemoderationStatus)
+def cancel_remoderation(
+    current_user: models.User = Depends(get_current_admin),
+):
+    remoderation.job.cancel()
+    return remoderation.job.status()
+
+
+@router.get("/admin/moderation/status", response_model=schemas.ModerationStatus)
+def get_moderation_status(
+    current_user: models.User = Depends(get_current_admin),
+):
+    return moderation_client.state()
+
+
+@router.post("/admin/reconcile-counters", response_model=schemas.ReconcileResult)
+def reconcile_counters(
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_admin),
+):
+    return {"reconciled_posts": counters.reconcile_all(db)}
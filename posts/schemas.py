@@ -1,6 +1,6 @@
-from typing import Optional
+from typing import Dict, List, Optional
 from datetime import date, datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class PostBase(BaseModel):
@@ -22,11 +22,26 @@ class PostUpdate(BaseModel):
 
 class Post(PostBase):
     id: int
+    comment_count: Optional[int] = 0
+    blocked_comment_count: Optional[int] = 0
+    last_comment_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
 
 
+class PostFields(BaseModel):
+    id: int
+    title: Optional[str] = None
+    content: Optional[str] = None
+    preview: Optional[str] = None
+    user_id: Optional[int] = None
+    blocked: Optional[bool] = None
+    comment_count: Optional[int] = None
+    blocked_comment_count: Optional[int] = None
+    last_comment_at: Optional[datetime] = None
+
+
 class CommentBase(BaseModel):
     content: str
     post_id: int
@@ -50,6 +65,40 @@ class Comment(CommentCreate):
         from_attributes = True
 
 
+class CommentWithAuthor(Comment):
+    username: Optional[str] = None
+
+
+class BatchIds(BaseModel):
+    ids: List[int] = Field(max_length=500)
+
+
+class PostBatch(BaseModel):
+    items: List[Post]
+    missing: List[int]
+
+
+class CommentBatch(BaseModel):
+    items: List[Comment]
+    missing: List[int]
+
+
+class PostDocument(Post):
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    comments: List[CommentWithAuthor] = []
+
+
+class CommentFields(BaseModel):
+    id: int
+    content: Optional[str] = None
+    preview: Optional[str] = None
+    post_id: Optional[int] = None
+    user_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    blocked: Optional[bool] = None
+
+
 class CommentAnalytics(BaseModel):
     date: date
     created_comments: int = 0
@@ -57,3 +106,65 @@ class CommentAnalytics(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class HourlyCommentAnalytics(BaseModel):
+    hour: datetime
+    created_comments: int = 0
+    blocked_comments: int = 0
+
+
+class UserCommentCount(BaseModel):
+    user_id: int
+    comments: int
+
+
+class UserCommentDistribution(BaseModel):
+    users: int = 0
+    comments: int = 0
+    mean: float = 0
+    p50: float = 0
+    p90: float = 0
+    p99: float = 0
+    max: int = 0
+    top_users: List[UserCommentCount] = []
+
+
+class BlockedRatePercentiles(BaseModel):
+    posts: int = 0
+    overall_rate: float = 0
+    p50: float = 0
+    p90: float = 0
+    p99: float = 0
+
+
+class RemoderationRequest(BaseModel):
+    tables: List[str] = ["posts", "comments"]
+    batch_size: int = 500
+    workers: int = 8
+    restart: bool = False
+
+
+class RemoderationStatus(BaseModel):
+    running: bool
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    progress: Dict[str, Dict[str, int]] = {}
+
+
+class ModerationStatus(BaseModel):
+    circuit: str
+    consecutive_failures: int
+    retry_budget: float
+    p95_latency: Optional[float] = None
+    hedge_delay: float
+    calls: int
+    hedged: int
+    retries: int
+    failures: int
+    fallbacks: int
+
+
+class ReconcileResult(BaseModel):
+    reconciled_posts: int
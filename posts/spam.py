@@ -0,0 +1,170 @@
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from typing import Optional
+
+import numpy as np
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+BANDS = 16
+SIMILARITY_THRESHOLD = 0.8
+WINDOW_SECONDS = 60 * 60
+MAX_ENTRIES = 50_000
+DUPLICATE_LIMIT = 3
+MAX_DUPLICATE_USERS = 10_000
+
+MERSENNE_PRIME = (1 << 31) - 1
+_random = np.random.default_rng(20240629)
+_a = _random.integers(1, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.int64)
+_b = _random.integers(0, MERSENNE_PRIME, NUM_PERMUTATIONS, dtype=np.int64)
+
+_non_word = re.compile(r"[^\w]+")
+
+
+def _shingles(text: str) -> np.ndarray:
+    normalized = _non_word.sub(" ", text.lower()).strip()
+    if len(normalized) <= SHINGLE_SIZE:
+        grams = {normalized}
+    else:
+        grams = {
+            normalized[i : i + SHINGLE_SIZE]
+            for i in range(len(normalized) - SHINGLE_SIZE + 1)
+        }
+    return np.fromiter(
+        (zlib.crc32(gram.encode()) & MERSENNE_PRIME for gram in grams),
+        np.int64,
+        len(grams),
+    )
+
+
+def minhash(text: str) -> np.ndarray:
+    shingles = _shingles(text)
+    hashes = (np.outer(_a, shingles) + _b[:, None]) % MERSENNE_PRIME
+    return hashes.min(axis=1)
+
+
+class Entry:
+    __slots__ = ("signature", "blocked", "last_seen")
+
+    def __init__(self, signature: np.ndarray, blocked: bool, last_seen: float):
+        self.signature = signature
+        self.blocked = blocked
+        self.last_seen = last_seen
+
+
+class NearDuplicateIndex:
+    # MinHash signatures of recent comments bucketed by LSH bands. Entries
+    # expire WINDOW_SECONDS after they were last matched.
+    def __init__(
+        self,
+        threshold: float = SIMILARITY_THRESHOLD,
+        window: float = WINDOW_SECONDS,
+        max_entries: int = MAX_ENTRIES,
+        duplicate_limit: int = DUPLICATE_LIMIT,
+        max_users: int = MAX_DUPLICATE_USERS,
+    ):
+        self.threshold = threshold
+        self.window = window
+        self.max_entries = max_entries
+        self.duplicate_limit = duplicate_limit
+        self.max_users = max_users
+        self.rows = NUM_PERMUTATIONS // BANDS
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.buckets = defaultdict(set)
+        # Per-user duplicate timestamps, least recently active user first
+        self.duplicates = OrderedDict()
+        self.next_id = 0
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(BANDS):
+            chunk = signature[band * self.rows : (band + 1) * self.rows]
+            yield band, chunk.tobytes()
+
+    def _remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        for key in self._band_keys(entry.signature):
+            bucket = self.buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self.buckets[key]
+
+    def _evict(self, now: float):
+        while self.entries:
+            entry_id, entry = next(iter(self.entries.items()))
+            if now - entry.last_seen < self.window and (
+                len(self.entries) <= self.max_entries
+            ):
+                break
+            self._remove(entry_id)
+
+    def match(self, text: str, now: float = None) -> Optional[Entry]:
+        now = time.time() if now is None else now
+        signature = minhash(text)
+        with self.lock:
+            self._evict(now)
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self.buckets.get(key, set())
+
+            best_id, best_score = None, 0.0
+            for entry_id in candidates:
+                score = np.mean(self.entries[entry_id].signature == signature)
+                if score > best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None or best_score < self.threshold:
+                return None
+
+            entry = self.entries[best_id]
+            entry.last_seen = now
+            self.entries.move_to_end(best_id)
+            return entry
+
+    def add(self, text: str, blocked: bool, now: float = None):
+        now = time.time() if now is None else now
+        signature = minhash(text)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = Entry(signature, blocked, now)
+            for key in self._band_keys(signature):
+                self.buckets[key].add(entry_id)
+            self._evict(now)
+
+    def allow_duplicate(self, user_id: int, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        with self.lock:
+            history = self.duplicates.pop(user_id, None) or deque()
+            while history and now - history[0] >= self.window:
+                history.popleft()
+            allowed = len(history) < self.duplicate_limit
+            if allowed:
+                history.append(now)
+            self.duplicates[user_id] = history
+            self._evict_users(now)
+            return allowed
+
+    def _evict_users(self, now: float):
+        # Users whose newest duplicate is out of the window have nothing left
+        # to limit; past max_users the least recently active go first
+        while self.duplicates:
+            user_id, history = next(iter(self.duplicates.items()))
+            if (
+                history
+                and now - history[-1] < self.window
+                and len(self.duplicates) <= self.max_users
+            ):
+                break
+            del self.duplicates[user_id]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+            self.duplicates.clear()
+
+
+comment_index = NearDuplicateIndex()
@@ -1,26 +1,85 @@
+import asyncio
+import tempfile
+import time
 import unittest
 from datetime import date, datetime
 from unittest.mock import MagicMock, patch
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, event, update
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, sessionmaker
-from fastapi import HTTPException
+import msgpack
+from fastapi import FastAPI, HTTPException, Request, Response
+from httpx import ASGITransport, AsyncClient
 
-from database import Base
-from posts import models, schemas
+from admission import AdmissionMiddleware, AdmissionPool, RateLimiter
+from backfill import run_backfill
+from cache import MemoryCache, SQLiteCache
+from dependencies import get_db
+from database import (
+    Base,
+    attach_archive,
+    statement_cache_stats,
+    track_statement_cache,
+)
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+from launcher import RestartBackoff
+from negotiation import negotiated_response
+from replica import AnalyticsReplica
+from memory_profiling import MemoryProfiler, MemoryProfilingMiddleware
+from monitoring import FirstRequestMiddleware, RuntimeMonitor, StartupTimer
+from posts import (
+    analytics,
+    archive,
+    compression,
+    counters,
+    models,
+    remoderation,
+    schemas,
+)
 from posts.crud import (
+    HOT_STATEMENTS,
     create_post,
     get_post_by_id,
     get_all_posts,
+    get_post_listing,
+    parse_fields,
     update_post_by_id,
     delete_post_by_id,
     create_comment,
     get_comments_for_post,
+    get_post_document,
+    get_cached_post_document,
+    invalidate_post_document,
     update_comment,
     delete_comment_by_id_and_post_id,
     get_comments_data,
+    get_comment_listing,
+    get_comments_by_ids,
+    get_posts_by_ids,
+    DEFAULT_POST_FIELDS,
+    POST_FIELDS,
+    PREVIEW_LENGTH,
 )
+from posts import routers as posts_routers
 from posts.models import Comment
+from posts.spam import NearDuplicateIndex, comment_index
+from posts.text_moderation import (
+    CircuitBreaker,
+    LocalModerator,
+    ModerationClient,
+    check_profanity,
+)
+from users.crud import get_current_user
+from totals import (
+    IndexStats,
+    analyze_sampled,
+    estimated_activity_total,
+    seed_table_counts,
+    table_total,
+    track_table_counts,
+)
+from sharding import RoutedSession, ShardRouter, create_all, create_shard_engines
 
 
 class TestPostFunctions(unittest.TestCase):
@@ -82,7 +141,7 @@ class TestPostFunctions(unittest.TestCase):
         mock_post = models.Post(
             id=post_id, title="Test Post", content="Test content", user_id=1
         )
-        self.mock_db_session.query().filter().first.return_value = mock_post
+        self.mock_db_session.scalars().first.return_value = mock_post
 
         retrieved_post = get_post_by_id(self.mock_db_session, post_id)
 
@@ -101,6 +160,26 @@ class TestPostFunctions(unittest.TestCase):
 
         self.assertEqual(len(all_posts), len(mock_posts))
 
+    def test_get_post_listing_with_fields_and_summary(self):
+        # Test sparse fieldsets and SQL-truncated previews for post listings
+        self.db.add(models.Post(title="Long Post", content="x" * 500, user_id=1))
+        self.db.commit()
+
+        fields = parse_fields("title", POST_FIELDS, DEFAULT_POST_FIELDS)
+        self.assertEqual(fields, ["id", "title"])
+        listing = get_post_listing(self.db, limit=100, fields=fields)
+        self.assertNotIn("content", listing[-1])
+        self.assertEqual(listing[-1]["title"], "Long Post")
+
+        fields = parse_fields(None, POST_FIELDS, DEFAULT_POST_FIELDS)
+        listing = get_post_listing(self.db, limit=100, fields=fields, summary=True)
+        self.assertNotIn("content", listing[-1])
+        self.assertEqual(len(listing[-1]["preview"]), PREVIEW_LENGTH)
+
+        with self.assertRaises(HTTPException) as cm:
+            parse_fields("title,password", POST_FIELDS, DEFAULT_POST_FIELDS)
+        self.assertEqual(cm.exception.status_code, 400)
+
     def test_update_post_by_id(self):
         # Test updating a post by its ID with valid data
         post_id = 1
@@ -110,7 +189,7 @@ class TestPostFunctions(unittest.TestCase):
         mock_post = models.Post(
             id=post_id, title="Test Post", content="Test content", user_id=user_id
         )
-        self.mock_db_session.query().filter().first.return_value = mock_post
+        self.mock_db_session.scalars().first.return_value = mock_post
 
         check_profanity = MagicMock(return_value=(False, ""))
 
@@ -129,7 +208,7 @@ class TestPostFunctions(unittest.TestCase):
         mock_post = models.Post(
             id=post_id, title="Test Post", content="Test content", user_id=1
         )
-        self.mock_db_session.query().filter().first.return_value = mock_post
+        self.mock_db_session.scalars().first.return_value = mock_post
 
         result = delete_post_by_id(self.mock_db_session, post_id)
 
@@ -179,6 +258,50 @@ class TestPostFunctions(unittest.TestCase):
 
         self.assertEqual(cm.exception.status_code, 500)
 
+    def test_near_duplicate_index(self):
+        # Test near-duplicate matching, time-based eviction and duplicate limits
+        index = NearDuplicateIndex(window=60, duplicate_limit=2)
+        index.add("Buy cheap watches at example dot com today!!!", True, now=0)
+
+        match = index.match("buy cheap watches at example dot com today", now=10)
+        self.assertIsNotNone(match)
+        self.assertTrue(match.blocked)
+        self.assertIsNone(index.match("A thoughtful reply about the post", now=10))
+        self.assertIsNone(index.match("Buy cheap watches at example dot com", now=100))
+
+        self.assertTrue(index.allow_duplicate(1, now=0))
+        self.assertTrue(index.allow_duplicate(1, now=1))
+        self.assertFalse(index.allow_duplicate(1, now=2))
+        self.assertTrue(index.allow_duplicate(1, now=70))
+
+        # Expired users are dropped and the number tracked is capped
+        index.max_users = 2
+        index.allow_duplicate(2, now=71)
+        index.allow_duplicate(3, now=72)
+        self.assertEqual(list(index.duplicates), [2, 3])
+        index.allow_duplicate(4, now=200)
+        self.assertEqual(list(index.duplicates), [4])
+
+    def test_create_comment_near_duplicate_of_blocked(self):
+        # Test comments close to a blocked one are blocked without moderation
+        comment_index.clear()
+        comment_index.add("Spam spam spam, visit my profile for prizes", True)
+        comment_data = schemas.CommentCreate(
+            content="spam spam spam - visit my profile for prizes!",
+            created_at=datetime.now(),
+            user_id=1,
+            post_id=1,
+        )
+
+        check_profanity = MagicMock(return_value=(False, ""))
+
+        with patch("posts.crud.check_profanity", check_profanity):
+            with self.assertRaises(HTTPException):
+                create_comment(self.mock_db_session, comment_data, 1, 1)
+
+        check_profanity.assert_not_called()
+        comment_index.clear()
+
     def test_get_comments_for_post(self):
         # Test retrieving comments for a specific post
         post_id = 1
@@ -190,9 +313,7 @@ class TestPostFunctions(unittest.TestCase):
                 id=2, content="Comment 2", user_id=2, post_id=post_id, blocked=False
             ),
         ]
-        self.mock_db_session.query().filter().offset().limit().all.return_value = (
-            mock_comments
-        )
+        self.mock_db_session.scalars().all.return_value = mock_comments
 
         comments_for_post = get_comments_for_post(self.mock_db_session, post_id)
 
@@ -208,7 +329,7 @@ class TestPostFunctions(unittest.TestCase):
         mock_comment = models.Comment(
             id=comment_id, content="Test comment", user_id=1, post_id=1, blocked=False
         )
-        self.mock_db_session.query().filter().first.return_value = mock_comment
+        self.mock_db_session.scalars().first.return_value = mock_comment
 
         check_profanity = MagicMock(return_value=(False, ""))
 
@@ -231,7 +352,7 @@ class TestPostFunctions(unittest.TestCase):
             post_id=post_id,
             blocked=False,
         )
-        self.mock_db_session.query().filter().first.return_value = mock_comment
+        self.mock_db_session.scalars().first.return_value = mock_comment
 
         result = delete_comment_by_id_and_post_id(
             self.mock_db_session, comment_id, post_id
@@ -266,6 +387,1141 @@ class TestPostFunctions(unittest.TestCase):
         self.assertEqual(second_day.created_comments, 1)
         self.assertEqual(second_day.blocked_comments, 0)
 
+    def test_comment_analytics_vectorized(self):
+        # Test hourly, per-user and blocked-rate aggregates computed with NumPy
+        comments = [
+            Comment(
+                created_at=datetime(2023, 7, 1, 9, 15),
+                user_id=1,
+                post_id=1,
+                blocked=False,
+            ),
+            Comment(
+                created_at=datetime(2023, 7, 1, 9, 45),
+                user_id=1,
+                post_id=1,
+                blocked=True,
+            ),
+            Comment(
+                created_at=datetime(2023, 7, 1, 11, 0),
+                user_id=2,
+                post_id=2,
+                blocked=False,
+            ),
+            Comment(
+                created_at=datetime(2023, 7, 3, 0, 0),
+                user_id=3,
+                post_id=2,
+                blocked=False,
+            ),
+        ]
+        self.db.add_all(comments)
+        self.db.commit()
+
+        date_from = date(2023, 7, 1)
+        date_to = date(2023, 7, 1)
+
+        hourly = analytics.get_hourly_comments(date_from, date_to, self.db)
+        self.assertEqual([row.hour.hour for row in hourly], [9, 11])
+        self.assertEqual(hourly[0].created_comments, 1)
+        self.assertEqual(hourly[0].blocked_comments, 1)
+
+        distribution = analytics.get_user_comment_distribution(
+            date_from, date_to, self.db
+        )
+        self.assertEqual(distribution.users, 2)
+        self.assertEqual(distribution.comments, 3)
+        self.assertEqual(distribution.top_users[0].user_id, 1)
+
+        blocked_rate = analytics.get_blocked_rate_percentiles(
+            date_from, date_to, self.db
+        )
+        self.assertEqual(blocked_rate.posts, 2)
+        self.assertAlmostEqual(blocked_rate.overall_rate, 1 / 3)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = analytics.ColumnCache(cache_dir, max_segments=1)
+            cache.refresh(self.db)
+            cached = cache.load(date_from, date_to)
+            self.assertEqual(len(cached), 3)
+            self.assertEqual(int(cached.blocked.sum()), 1)
+
+            # An unlisted segment left by a crash is never read
+            with open(f"{cache_dir}/99.id.bin", "wb") as orphan:
+                orphan.write(b"\0" * 64)
+            self.assertEqual(len(cache.load(date_from, date_to)), 3)
+
+            # Deletes are masked out without touching the cached segments
+            post = models.Post(id=97, title="Doomed", content="Body")
+            comment = Comment(content="gone", post_id=98, user_id=1)
+            orphan = Comment(content="kept", post_id=97, user_id=1)
+            self.db.add_all([post, comment, orphan])
+            self.db.commit()
+            cache.refresh(self.db)
+            self.assertEqual(len(cache._read_meta()["segments"]), 1)
+            segments = cache._read_meta()["segments"]
+            with patch("posts.analytics.column_cache", cache):
+                delete_comment_by_id_and_post_id(self.db, comment.id, 98)
+                delete_post_by_id(self.db, 97)
+            self.assertEqual(cache._read_meta()["segments"], segments)
+            loaded = cache.load()
+            self.assertNotIn(comment.id, loaded.id)
+            self.assertEqual(loaded.post_id[loaded.id == orphan.id].tolist(), [-1])
+
+            # Compaction folds the tombstones into the segments
+            with patch("posts.analytics.MAX_TOMBSTONES", 0):
+                cache.refresh(self.db)
+            self.assertEqual(len(cache._read_tombstones("comments")), 0)
+            compacted = cache.load()
+            self.assertNotIn(comment.id, compacted.id)
+            self.assertEqual(
+                compacted.post_id[compacted.id == orphan.id].tolist(), [-1]
+            )
+
+    def test_compressed_content_round_trip(self):
+        # Test compressed bodies are decompressed on attribute access
+        content = "compressible comment body " * 50
+        compressed = compression.compress_text(content)
+        self.assertTrue(compressed.startswith(compression.MAGIC))
+        self.assertLess(len(compressed), len(content))
+        self.assertEqual(compression.decompress_text(compressed), content)
+
+        comment = models.Comment(content="placeholder")
+        comment._content = compressed
+        self.assertEqual(comment.content, content)
+
+        dictionary = compression.train_dictionary([content] * 3)
+        self.assertIn(b"compressible", dictionary)
+
+    def test_remoderate_table(self):
+        # Test the re-moderation job flags rows in bulk and checkpoints progress
+        comments = [
+            Comment(content="fine words", post_id=99, blocked=True),
+            Comment(content="rude words", post_id=99, blocked=False),
+        ]
+        self.db.add_all(comments)
+        self.db.commit()
+        ids = [comment.id for comment in comments]
+
+        client = MagicMock()
+        client.contains_profanity.side_effect = lambda text: (
+            text.startswith("rude"),
+            "remote",
+        )
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint = remoderation.Checkpoint(f"{checkpoint_dir}/progress.json")
+            checkpoint.table("comments")["last_id"] = ids[0] - 1
+            with patch("posts.remoderation.moderation_client", client), patch(
+                "posts.remoderation.SessionLocal", self.Session
+            ), remoderation.ThreadPoolExecutor(max_workers=2) as executor:
+                remoderation.remoderate_table(
+                    "comments", checkpoint, executor, batch_size=1, throttle=0
+                )
+
+            progress = remoderation.Checkpoint(checkpoint.path).table("comments")
+            self.assertEqual(progress["last_id"], ids[-1])
+            self.assertEqual(progress["blocked"], 1)
+            self.assertEqual(progress["unblocked"], 1)
+
+        self.db.expire_all()
+        self.assertFalse(self.db.get(Comment, ids[0]).blocked)
+        self.assertTrue(self.db.get(Comment, ids[1]).blocked)
+
+    def test_remoderation_never_applies_fallback_verdicts(self):
+        # Test an open breaker stops the run without unblocking anything
+        comment = Comment(content="fine words", post_id=99, blocked=True)
+        self.db.add(comment)
+        self.db.commit()
+
+        client = ModerationClient()
+        client.breaker = CircuitBreaker(threshold=1, reset_timeout=3600)
+        client.breaker.record_failure()
+
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint = remoderation.Checkpoint(f"{checkpoint_dir}/progress.json")
+            checkpoint.table("comments")["last_id"] = comment.id - 1
+            with patch("posts.remoderation.moderation_client", client), patch(
+                "posts.remoderation.SessionLocal", self.Session
+            ), remoderation.ThreadPoolExecutor(max_workers=2) as executor:
+                with self.assertRaises(remoderation.ModerationUnavailable):
+                    remoderation.remoderate_table(
+                        "comments", checkpoint, executor, batch_size=10, throttle=0
+                    )
+            self.assertEqual(checkpoint.table("comments")["last_id"], comment.id - 1)
+
+        self.db.expire_all()
+        self.assertTrue(self.db.get(Comment, comment.id).blocked)
+
+    def test_remoderation_job_starts_over_after_finishing(self):
+        # Test a finished run clears its checkpoint and failures are logged
+        seen = []
+
+        def remoderate_table(name, checkpoint, *args):
+            seen.append(checkpoint.table(name)["last_id"])
+            checkpoint.advance(name, 10, 1, 0, 0)
+
+        job = remoderation.RemoderationJob()
+        with tempfile.TemporaryDirectory() as checkpoint_dir, patch(
+            "posts.remoderation.remoderate_table", remoderate_table
+        ):
+            path = f"{checkpoint_dir}/progress.json"
+            job.run(tables=["comments"], checkpoint_path=path)
+            job.run(tables=["comments"], checkpoint_path=path)
+            self.assertEqual(seen, [0, 0])
+            self.assertEqual(job.status()["progress"]["comments"]["last_id"], 10)
+
+        with patch(
+            "posts.remoderation.remoderate_table", MagicMock(side_effect=OSError("x"))
+        ), self.assertLogs("remoderation", level="ERROR"):
+            job._run_quietly(tables=["comments"], checkpoint_path=path)
+        self.assertEqual(job.status()["error"], "x")
+
+    def test_moderation_falls_back_to_wordlist(self):
+        # Test failed upstream calls fall back to the local wordlist and trip the breaker
+        client = ModerationClient(url="http://127.0.0.1:9/unreachable", deadline=0.5)
+
+        for _ in range(client.breaker.threshold):
+            self.assertEqual(
+                client.contains_profanity("what a bastard"), (True, "local")
+            )
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+        with patch.object(client, "_remote") as remote:
+            self.assertEqual(
+                client.contains_profanity("a friendly comment"), (False, "local")
+            )
+        remote.assert_not_called()
+        self.assertEqual(client.state()["fallbacks"], client.breaker.threshold + 1)
+
+    def test_check_profanity_skips_missing_text(self):
+        # Test a null title is clean instead of crashing the update
+        self.db.add(models.Post(id=4301, title="Title", content="Body", user_id=1))
+        self.db.commit()
+        self.assertEqual(check_profanity(None), (False, ""))
+        self.assertEqual(check_profanity(""), (False, ""))
+        self.assertFalse(LocalModerator().contains_profanity(None))
+
+        with patch(
+            "posts.text_moderation.moderation_client.contains_profanity",
+            return_value=(False, "remote"),
+        ):
+            post = update_post_by_id(
+                self.db, 4301, schemas.PostUpdate(title=None, content="New body"), 1
+            )
+        self.assertIsNone(post.title)
+        self.assertEqual(post.content, "New body")
+
+    def test_circuit_breaker_half_open_probe(self):
+        # Test the breaker lets one probe through after the reset timeout
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_moderation_probe_released_on_unexpected_error(self):
+        # Test an unexpected error during a half-open probe frees the probe
+        client = ModerationClient(deadline=0.5)
+        client.breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        client.breaker.record_failure()
+
+        with patch.object(client, "_remote", side_effect=ValueError("bad")):
+            with self.assertRaises(ValueError):
+                client.contains_profanity("a friendly comment")
+        self.assertTrue(client.breaker.allow())
+
+    def test_moderation_hedge_delay_capped_by_deadline(self):
+        # Test the hedge wait never outlasts the remaining deadline
+        client = ModerationClient(deadline=0.1)
+
+        def slow_request(text, deadline):
+            time.sleep(0.5)
+            return False
+
+        with patch.object(client, "_request", slow_request), patch.object(
+            client, "hedge_delay", return_value=5.0
+        ):
+            started = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                client._remote("text", time.monotonic() + 0.1)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(client.state()["hedged"], 0)
+
+    def test_run_backfill_in_resumable_chunks(self):
+        # Test chunked backfills update matching rows and record a checkpoint
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with engine.connect() as connection:
+            connection.execute(
+                models.Post.__table__.insert(),
+                [{"title": f"Post {i}", "blocked": None} for i in range(25)],
+            )
+            connection.commit()
+
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            table = models.Post.__table__
+            updated = run_backfill(
+                connection,
+                "posts_blocked",
+                table,
+                values={"blocked": False},
+                where=table.c.blocked.is_(None),
+                chunk_size=10,
+                throttle=0,
+            )
+            self.assertEqual(updated, 25)
+
+            rerun = run_backfill(
+                connection,
+                "posts_blocked",
+                table,
+                values={"blocked": True},
+                chunk_size=10,
+                throttle=0,
+            )
+            self.assertEqual(rerun, 25)
+            blocked = connection.execute(
+                table.select().where(table.c.blocked == True)
+            ).all()
+            self.assertEqual(blocked, [])
+
+    def test_post_comment_counters(self):
+        # Test counters follow comment creation, deletion and reconciliation
+        post = models.Post(id=1000, title="Counted", content="Body", user_id=1)
+        self.db.add(post)
+        self.db.commit()
+
+        check_profanity = MagicMock(return_value=(False, ""))
+        with patch("posts.crud.check_profanity", check_profanity):
+            for hour in (10, 12):
+                comment = create_comment(
+                    self.db,
+                    schemas.CommentCreate(
+                        content=f"Counted comment at {hour}",
+                        created_at=datetime(2023, 8, 1, hour),
+                        user_id=1,
+                        post_id=post.id,
+                    ),
+                    1,
+                    post.id,
+                )
+
+        self.db.refresh(post)
+        self.assertEqual(post.comment_count, 2)
+        self.assertEqual(post.last_comment_at, datetime(2023, 8, 1, 12))
+
+        delete_comment_by_id_and_post_id(self.db, comment.id, post.id)
+        self.db.refresh(post)
+        self.assertEqual(post.comment_count, 1)
+        self.assertEqual(post.last_comment_at, datetime(2023, 8, 1, 10))
+
+        post.comment_count = 7
+        post.blocked_comment_count = 3
+        self.db.commit()
+        self.assertEqual(counters.reconcile_post_counters(self.db, [post.id]), 1)
+        self.db.commit()
+        self.db.refresh(post)
+        self.assertEqual((post.comment_count, post.blocked_comment_count), (1, 0))
+
+    def test_get_post_document_query_count(self):
+        # Test the post document loads post, comments and authors in a fixed number of queries
+        author = models.User(username="document_author", hashed_password="x")
+        commenter = models.User(username="document_commenter", hashed_password="x")
+        self.db.add_all([author, commenter])
+        self.db.flush()
+        post = models.Post(id=2000, title="Document", content="Body", user_id=author.id)
+        self.db.add(post)
+        self.db.add_all(
+            [
+                Comment(
+                    content=f"Comment {i}",
+                    post_id=post.id,
+                    user_id=commenter.id,
+                    blocked=i == 3,
+                )
+                for i in range(30)
+            ]
+        )
+        self.db.commit()
+        self.db.expunge_all()
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            document = get_post_document(self.db, 2000, limit=25)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+
+        self.assertLessEqual(len(statements), 3)
+        self.assertEqual(document["username"], "document_author")
+        self.assertEqual(len(document["comments"]), 25)
+        self.assertEqual(document["comments"][0]["content"], "Comment 29")
+        self.assertNotIn("Comment 3", [c["content"] for c in document["comments"]])
+        self.assertEqual(
+            {c["username"] for c in document["comments"]}, {"document_commenter"}
+        )
+        schemas.PostDocument(**document)
+
+    def test_idempotency_key_replays_and_coalesces(self):
+        # Test retried and concurrent POSTs with one Idempotency-Key run the handler once
+        app = FastAPI()
+        calls = []
+
+        @app.post("/posts/")
+        async def create(payload: dict):
+            calls.append(payload)
+            await asyncio.sleep(0.05)
+            return {"id": len(calls)}
+
+        app.add_middleware(IdempotencyMiddleware, store=IdempotencyStore(path=None))
+
+        async def scenario():
+            async with AsyncClient(
+                transport=ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                headers = {"Idempotency-Key": "abc", "Authorization": "Bearer t"}
+                first, second = await asyncio.gather(
+                    client.post("/posts/", json={"title": "a"}, headers=headers),
+                    client.post("/posts/", json={"title": "a"}, headers=headers),
+                )
+                replay = await client.post(
+                    "/posts/", json={"title": "a"}, headers=headers
+                )
+                mismatch = await client.post(
+                    "/posts/", json={"title": "b"}, headers=headers
+                )
+                other_user = await client.post(
+                    "/posts/",
+                    json={"title": "a"},
+                    headers={"Idempotency-Key": "abc", "Authorization": "Bearer u"},
+                )
+                return first, second, replay, mismatch, other_user
+
+        first, second, replay, mismatch, other_user = asyncio.run(scenario())
+
+        self.assertEqual(first.json(), {"id": 1})
+        self.assertEqual(second.json(), {"id": 1})
+        self.assertEqual(replay.json(), {"id": 1})
+        self.assertEqual(replay.headers["idempotent-replayed"], "true")
+        self.assertEqual(mismatch.status_code, 422)
+        self.assertEqual(other_user.json(), {"id": 2})
+        self.assertEqual(len(calls), 2)
+
+    def test_admission_sheds_writes_and_keeps_reads(self):
+        # Test a saturated write pool returns 503 with Retry-After while reads still pass
+        app = FastAPI()
+        release = asyncio.Event()
+
+        @app.post("/posts/")
+        async def create():
+            await release.wait()
+            return {"ok": True}
+
+        @app.get("/all_posts/")
+        async def listing():
+            return []
+
+        pools = {
+            "read": AdmissionPool("read", 2, 2, 0.5),
+            "write": AdmissionPool("write", 1, 1, 0.05),
+            "auth": AdmissionPool("auth", 1, 1, 0.05),
+        }
+        app.add_middleware(AdmissionMiddleware, pools=pools)
+
+        async def scenario():
+            async with AsyncClient(
+                transport=ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                running = asyncio.ensure_future(client.post("/posts/"))
+                await asyncio.sleep(0.01)
+                queued, full = await asyncio.gather(
+                    client.post("/posts/"), client.post("/posts/")
+                )
+                read = await client.get("/all_posts/")
+                release.set()
+                return await running, queued, full, read
+
+        running, queued, full, read = asyncio.run(scenario())
+
+        self.assertEqual(running.status_code, 200)
+        self.assertEqual(queued.status_code, 503)
+        self.assertEqual(full.status_code, 503)
+        self.assertEqual(full.headers["retry-after"], "1")
+        self.assertEqual(read.status_code, 200)
+        self.assertEqual(pools["write"].counters["timed_out"], 1)
+        self.assertEqual(pools["write"].counters["rejected"], 1)
+        self.assertEqual(pools["write"].active, 0)
+
+    def test_comment_rate_limiter_token_bucket(self):
+        # Test per-user buckets allow a burst, then refill at the configured rate
+        now = [0.0]
+        limiter = RateLimiter(rate=0.5, burst=2, clock=lambda: now[0])
+
+        self.assertEqual(limiter.acquire(1), 0)
+        self.assertEqual(limiter.acquire(1), 0)
+        self.assertEqual(limiter.acquire(1), 2.0)
+        self.assertEqual(limiter.acquire(2), 0)
+
+        now[0] = 2.0
+        self.assertEqual(limiter.acquire(1), 0)
+        self.assertGreater(limiter.acquire(1), 0)
+
+    def test_comment_rate_limit_is_opt_in(self):
+        # Test the comment endpoint answers 429 only when a rate is configured
+        app = FastAPI()
+        app.include_router(posts_routers.router)
+        app.dependency_overrides[get_current_user] = lambda: models.User(id=1)
+        body = {
+            "content": "hello",
+            "post_id": 1,
+            "user_id": 1,
+            "created_at": "2026-01-01T00:00:00",
+        }
+
+        async def scenario():
+            async with AsyncClient(
+                transport=ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                return await client.post("/posts/1/comments/", json=body)
+
+        with patch("posts.routers.comment_limiter", RateLimiter(rate=0.5, burst=0)):
+            response = asyncio.run(scenario())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "2")
+
+        with patch("posts.routers.comment_limiter", None):
+            self.assertIsNone(posts_routers.limit_comment_rate(models.User(id=1)))
+
+    def test_restart_backoff_gives_up_on_fast_failures(self):
+        # Test workers dying at startup back off exponentially, then stop
+        now = [100.0]
+        backoff = RestartBackoff(
+            delay=1, max_delay=3, fast=10, max_failures=4, clock=lambda: now[0]
+        )
+        self.assertEqual(backoff.next_delay(99.0), 1)
+        self.assertEqual(backoff.next_delay(99.0), 2)
+        self.assertEqual(backoff.next_delay(99.0), 3)
+        self.assertIsNone(backoff.next_delay(99.0))
+
+        # A worker that served for a while resets the count
+        self.assertEqual(backoff.next_delay(50.0), 0)
+        self.assertEqual(backoff.next_delay(99.0), 1)
+
+    def test_runtime_monitor_detects_loop_stall(self):
+        # Test a blocking call on the event loop is reported with its stack
+        monitor = RuntimeMonitor(
+            threadpool_size=8, probe_interval=0.01, stall_threshold=0.1
+        )
+
+        def block_the_loop():
+            time.sleep(0.4)
+
+        async def scenario():
+            await monitor.start()
+            await asyncio.sleep(0.1)
+            block_the_loop()
+            await asyncio.sleep(0.1)
+            await monitor.stop()
+            return monitor.snapshot()
+
+        snapshot = asyncio.run(scenario())
+
+        self.assertEqual(snapshot["threadpool"]["size"], 8)
+        self.assertIsNotNone(snapshot["threadpool"]["wait_seconds"]["max"])
+        self.assertEqual(snapshot["event_loop"]["stalls"], 1)
+        stall = snapshot["event_loop"]["recent_stalls"][0]
+        self.assertIn("block_the_loop", stall["stack"])
+        self.assertGreaterEqual(stall["duration"], 0.2)
+
+    def test_prebuilt_statements_hit_compiled_cache(self):
+        # Test repeated hot lookups reuse the compiled statement
+        track_statement_cache(self.engine)
+        post = models.Post(title="Cached", content="Body", user_id=1)
+        self.db.add(post)
+        self.db.commit()
+
+        get_post_by_id(self.db, post.id)
+        before = statement_cache_stats()
+        for _ in range(5):
+            self.assertEqual(get_post_by_id(self.db, post.id).title, "Cached")
+        after = statement_cache_stats()
+
+        self.assertEqual(after["hits"] - before["hits"], 5)
+        self.assertEqual(after["misses"], before["misses"])
+
+    def test_sharded_session_routes_by_post_id(self):
+        # Test posts and comments land in the shard of their post and reads scatter-gather
+        with tempfile.TemporaryDirectory() as directory:
+            engines = create_shard_engines(2, directory)
+            create_all(Base.metadata, engines)
+            ShardedSession = sessionmaker(
+                class_=RoutedSession, router=ShardRouter(engines)
+            )
+
+            with ShardedSession() as db:
+                author = models.User(username="sharded_author", hashed_password="x")
+                db.add(author)
+                db.commit()
+                posts = [
+                    models.Post(title=f"Post {i}", content="Body", user_id=author.id)
+                    for i in range(4)
+                ]
+                db.add_all(posts)
+                db.flush()
+                db.add_all(
+                    Comment(
+                        content="Comment",
+                        post_id=post.id,
+                        user_id=author.id,
+                        created_at=datetime(2023, 9, 1, 12),
+                    )
+                    for post in posts
+                )
+                db.commit()
+                post_ids = [post.id for post in posts]
+
+            with ShardedSession() as db:
+                listing = get_post_listing(db, skip=1, limit=2, fields=["id"])
+                self.assertEqual([row["id"] for row in listing], post_ids[1:3])
+                document = get_post_document(db, post_ids[1])
+                self.assertEqual(document["username"], "sharded_author")
+                self.assertEqual(len(document["comments"]), 1)
+                analytics_rows = get_comments_data(
+                    date(2023, 9, 1), date(2023, 9, 1), db
+                )
+                self.assertEqual(analytics_rows[0].created_comments, 4)
+
+            for shard_id in ("shard_0", "shard_1"):
+                with engines[shard_id].connect() as connection:
+                    stored = connection.exec_driver_sql(
+                        "SELECT posts.id FROM posts "
+                        "JOIN comments ON comments.post_id = posts.id"
+                    ).all()
+                self.assertEqual(len(stored), 2)
+                for (post_id,) in stored:
+                    self.assertEqual(f"shard_{post_id % 2}", shard_id)
+            for shard_engine in engines.values():
+                shard_engine.dispose()
+
+    def test_startup_timer_and_hot_statement_warm_up(self):
+        # Test warm-up statements run cleanly and only the first request is timed
+        for statement, params in HOT_STATEMENTS:
+            self.assertEqual(self.db.execute(statement, params).all(), [])
+
+        timer = StartupTimer()
+        with timer.phase("warm_up"):
+            pass
+        app = FastAPI()
+
+        @app.get("/")
+        async def root():
+            return {}
+
+        app.add_middleware(FirstRequestMiddleware, timer=timer)
+
+        async def scenario():
+            async with AsyncClient(
+                transport=ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                await client.get("/")
+                first = dict(timer.first_request)
+                await client.get("/")
+                return first
+
+        first = asyncio.run(scenario())
+
+        self.assertIn("warm_up", timer.snapshot()["phases"])
+        self.assertEqual(timer.first_request, first)
+        self.assertGreaterEqual(first["since_start"], first["latency"])
+
+    def test_sqlite_cache_shared_between_workers(self):
+        # Test an invalidation made by one worker reaches another worker's copy
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = SQLiteCache(f"{cache_dir}/cache.db", local_ttl=0)
+            second = SQLiteCache(f"{cache_dir}/cache.db", local_ttl=0)
+            created_at = datetime(2024, 5, 1, 12, 30)
+            first.set("post_documents", 7, {"created_at": created_at}, ttl=60)
+
+            self.assertEqual(
+                second.get("post_documents", 7),
+                {"created_at": created_at.isoformat()},
+            )
+            self.assertIsNotNone(first.get("post_documents", 7))
+            second.delete("post_documents", 7)
+            self.assertIsNone(first.get("post_documents", 7))
+
+            second.set("moderation", "expired", True, ttl=-1)
+            self.assertIsNone(first.get("moderation", "expired"))
+
+        memory = MemoryCache(max_entries=1)
+        memory.set("users", "a", 1, ttl=60)
+        memory.set("users", "b", 2, ttl=60)
+        self.assertIsNone(memory.get("users", "a"))
+        self.assertEqual(memory.stats()["evictions"], 1)
+
+    def test_post_document_cache_invalidation(self):
+        # Test a write during a document fill is not cached over, and a failing
+        # cache does not fail a saved comment
+        self.db.add(models.Post(id=43001, title="Cached", content="Body"))
+        self.db.commit()
+        local = MemoryCache()
+        real_document = get_post_document
+
+        def document_with_concurrent_write(db, post_id, limit):
+            document = real_document(db, post_id, limit)
+            invalidate_post_document(post_id)
+            return document
+
+        with patch("posts.crud.cache", local), patch(
+            "posts.crud.get_post_document", document_with_concurrent_write
+        ):
+            self.assertEqual(get_cached_post_document(self.db, 43001)["id"], 43001)
+        self.assertIsNone(local.get("post_documents", 43001))
+
+        broken = MagicMock(delete=MagicMock(side_effect=OSError("locked")))
+        with patch("posts.crud.cache", broken), patch(
+            "posts.crud.check_profanity", MagicMock(return_value=(False, ""))
+        ), self.assertLogs("posts", level="WARNING"):
+            comment = create_comment(
+                self.db,
+                schemas.CommentCreate(
+                    content="Saved despite the cache",
+                    post_id=43001,
+                    user_id=1,
+                    created_at=datetime.utcnow(),
+                ),
+                1,
+                43001,
+            )
+        self.assertIsNotNone(self.db.get(Comment, comment.id))
+
+    def test_archive_tiering_and_read_fall_through(self):
+        # Test old comments move to the archive and reads continue into it
+        with tempfile.TemporaryDirectory() as data_dir:
+            engine = create_engine(f"sqlite:///{data_dir}/content.db")
+            attach_archive(engine)
+            Base.metadata.create_all(engine)
+            old = datetime(2020, 1, 1)
+            with Session(engine) as db:
+                db.add(models.Post(id=1, title="Old post", comment_count=4))
+                db.add_all(
+                    [
+                        Comment(id=1, content="first", post_id=1, created_at=old),
+                        Comment(id=2, content="second", post_id=1, created_at=old),
+                        Comment(
+                            id=3,
+                            content="rude",
+                            post_id=1,
+                            created_at=old,
+                            blocked=True,
+                        ),
+                        Comment(id=4, content="third", post_id=1, created_at=old),
+                        Comment(
+                            id=5, content="new", post_id=1, created_at=datetime.utcnow()
+                        ),
+                        # A backdated comment above a recent one stays live
+                        Comment(id=6, content="late", post_id=1, created_at=old),
+                    ]
+                )
+                db.commit()
+
+            result = archive.run_tiering(engine, 30, 30, batch_size=2)
+            self.assertEqual((result["archived"], result["purged"]), (3, 1))
+
+            with patch("posts.crud.ARCHIVE_COMMENTS", True), patch(
+                "posts.counters.ARCHIVE_COMMENTS", True
+            ), Session(engine) as db:
+                page = get_comments_for_post(db, 1, skip=0, limit=3)
+                self.assertEqual([c.content for c in page], ["late", "new", "third"])
+                page = get_comments_for_post(db, 1, skip=3, limit=3)
+                self.assertEqual([c.content for c in page], ["second", "first"])
+
+                db.execute(update(models.Post).values(comment_count=0))
+                counters.reconcile_post_counters(db, [1])
+                self.assertEqual(db.get(models.Post, 1).comment_count, 5)
+
+            # Ids of archived comments are never handed out again
+            with engine.connect() as connection:
+                connection.execute(
+                    archive.archived_comments.insert(), [{"id": 50, "post_id": 1}]
+                )
+                connection.commit()
+                archive.archive_comments(connection, old)
+            with Session(engine) as db:
+                db.execute(delete(Comment).where(Comment.id.in_([5, 6])))
+                comment = Comment(content="later", post_id=1)
+                db.add(comment)
+                db.commit()
+                self.assertEqual(comment.id, 51)
+            engine.dispose()
+
+    def test_archived_comments_reach_the_api(self):
+        # Test the comment listing and post document continue into the archive
+        with tempfile.TemporaryDirectory() as data_dir:
+            engine = create_engine(
+                f"sqlite:///{data_dir}/content.db",
+                connect_args={"check_same_thread": False},
+            )
+            attach_archive(engine)
+            Base.metadata.create_all(engine)
+            old = datetime(2020, 1, 1)
+            with Session(engine) as db:
+                db.add(models.User(id=44001, username="archivist"))
+                db.add(
+                    models.Post(
+                        id=44001, title="Old post", content="Body", comment_count=3
+                    )
+                )
+                db.add_all(
+                    [
+                        Comment(
+                            id=id,
+                            content=content,
+                            post_id=44001,
+                            user_id=44001,
+                            created_at=created_at,
+                        )
+                        for id, content, created_at in [
+                            (1, "first", old),
+                            (2, "second", old),
+                            (3, "new", datetime.utcnow()),
+                        ]
+                    ]
+                )
+                db.commit()
+            archive.run_tiering(engine, 30, 30)
+
+            LocalSession = sessionmaker(bind=engine)
+
+            def get_local_db():
+                with LocalSession() as db:
+                    yield db
+
+            app = FastAPI()
+            app.include_router(posts_routers.router)
+            app.dependency_overrides[get_db] = get_local_db
+            app.dependency_overrides[get_current_user] = lambda: models.User(id=1)
+
+            async def scenario():
+                async with AsyncClient(
+                    transport=ASGITransport(app=app), base_url="http://test"
+                ) as client:
+                    listing = await client.get("/posts/44001/all_comments/")
+                    document = await client.get("/posts/44001/document")
+                    return listing.json(), document.json()
+
+            with patch("posts.crud.ARCHIVE_COMMENTS", True):
+                listing, document = asyncio.run(scenario())
+
+            self.assertEqual(
+                [c["content"] for c in listing], ["new", "second", "first"]
+            )
+            self.assertEqual(
+                [(c["content"], c["username"]) for c in document["comments"]],
+                [("new", "archivist"), ("second", "archivist"), ("first", "archivist")],
+            )
+            engine.dispose()
+
+    def test_table_totals_and_estimates(self):
+        # Test maintained table counts follow flushes and activity totals are estimated
+        with tempfile.TemporaryDirectory() as data_dir:
+            engine = create_engine(f"sqlite:///{data_dir}/content.db")
+            Base.metadata.create_all(engine)
+            LocalSession = sessionmaker(bind=engine)
+            track_table_counts(LocalSession)
+
+            with LocalSession() as db:
+                db.add_all([models.Post(id=1, user_id=1), models.Post(id=2, user_id=1)])
+                db.commit()
+                # Reads count without seeding; startup seeds the missing rows
+                self.assertEqual(table_total(db, "posts"), 2)
+                self.assertEqual(db.query(models.TableCount).count(), 0)
+                self.assertEqual(seed_table_counts(db), {"users": 0, "posts": 2})
+                self.assertEqual(seed_table_counts(db), {})
+
+                db.add(models.Post(id=3, user_id=2))
+                db.commit()
+                db.delete(db.get(models.Post, 1))
+                db.commit()
+                self.assertEqual(table_total(db, "posts"), 2)
+
+                # Two users with three posts and two comments each
+                db.add_all(
+                    [models.Post(id=4, user_id=2)]
+                    + [models.Post(id=5, user_id=1)]
+                    + [models.Post(id=6, user_id=2)]
+                    + [
+                        Comment(id=id, content="c", post_id=2, user_id=1 + id % 2)
+                        for id in range(1, 5)
+                    ]
+                )
+                db.commit()
+
+            stats = IndexStats(engines=[engine])
+            self.assertIsNone(estimated_activity_total(stats))
+            analyze_sampled(engine)
+            stats.invalidate()
+            self.assertEqual(estimated_activity_total(stats), 5)
+            engine.dispose()
+
+    def test_hot_comments_serve_first_page_without_queries(self):
+        # Test the first comment page comes from the ring and follows writes
+        self.db.add(models.Post(id=4600, title="Hot"))
+        self.db.add_all(
+            [Comment(id=46000 + i, content=f"hot {i}", post_id=4600) for i in range(3)]
+        )
+        self.db.commit()
+        self.assertEqual(len(get_comment_listing(self.db, 4600)), 3)
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        check_profanity = MagicMock(return_value=(False, ""))
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            first_page = get_comment_listing(self.db, 4600, summary=True)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])
+        self.assertEqual(first_page[0]["preview"], "hot 2")
+
+        with patch("posts.crud.check_profanity", check_profanity):
+            created = create_comment(
+                self.db,
+                schemas.CommentCreate(
+                    content="hot 3", post_id=4600, user_id=1, created_at=datetime.now()
+                ),
+                user_id=1,
+                post_id=4600,
+            )
+            update_comment(
+                self.db, 46001, schemas.CommentUpdate(content="hot 1 edited")
+            )
+        delete_comment_by_id_and_post_id(self.db, 46000, 4600)
+
+        self.assertEqual(
+            [c["content"] for c in get_comment_listing(self.db, 4600)],
+            ["hot 3", "hot 2", "hot 1 edited"],
+        )
+        self.assertEqual(created.post_id, 4600)
+
+    def test_hot_comments_endpoint_serves_total_without_queries(self):
+        # Test the hot first page and its X-Total-Count come without a query
+        with tempfile.TemporaryDirectory() as data_dir:
+            engine = create_engine(
+                f"sqlite:///{data_dir}/content.db",
+                connect_args={"check_same_thread": False},
+            )
+            Base.metadata.create_all(engine)
+            with Session(engine) as db:
+                db.add(
+                    models.Post(id=4610, title="Hot", content="Body", comment_count=2)
+                )
+                db.add_all(
+                    [
+                        Comment(id=46100 + i, content=f"hot {i}", post_id=4610)
+                        for i in range(2)
+                    ]
+                )
+                db.commit()
+
+            LocalSession = sessionmaker(bind=engine)
+
+            def get_local_db():
+                with LocalSession() as db:
+                    yield db
+
+            app = FastAPI()
+            app.include_router(posts_routers.router)
+            app.dependency_overrides[get_db] = get_local_db
+            app.dependency_overrides[get_current_user] = lambda: models.User(id=1)
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            async def scenario():
+                async with AsyncClient(
+                    transport=ASGITransport(app=app), base_url="http://test"
+                ) as client:
+                    await client.get("/posts/4610/all_comments/")
+                    event.listen(engine, "before_cursor_execute", count)
+                    try:
+                        return await client.get("/posts/4610/all_comments/")
+                    finally:
+                        event.remove(engine, "before_cursor_execute", count)
+
+            response = asyncio.run(scenario())
+            self.assertEqual(statements, [])
+            self.assertEqual(response.headers["X-Total-Count"], "2")
+            self.assertEqual(
+                [c["content"] for c in response.json()], ["hot 1", "hot 0"]
+            )
+            engine.dispose()
+
+    def test_batch_lookups_keep_order_and_report_missing(self):
+        # Test batch lookups use one IN query, keep request order and list missing ids
+        self.db.add_all(
+            [
+                models.Post(id=4700 + i, title=f"Batch {i}", content="Body")
+                for i in range(3)
+            ]
+        )
+        self.db.add_all(
+            [
+                Comment(id=47000, content="shown", post_id=4700),
+                Comment(id=47001, content="hidden", post_id=4700, blocked=True),
+            ]
+        )
+        self.db.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count)
+        try:
+            posts, missing = get_posts_by_ids(self.db, [4702, 4799, 4700, 4702])
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([post.id for post in posts], [4702, 4700])
+        self.assertEqual(missing, [4799])
+
+        comments, missing = get_comments_by_ids(self.db, [47001, 47000])
+        self.assertEqual([comment.id for comment in comments], [47000])
+        self.assertEqual(missing, [47001])
+
+    def test_negotiated_response_formats_and_compression(self):
+        # Test msgpack and gzip are negotiated and small bodies stay plain JSON
+        app = FastAPI()
+        items = [
+            {"id": i, "content": "word " * 20, "created_at": datetime(2024, 1, 1)}
+            for i in range(300)
+        ]
+
+        @app.get("/items")
+        def listing(request: Request, response: Response, count: int = 300):
+            response.headers["X-Total-Count"] = "300"
+            return negotiated_response(request, items[:count], headers=response.headers)
+
+        async def scenario():
+            async with AsyncClient(
+                transport=ASGITransport(app=app), base_url="http://test"
+            ) as client:
+                packed = await client.get(
+                    "/items",
+                    headers={
+                        "Accept": "application/msgpack",
+                        "Accept-Encoding": "gzip",
+                    },
+                )
+                small = await client.get(
+                    "/items?count=1", headers={"Accept-Encoding": "gzip"}
+                )
+                return packed, small
+
+        packed, small = asyncio.run(scenario())
+
+        self.assertEqual(packed.headers["content-type"], "application/msgpack")
+        self.assertEqual(packed.headers["content-encoding"], "gzip")
+        self.assertEqual(packed.headers["x-total-count"], "300")
+        decoded = msgpack.unpackb(packed.content)
+        self.assertEqual(len(decoded), 300)
+        self.assertEqual(decoded[5]["created_at"], "2024-01-01T00:00:00")
+
+        self.assertNotIn("content-encoding", small.headers)
+        self.assertEqual(small.json()[0]["id"], 0)
+
+    def test_analytics_replica_snapshots_primary(self):
+        # Test the replica serves a read-only snapshot until it is refreshed
+        with tempfile.TemporaryDirectory() as directory:
+            primary = create_engine(f"sqlite:///{directory}/content.db")
+            Base.metadata.create_all(primary)
+            with primary.begin() as connection:
+                connection.execute(
+                    Comment.__table__.insert(), [{"id": 48000, "post_id": 1}]
+                )
+            replica = AnalyticsReplica(primary, f"{directory}/analytics.db", 60)
+
+            replica.ensure_fresh()
+            with primary.begin() as connection:
+                connection.execute(
+                    Comment.__table__.insert(), [{"id": 48001, "post_id": 1}]
+                )
+            with replica.SessionLocal() as db:
+                self.assertEqual(db.query(Comment).count(), 1)
+                with self.assertRaises(OperationalError):
+                    db.execute(delete(Comment))
+
+            replica.refresh()
+            with replica.SessionLocal() as db:
+                self.assertEqual(db.query(Comment).count(), 2)
+            response = Response()
+            replica.set_freshness(response)
+            self.assertEqual(response.headers["X-Data-Age"], "0")
+            self.assertIn("X-Data-As-Of", response.headers)
+
+            with patch.object(
+                replica, "refresh", side_effect=OSError("disk full")
+            ), self.assertLogs("replica", level="WARNING"):
+                replica.refreshing = True
+                replica._refresh_in_background()
+            self.assertFalse(replica.refreshing)
+            replica.engine.dispose()
+            primary.dispose()
+
+    def test_memory_profiler_records_route_peaks(self):
+        # Test sampled requests record their peak and snapshots diff by site
+        profiler = MemoryProfiler(enabled=True, sample_rate=1.0, snapshot_interval=0)
+        app = FastAPI()
+        app.add_middleware(MemoryProfilingMiddleware, profiler=profiler)
+        kept = []
+
+        @app.get("/items/{count}")
+        def listing(count: int):
+            items = [bytes(1024) for _ in range(count)]
+            kept.append(items[:10])
+            return {"count": len(items)}
+
+        async def scenario():
+            await profiler.start()
+            try:
+                async with AsyncClient(
+                    transport=ASGITransport(app=app), base_url="http://test"
+                ) as client:
+                    profiler.diff_snapshot()
+                    await client.get("/items/2000")
+                    await client.get("/missing")
+                    diff = profiler.diff_snapshot()
+                    return diff, profiler.report(5)
+            finally:
+                await profiler.stop()
+
+        diff, report = asyncio.run(scenario())
+
+        route = report["routes"]["GET /items/{count}"]
+        self.assertEqual(route["samples"], 1)
+        self.assertGreater(route["max_peak_kib"], 2000)
+        self.assertIn("GET <unmatched>", report["routes"])
+        self.assertEqual(len(report["top_sites"]), 5)
+        self.assertTrue(any(entry["size_diff_kib"] > 0 for entry in diff))
+        with tempfile.TemporaryDirectory() as directory:
+            profiler.snapshot_dir = directory
+            with open(profiler._write_diff(diff)) as diff_file:
+                self.assertIn("KiB", diff_file.read())
+
 
 if __name__ == "__main__":
     unittest.main()
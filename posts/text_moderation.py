@@ -1,19 +1,280 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+
 import requests
-from fastapi import HTTPException
+
+from cache import cache
+
+API_URL = "https://www.purgomalum.com/service/containsprofanity"
+WORDLIST_PATH = os.getenv(
+    "MODERATION_WORDLIST", os.path.join(os.path.dirname(__file__), "wordlist.txt")
+)
+CALL_DEADLINE = float(os.getenv("MODERATION_DEADLINE", "2.0"))
+DEFAULT_HEDGE_DELAY = 0.5
+MIN_HEDGE_DELAY = 0.05
+LATENCY_SAMPLES = 200
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MAX = 10.0
+MAX_RETRIES = 1
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+MAX_WORKERS = 32
+# Remote verdicts are shared by all workers; wordlist fallbacks are not cached
+VERDICT_TTL = float(os.getenv("MODERATION_CACHE_TTL", "86400"))
+
+PROFANE_MESSAGE = "Content contains profanity or inappropriate language."
+CLEAN_MESSAGE = "Content is clean."
+
+_word = re.compile(r"[a-z]+")
 
 
-def check_profanity(text: str) -> (bool, str):
+def load_wordlist(path: str = WORDLIST_PATH) -> frozenset:
     try:
-        url = "https://www.purgomalum.com/service/containsprofanity"
-        params = {"text": text}
-        response = requests.get(url, params=params)
+        with open(path) as wordlist_file:
+            return frozenset(
+                line.strip().lower() for line in wordlist_file if line.strip()
+            )
+    except FileNotFoundError:
+        return frozenset()
+
+
+class LocalModerator:
+    def __init__(self, path: str = WORDLIST_PATH):
+        self.path = path
+        self._words = None
+
+    @property
+    def words(self) -> frozenset:
+        if self._words is None:
+            self._words = load_wordlist(self.path)
+        return self._words
+
+    def contains_profanity(self, text: Optional[str]) -> bool:
+        if not text:
+            return False
+        return any(word in self.words for word in _word.findall(text.lower()))
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            # Half-open lets a single probe call through
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # Frees a probe that ended without a recorded outcome
+        with self.lock:
+            self.probing = False
+
+
+class RetryBudget:
+    # Every call earns a fraction of a retry, so retries (and hedges) stay a
+    # bounded share of upstream traffic when it is failing.
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, maximum=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
 
-        if response.text.strip().lower() == "true":
-            return True, "Content contains profanity or inappropriate language."
 
-        return False, "Content is clean."
+class LatencyTracker:
+    def __init__(self, samples: int = LATENCY_SAMPLES):
+        self.samples = deque(maxlen=samples)
+        self.lock = threading.Lock()
 
-    except requests.RequestException as e:
-        raise HTTPException(
-            status_code=500, detail=f"Error connecting to PurgoMalum API: {str(e)}"
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent: float):
+        with self.lock:
+            if len(self.samples) < 20:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class ModerationClient:
+    def __init__(self, url: str = API_URL, deadline: float = CALL_DEADLINE):
+        self.url = url
+        self.deadline = deadline
+        self.http = requests.Session()
+        self.executor = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix="moderation"
+        )
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self.latency = LatencyTracker()
+        self.local = LocalModerator()
+        self.counters = {
+            "calls": 0,
+            "hedged": 0,
+            "retries": 0,
+            "failures": 0,
+            "fallbacks": 0,
+        }
+        self.counters_lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self.counters_lock:
+            self.counters[name] += 1
+
+    def _request(self, text: str, deadline: float) -> bool:
+        started = time.monotonic()
+        response = self.http.get(
+            self.url,
+            params={"text": text},
+            timeout=max(deadline - started, 0.001),
         )
+        response.raise_for_status()
+        self.latency.record(time.monotonic() - started)
+        return response.text.strip().lower() == "true"
+
+    def hedge_delay(self) -> float:
+        p95 = self.latency.percentile(95)
+        if p95 is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(p95, MIN_HEDGE_DELAY)
+
+    def _remote(self, text: str, deadline: float) -> bool:
+        pending = {self.executor.submit(self._request, text, deadline)}
+        # The hedge delay counts against the caller's deadline
+        remaining = max(deadline - time.monotonic(), 0)
+        done, pending = wait(pending, timeout=min(self.hedge_delay(), remaining))
+        if not done and time.monotonic() < deadline and self.budget.try_spend():
+            self._count("hedged")
+            pending.add(self.executor.submit(self._request, text, deadline))
+
+        error = None
+        while done or pending:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(
+                pending, timeout=remaining, return_when=FIRST_COMPLETED
+            )
+        raise error or TimeoutError("Moderation deadline exceeded")
+
+    def contains_profanity(self, text: str) -> (bool, str):
+        self._count("calls")
+        self.budget.deposit()
+
+        if self.breaker.allow():
+            deadline = time.monotonic() + self.deadline
+            try:
+                for attempt in range(MAX_RETRIES + 1):
+                    try:
+                        result = self._remote(text, deadline)
+                        self.breaker.record_success()
+                        return result, "remote"
+                    except (requests.RequestException, TimeoutError):
+                        self._count("failures")
+                        if (
+                            attempt == MAX_RETRIES
+                            or time.monotonic() >= deadline
+                            or not self.budget.try_spend()
+                        ):
+                            self.breaker.record_failure()
+                            break
+                        self._count("retries")
+            finally:
+                # An unexpected error must not leave a half-open probe pending
+                self.breaker.release()
+
+        self._count("fallbacks")
+        return self.local.contains_profanity(text), "local"
+
+    def state(self) -> dict:
+        with self.counters_lock:
+            counters = dict(self.counters)
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "retry_budget": round(self.budget.tokens, 2),
+            "p95_latency": self.latency.percentile(95),
+            "hedge_delay": self.hedge_delay(),
+            **counters,
+        }
+
+
+moderation_client = ModerationClient()
+
+
+def verdict_key(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def check_profanity(text: Optional[str]) -> (bool, str):
+    # Optional fields such as PostUpdate.title arrive as None
+    if not text:
+        return False, ""
+    key = verdict_key(text)
+    is_profane = cache.get("moderation", key)
+    if is_profane is None:
+        is_profane, source = moderation_client.contains_profanity(text)
+        if source == "remote":
+            cache.set("moderation", key, is_profane, VERDICT_TTL)
+    if is_profane:
+        return True, PROFANE_MESSAGE
+
+    return False, CLEAN_MESSAGE
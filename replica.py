@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from fastapi import Response
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from sharding import SHARD_COUNT
+
+logger = logging.getLogger("replica")
+
+# Snapshot file the analytics endpoints read from; unset keeps them on the primary
+ANALYTICS_REPLICA_PATH = os.getenv("ANALYTICS_REPLICA_PATH")
+# Seconds a snapshot is served before a refresh starts in the background
+ANALYTICS_REPLICA_INTERVAL = float(os.getenv("ANALYTICS_REPLICA_INTERVAL", "300"))
+# Pages copied per backup step when the primary is not in WAL mode
+BACKUP_PAGES = 1024
+BACKUP_SLEEP = 0.005
+
+
+class AnalyticsReplica:
+    # A copy of the primary's main file made with the SQLite online backup
+    # API. The copy is written to a temporary file and moved over the
+    # previous snapshot, so readers never see a half-written file; sessions
+    # still open on the old snapshot keep reading it until they close.
+    def __init__(self, source_engine, path: str, interval: float):
+        self.source_engine = source_engine
+        self.path = path
+        self.interval = interval
+        self.engine = create_engine(
+            f"sqlite:///file:{os.path.abspath(path)}?mode=ro&uri=true",
+            connect_args={"check_same_thread": False},
+        )
+        self.SessionLocal = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine
+        )
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.counters = {"refreshes": 0, "failures": 0}
+
+    def refreshed_at(self):
+        # The file's mtime, so a snapshot taken by another worker counts too
+        try:
+            return os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        target = None
+        try:
+            with self.source_engine.connect() as connection:
+                source = connection.connection.driver_connection
+                wal = source.execute("PRAGMA main.journal_mode").fetchone()[0] == "wal"
+                target = sqlite3.connect(tmp_path)
+                # In WAL mode the copy is one read transaction that never
+                # blocks writers. Otherwise copy in steps so writers get the
+                # lock in between; a write restarts the copy.
+                source.backup(
+                    target,
+                    pages=-1 if wal else BACKUP_PAGES,
+                    sleep=BACKUP_SLEEP,
+                )
+                target.close()
+                target = None
+            os.replace(tmp_path, self.path)
+            # Pooled connections still point at the replaced file
+            self.engine.dispose()
+            self.counters["refreshes"] += 1
+        except Exception:
+            self.counters["failures"] += 1
+            raise
+        finally:
+            if target is not None:
+                target.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            # The old snapshot keeps serving; the next stale read retries
+            logger.warning("Analytics replica refresh failed", exc_info=True)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def ensure_fresh(self):
+        # The first snapshot is taken inline; after that a stale snapshot is
+        # served while a new one is copied
+        refreshed_at = self.refreshed_at()
+        if refreshed_at is None:
+            with self.lock:
+                if self.refreshed_at() is None:
+                    self.refresh()
+            return
+        if time.time() - refreshed_at < self.interval:
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def set_freshness(self, response: Response):
+        refreshed_at = self.refreshed_at()
+        if refreshed_at is None:
+            return
+        response.headers["X-Data-As-Of"] = datetime.fromtimestamp(
+            refreshed_at, timezone.utc
+        ).isoformat(timespec="seconds")
+        response.headers["X-Data-Age"] = str(int(time.time() - refreshed_at))
+
+    def stats(self) -> dict:
+        refreshed_at = self.refreshed_at()
+        return {
+            "age": None if refreshed_at is None else round(time.time() - refreshed_at),
+            "refreshing": self.refreshing,
+            **self.counters,
+        }
+
+
+def create_replica():
+    # Sharded analytics already run on every shard file; a single snapshot
+    # would only cover the global one
+    if not ANALYTICS_REPLICA_PATH or SHARD_COUNT:
+        return None
+    from database import engine
+
+    return AnalyticsReplica(engine, ANALYTICS_REPLICA_PATH, ANALYTICS_REPLICA_INTERVAL)
+
+
+analytics_replica = create_replica()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the analytics replica")
+    parser.parse_args()
+    if analytics_replica is None:
+        parser.error("set ANALYTICS_REPLICA_PATH (not supported with SHARD_COUNT)")
+    analytics_replica.refresh()
+    print(f"{analytics_replica.path}: {analytics_replica.stats()}")
+
+
+if __name__ == "__main__":
+    main()
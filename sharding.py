@@ -0,0 +1,270 @@
+import os
+import threading
+from collections import defaultdict
+from typing import List, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.horizontal_shard import ShardedSession, set_shard_id
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_DIR = os.getenv("SHARD_DIR", ".")
+# Ids reserved from the global sequence per round trip
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "100"))
+
+GLOBAL_SHARD = "global"
+POST_TABLES = ("posts", "comments", "archived_comments")
+# Columns whose value decides the shard of a posts/comments statement
+ROUTING_COLUMNS = {
+    ("posts", "id"),
+    ("comments", "post_id"),
+    ("archived_comments", "post_id"),
+}
+
+
+def shard_path(shard_id: str, directory: str = SHARD_DIR) -> str:
+    if shard_id == GLOBAL_SHARD:
+        return os.path.join(directory, "content.db")
+    return os.path.join(directory, f"content_{shard_id}.db")
+
+
+def create_shard_engines(
+    count: int = SHARD_COUNT, directory: str = SHARD_DIR, **engine_kwargs
+) -> dict:
+    # Users live in the global file, posts and comments in `count` shard
+    # files. Every shard connection attaches the global file behind a temp
+    # view (temp is searched before main), so joins from posts and comments
+    # to users still run inside one statement.
+    global_path = shard_path(GLOBAL_SHARD, directory)
+    engines = {
+        GLOBAL_SHARD: create_engine(
+            f"sqlite:///{global_path}",
+            connect_args={"check_same_thread": False},
+            **engine_kwargs,
+        )
+    }
+    for index in range(count):
+        shard_id = f"shard_{index}"
+        shard_engine = create_engine(
+            f"sqlite:///{shard_path(shard_id, directory)}",
+            connect_args={"check_same_thread": False},
+            **engine_kwargs,
+        )
+
+        @event.listens_for(shard_engine, "connect")
+        def attach_global(dbapi_connection, connection_record):
+            dbapi_connection.execute("ATTACH DATABASE ? AS global", (global_path,))
+            dbapi_connection.execute(
+                "CREATE TEMP VIEW IF NOT EXISTS users AS SELECT * FROM global.users"
+            )
+
+        engines[shard_id] = shard_engine
+    return engines
+
+
+def create_all(metadata, engines: dict):
+    tables = [table for table in metadata.sorted_tables]
+    global_tables = [table for table in tables if table.name not in POST_TABLES]
+    shard_tables = [table for table in tables if table.name in POST_TABLES]
+    metadata.create_all(engines[GLOBAL_SHARD], tables=global_tables)
+    for shard_id, shard_engine in engines.items():
+        if shard_id != GLOBAL_SHARD:
+            metadata.create_all(shard_engine, tables=shard_tables)
+
+
+class IdAllocator:
+    # Post and comment ids come from a sequence table in the global file so
+    # they stay unique across shards. Each round trip reserves a block, which
+    # keeps the global write lock out of the per-insert path; ids are
+    # therefore increasing per process, not across processes.
+    def __init__(self, engines: dict, block_size: int = ID_BLOCK_SIZE):
+        self.engines = engines
+        self.block_size = block_size
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def _initial_id(self, table: str) -> int:
+        highest = 0
+        for shard_id, shard_engine in self.engines.items():
+            if shard_id == GLOBAL_SHARD:
+                continue
+            with shard_engine.connect() as connection:
+                highest = max(
+                    highest,
+                    connection.exec_driver_sql(
+                        f"SELECT coalesce(max(id), 0) FROM {table}"
+                    ).scalar(),
+                )
+        return highest + 1
+
+    def _reserve(self, table: str, count: int) -> int:
+        with self.engines[GLOBAL_SHARD].begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE IF NOT EXISTS id_sequences "
+                "(name VARCHAR PRIMARY KEY, next_id INTEGER NOT NULL)"
+            )
+            exists = connection.exec_driver_sql(
+                "SELECT 1 FROM id_sequences WHERE name = ?", (table,)
+            ).scalar()
+            if not exists:
+                connection.exec_driver_sql(
+                    "INSERT INTO id_sequences (name, next_id) VALUES (?, ?)",
+                    (table, self._initial_id(table)),
+                )
+            end = connection.exec_driver_sql(
+                "UPDATE id_sequences SET next_id = next_id + ? WHERE name = ? "
+                "RETURNING next_id",
+                (count, table),
+            ).scalar()
+        return end - count
+
+    def allocate(self, table: str, count: int) -> List[int]:
+        ids = []
+        with self.lock:
+            while len(ids) < count:
+                next_id, end = self.blocks.get(table, (0, 0))
+                if next_id >= end:
+                    size = max(self.block_size, count - len(ids))
+                    next_id = self._reserve(table, size)
+                    end = next_id + size
+                taken = min(end - next_id, count - len(ids))
+                ids.extend(range(next_id, next_id + taken))
+                self.blocks[table] = (next_id + taken, end)
+        return ids
+
+    def advance(self, table: str, next_id: int):
+        # Used by bulk loaders that write ids directly
+        with self.lock:
+            self._reserve(table, 0)
+            with self.engines[GLOBAL_SHARD].begin() as connection:
+                connection.exec_driver_sql(
+                    "UPDATE id_sequences SET next_id = max(next_id, ?) WHERE name = ?",
+                    (next_id, table),
+                )
+            self.blocks.pop(table, None)
+
+
+class ShardRouter:
+    def __init__(self, engines: dict, allocator: IdAllocator = None):
+        self.engines = engines
+        self.post_shards = [
+            shard_id for shard_id in engines if shard_id != GLOBAL_SHARD
+        ]
+        self.allocator = allocator or IdAllocator(engines)
+
+    def shard_for_post(self, post_id: int) -> str:
+        # Ids are allocated sequentially, so the modulo spreads them evenly
+        return self.post_shards[int(post_id) % len(self.post_shards)]
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        table = mapper.local_table.name if mapper is not None else None
+        if table not in POST_TABLES:
+            return GLOBAL_SHARD
+        if instance is None:
+            return self.post_shards[0]
+        if table == "posts":
+            return self.shard_for_post(instance.id)
+        return self.shard_for_post(instance.post_id)
+
+    def identity_chooser(self, mapper, primary_key, *, lazy_loaded_from, **kw):
+        table = mapper.local_table.name
+        if table not in POST_TABLES:
+            return [GLOBAL_SHARD]
+        if table == "posts":
+            return [self.shard_for_post(primary_key[0])]
+        if lazy_loaded_from is not None and lazy_loaded_from.identity_token:
+            return [lazy_loaded_from.identity_token]
+        return self.post_shards
+
+    def execute_chooser(self, orm_context):
+        mapper = orm_context.bind_mapper
+        if mapper is None or mapper.local_table.name not in POST_TABLES:
+            return [GLOBAL_SHARD]
+
+        post_ids = _routing_values(
+            getattr(orm_context.statement, "whereclause", None),
+            orm_context.parameters,
+        )
+        if post_ids is None:
+            return self.post_shards
+        return sorted({self.shard_for_post(post_id) for post_id in post_ids})
+
+    def assign_ids(self, session, flush_context, instances):
+        pending = defaultdict(list)
+        for instance in session.new:
+            table = getattr(instance, "__tablename__", None)
+            if table in POST_TABLES and instance.id is None:
+                pending[table].append(instance)
+        # Posts first, so comments added with their post get its shard
+        for table in POST_TABLES:
+            if pending[table]:
+                ids = self.allocator.allocate(table, len(pending[table]))
+                for instance, allocated in zip(pending[table], ids):
+                    instance.id = allocated
+
+
+def _bind_value(bind: BindParameter, parameters):
+    if bind.callable is not None or bind.value is not None:
+        return bind.effective_value
+    if isinstance(parameters, dict):
+        return parameters.get(bind.key)
+    return None
+
+
+def _routing_values(clause, parameters) -> Optional[set]:
+    # Post ids pinned by the top-level AND of the WHERE clause, or None when
+    # the statement may touch any shard
+    if clause is None:
+        return None
+    if isinstance(clause, BooleanClauseList) and clause.operator is operators.and_:
+        for criterion in clause.clauses:
+            values = _routing_values(criterion, parameters)
+            if values is not None:
+                return values
+        return None
+    if not isinstance(clause, BinaryExpression):
+        return None
+
+    column, bind = clause.left, clause.right
+    table = getattr(column, "table", None)
+    key = (getattr(table, "name", None), getattr(column, "name", None))
+    if key not in ROUTING_COLUMNS:
+        return None
+    if not isinstance(bind, BindParameter):
+        return None
+    value = _bind_value(bind, parameters)
+    if value is None:
+        return None
+    if clause.operator is operators.eq:
+        return {value}
+    if clause.operator is operators.in_op:
+        return set(value)
+    return None
+
+
+class RoutedSession(ShardedSession):
+    def __init__(self, router: ShardRouter, **kwargs):
+        self.router = router
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            shards=router.engines,
+            **kwargs,
+        )
+        event.listen(self, "before_flush", router.assign_ids)
+
+
+def post_shards(db) -> List[Optional[str]]:
+    # The shards holding posts and comments; [None] for an unsharded session
+    if isinstance(db, RoutedSession):
+        return db.router.post_shards
+    return [None]
+
+
+def on_shard(statement, shard_id: Optional[str]):
+    # Pins a select/update (or legacy Query) to one shard
+    if shard_id is None:
+        return statement
+    return statement.options(set_shard_id(shard_id))
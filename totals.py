@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from collections import Counter
+from typing import Iterable, Optional
+
+from fastapi import Response
+from sqlalchemy import event, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from database import SessionLocal, post_engines
+from posts.models import Post, TableCount, User
+
+COUNTED_TABLES = {"users": User, "posts": Post}
+# ANALYZE reads this many rows per index instead of all of them, which is
+# enough for the query planner
+ANALYSIS_LIMIT = int(os.getenv("ANALYSIS_LIMIT", "1000"))
+STATS_TTL = 300.0
+
+
+def track_table_counts(target):
+    # Applies the rows a flush inserted and deleted to table_counts. Unsharded,
+    # that is the same transaction as the rows themselves. Sharded,
+    # table_counts lives in the global file and commits separately from the
+    # shard holding the posts, so a crash between the two commits leaves the
+    # counter off. Bulk statements that bypass the unit of work are not seen
+    # either; reconcile_table_counts fixes both kinds of drift.
+    @event.listens_for(target, "after_flush")
+    def count_rows(session, flush_context):
+        deltas = Counter()
+        for instance in session.new:
+            deltas[getattr(instance, "__tablename__", None)] += 1
+        for instance in session.deleted:
+            deltas[getattr(instance, "__tablename__", None)] -= 1
+        for name in COUNTED_TABLES:
+            if deltas[name]:
+                session.execute(
+                    update(TableCount)
+                    .where(TableCount.name == name)
+                    .values(count=TableCount.count + deltas[name])
+                    .execution_options(synchronize_session=False)
+                )
+
+
+def exact_count(db, name: str) -> int:
+    # A sharded session runs the count on every shard, one row each
+    model = COUNTED_TABLES[name]
+    return sum(db.scalars(select(func.count(model.id))).all())
+
+
+def reconcile_table_counts(db, names: Iterable[str] = COUNTED_TABLES) -> dict:
+    counts = {name: exact_count(db, name) for name in names}
+    for name, count in counts.items():
+        db.execute(
+            insert(TableCount)
+            .values(name=name, count=count)
+            .on_conflict_do_update(index_elements=["name"], set_={"count": count})
+        )
+    db.commit()
+    return counts
+
+
+def seed_table_counts(db) -> dict:
+    # Adds the rows missing from table_counts with an exact count; run once
+    # per worker at startup so that reads never write
+    seeded = {
+        name: exact_count(db, name)
+        for name in COUNTED_TABLES
+        if db.scalar(select(TableCount.count).where(TableCount.name == name)) is None
+    }
+    for name, count in seeded.items():
+        db.execute(
+            insert(TableCount)
+            .values(name=name, count=count)
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+    db.commit()
+    return seeded
+
+
+def table_total(db, name: str) -> int:
+    total = db.scalar(select(TableCount.count).where(TableCount.name == name))
+    if total is None:
+        # Not seeded yet; count without writing from a read request
+        total = exact_count(db, name)
+    return total
+
+
+class IndexStats:
+    # Row estimates from sqlite_stat1, which ANALYZE fills from a sample of
+    # ANALYSIS_LIMIT rows per index. Each entry reads "rows avg1 avg2 ...",
+    # where avgN is the average number of rows sharing a value of the first
+    # N indexed columns.
+    def __init__(self, engines=None, ttl: float = STATS_TTL):
+        self.engines = engines
+        self.ttl = ttl
+        self.stats = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    def _load(self) -> dict:
+        stats = Counter()
+        for engine in self.engines or post_engines:
+            with engine.connect() as connection:
+                has_stats = connection.exec_driver_sql(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+                ).scalar()
+                if not has_stats:
+                    continue
+                for table, index, stat in connection.exec_driver_sql(
+                    "SELECT tbl, idx, stat FROM sqlite_stat1"
+                ):
+                    numbers = [int(value) for value in stat.split()[:2]]
+                    # Per-file estimates add up: a user's posts and comments
+                    # are spread over the shards
+                    stats[(table, index, "rows")] += numbers[0]
+                    if len(numbers) > 1:
+                        stats[(table, index, "per_key")] += numbers[1]
+        return stats
+
+    def estimate(self, table: str, index: str) -> Optional[int]:
+        # Expected rows matching one value of the index's first column
+        with self.lock:
+            if self.stats is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.stats = self._load()
+                self.loaded_at = time.monotonic()
+            return self.stats.get((table, index, "per_key"))
+
+    def invalidate(self):
+        with self.lock:
+            self.stats = None
+
+
+index_stats = IndexStats()
+
+
+def estimated_activity_total(stats: IndexStats = index_stats) -> Optional[int]:
+    # Posts plus comments per user on average, the figure the query planner
+    # itself uses for a user's activity feed. It costs nothing per request,
+    # but says nothing about the particular user.
+    estimates = [
+        stats.estimate("posts", "ix_posts_user_id_created_at_id"),
+        stats.estimate("comments", "ix_comments_user_id_created_at_id"),
+    ]
+    if None in estimates:
+        return None
+    return sum(estimates)
+
+
+def analyze_sampled(engine, limit: int = ANALYSIS_LIMIT):
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f"PRAGMA analysis_limit = {int(limit)}")
+        connection.exec_driver_sql("ANALYZE")
+        connection.commit()
+    index_stats.invalidate()
+
+
+def set_total_count(response: Response, total: Optional[int], estimated=False):
+    if total is None:
+        return
+    response.headers["X-Total-Count"] = str(total)
+    if estimated:
+        response.headers["X-Total-Count-Estimated"] = "true"
+
+
+track_table_counts(SessionLocal)
@@ -1,21 +1,50 @@
-from typing import List
+import base64
+import heapq
+import os
+from itertools import islice
+from typing import List, Optional
 
 from fastapi import HTTPException, Depends, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError
+from sqlalchemy import and_, bindparam, or_, select
 from sqlalchemy.orm import Session
 
+from cache import cache
 from dependencies import get_db
 from posts import models
+from posts.crud import get_by_ids
 from passlib.context import CryptContext
 from jose.jwt import encode, decode
 from datetime import datetime, timedelta
 
+from sharding import on_shard, post_shards
 from users.schemas import TokenData
 
 SECRET_KEY = "SECRET_KEY"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Authenticated users are cached without their password hash
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+# Comma-separated usernames allowed on the /admin/* routes
+ADMIN_USERNAMES = frozenset(
+    name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()
+)
+
+# Tie-break between a post and a comment created at the same instant
+ACTIVITY_RANKS = {"post": 1, "comment": 0}
+
+USER_BY_ID = select(models.User).where(models.User.id == bindparam("user_id"))
+USER_BY_USERNAME = select(models.User).where(
+    models.User.username == bindparam("username")
+)
+USERS_BY_IDS = select(models.User).where(
+    models.User.id.in_(bindparam("ids", expanding=True))
+)
+HOT_STATEMENTS = (
+    (USER_BY_ID, {"user_id": 0}),
+    (USER_BY_USERNAME, {"username": ""}),
+)
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -37,12 +66,30 @@ def get_current_user(
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
+    cached = cache.get("users", token_data.username)
+    if cached is not None:
+        return models.User(id=cached["id"], username=cached["username"])
     user = get_user_by_username(db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    cache.set(
+        "users",
+        token_data.username,
+        {"id": user.id, "username": user.username},
+        AUTH_CACHE_TTL,
+    )
     return user
 
 
+def get_current_admin(current_user: models.User = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return current_user
+
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
@@ -56,7 +103,11 @@ def get_all_users(db: Session, skip: int = 0, limit: int = 10) -> List[models.Us
 
 
 def get_user_by_id(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return db.scalars(USER_BY_ID, {"user_id": user_id}).first()
+
+
+def get_users_by_ids(db: Session, ids: List[int]):
+    return get_by_ids(db, USERS_BY_IDS, ids)
 
 
 def create_user(db: Session, user):
@@ -69,7 +120,7 @@ def create_user(db: Session, user):
 
 
 def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+    return db.scalars(USER_BY_USERNAME, {"username": username}).first()
 
 
 def authenticate_user(db: Session, username: str, password: str):
@@ -90,3 +141,101 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     encoded_jwt = encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+
+def encode_activity_cursor(created_at: datetime, kind: str, item_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{kind}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_activity_cursor(cursor: str) -> (datetime, str, int):
+    try:
+        created_at, kind, item_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        )
+        if kind not in ACTIVITY_RANKS:
+            raise ValueError(kind)
+        return datetime.fromisoformat(created_at), kind, int(item_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _activity_filter(model, user_id: int):
+    return (
+        model.user_id == user_id,
+        model.created_at.isnot(None),
+        or_(model.blocked == False, model.blocked.is_(None)),
+    )
+
+
+def _activity_source(
+    db: Session, model, kind: str, user_id: int, cursor, batch: int, shard_id=None
+):
+    # Reads one source newest first by keyset over (user_id, created_at, id),
+    # fetching another batch only when the merge asks for more rows.
+    rank = ACTIVITY_RANKS[kind]
+    query = on_shard(db.query(model), shard_id).filter(
+        *_activity_filter(model, user_id)
+    )
+    if cursor is not None:
+        created_at, cursor_kind, cursor_id = cursor
+        cursor_rank = ACTIVITY_RANKS[cursor_kind]
+        if rank < cursor_rank:
+            after = model.created_at <= created_at
+        elif rank > cursor_rank:
+            after = model.created_at < created_at
+        else:
+            after = or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, model.id < cursor_id),
+            )
+        query = query.filter(after)
+
+    while True:
+        rows = (
+            query.order_by(model.created_at.desc(), model.id.desc()).limit(batch).all()
+        )
+        for row in rows:
+            yield (row.created_at, rank, row.id), kind, row
+        if len(rows) < batch:
+            return
+        last = rows[-1]
+        query = query.filter(
+            or_(
+                model.created_at < last.created_at,
+                and_(model.created_at == last.created_at, model.id < last.id),
+            )
+        )
+
+
+def get_user_activity(
+    db: Session, user_id: int, limit: int = 20, cursor: Optional[str] = None
+) -> dict:
+    position = decode_activity_cursor(cursor) if cursor else None
+    # One source per kind and shard; a user's rows are spread over all shards
+    sources = [
+        _activity_source(db, model, kind, user_id, position, limit + 1, shard_id)
+        for model, kind in ((models.Post, "post"), (models.Comment, "comment"))
+        for shard_id in post_shards(db)
+    ]
+    merged = heapq.merge(*sources, key=lambda item: item[0], reverse=True)
+    page = list(islice(merged, limit + 1))
+
+    items = [
+        {
+            "kind": kind,
+            "id": row.id,
+            "created_at": row.created_at,
+            "post_id": row.id if kind == "post" else row.post_id,
+            "title": row.title if kind == "post" else None,
+            "content": row.content,
+        }
+        for _, kind, row in page[:limit]
+    ]
+    next_cursor = None
+    if len(page) > limit:
+        last = items[-1]
+        next_cursor = encode_activity_cursor(
+            last["created_at"], last["kind"], last["id"]
+        )
+    return {"items": items, "next_cursor": next_cursor}
@@ -1,11 +1,14 @@
 from datetime import timedelta
-from typing import List
+from typing import List, Optional
 
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, HTTPException, APIRouter, Query, Request, Response
 from sqlalchemy.orm import Session
 
 from dependencies import get_db
+from negotiation import negotiated_response
 from posts import models
+from posts.schemas import BatchIds
+from totals import estimated_activity_total, set_total_count, table_total
 
 from users import schemas
 from users import crud
@@ -50,12 +53,43 @@ def read_user(
     return user
 
 
+@router.post("/users/batch", response_model=schemas.UserBatch)
+def read_users_batch(
+    batch: BatchIds,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    items, missing = crud.get_users_by_ids(db, batch.ids)
+    return {"items": items, "missing": missing}
+
+
 @router.get("/users/", response_model=List[schemas.User])
 def read_users(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 10,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
+    set_total_count(response, table_total(db, "users"))
     users = crud.get_all_users(db, skip=skip, limit=limit)
-    return users
+    return negotiated_response(
+        request,
+        [schemas.User.model_validate(user) for user in users],
+        headers=response.headers,
+    )
+
+
+@router.get("/users/{user_id}/activity", response_model=schemas.ActivityPage)
+def read_user_activity(
+    user_id: int,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    # A per-user count would scan the whole feed; the planner's estimate is free
+    set_total_count(response, estimated_activity_total(), estimated=True)
+    return crud.get_user_activity(db, user_id, limit=limit, cursor=cursor)
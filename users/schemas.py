@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -24,6 +25,11 @@ class User(UserBase):
         from_attributes = True
 
 
+class UserBatch(BaseModel):
+    items: List[User]
+    missing: List[int]
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -31,3 +37,17 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+
+
+class ActivityItem(BaseModel):
+    kind: str
+    id: int
+    created_at: datetime
+    post_id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ActivityPage(BaseModel):
+    items: List[ActivityItem]
+    next_cursor: Optional[str] = None
@@ -1,8 +1,13 @@
 import unittest
+from datetime import datetime
 from unittest.mock import MagicMock
 
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import Base
+from posts import models
 
 from users import crud
 from users.crud import ALGORITHM, SECRET_KEY
@@ -44,3 +49,81 @@ class TestUserFunctions(unittest.TestCase):
         with self.assertRaises(HTTPException) as cm:
             crud.get_current_user(db=self.mock_db_session, token=invalid_token)
         self.assertEqual(cm.exception.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_get_current_admin(self):
+        # Test only usernames listed in ADMIN_USERNAMES pass the admin check
+        admin = models.User(id=1, username="root")
+        with unittest.mock.patch("users.crud.ADMIN_USERNAMES", frozenset({"root"})):
+            self.assertIs(crud.get_current_admin(current_user=admin), admin)
+            with self.assertRaises(HTTPException) as cm:
+                crud.get_current_admin(
+                    current_user=models.User(id=2, username="testuser")
+                )
+        self.assertEqual(cm.exception.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_get_user_activity_pages(self):
+        # Test posts and comments are merged newest first across cursor pages
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        db = sessionmaker(bind=engine)()
+        db.add_all(
+            [
+                models.Post(
+                    id=1, title="P1", user_id=1, created_at=datetime(2024, 1, 1)
+                ),
+                models.Post(
+                    id=2, title="P2", user_id=1, created_at=datetime(2024, 1, 3)
+                ),
+                models.Post(
+                    id=3, title="Other", user_id=2, created_at=datetime(2024, 1, 4)
+                ),
+                models.Comment(
+                    id=1,
+                    content="C1",
+                    post_id=1,
+                    user_id=1,
+                    created_at=datetime(2024, 1, 2),
+                    blocked=False,
+                ),
+                models.Comment(
+                    id=2,
+                    content="C2",
+                    post_id=1,
+                    user_id=1,
+                    created_at=datetime(2024, 1, 3),
+                    blocked=False,
+                ),
+                models.Comment(
+                    id=3,
+                    content="C3",
+                    post_id=1,
+                    user_id=1,
+                    created_at=datetime(2024, 1, 5),
+                    blocked=True,
+                ),
+                models.Comment(
+                    id=4,
+                    content="C4",
+                    post_id=2,
+                    user_id=1,
+                    created_at=datetime(2024, 1, 6),
+                    blocked=False,
+                ),
+            ]
+        )
+        db.commit()
+
+        seen = []
+        cursor = None
+        while True:
+            page = crud.get_user_activity(db, user_id=1, limit=2, cursor=cursor)
+            seen += [(item["kind"], item["id"]) for item in page["items"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual(
+            seen,
+            [("comment", 4), ("post", 2), ("comment", 2), ("comment", 1), ("post", 1)],
+        )
+        db.close()